@@ -0,0 +1,537 @@
+import json
+import logging
+import os
+import pickle
+import struct
+import threading
+import time
+import uuid
+import weakref
+import zlib
+from collections import OrderedDict
+from typing import Optional
+
+from cachelib.serializers import RedisSerializer
+from flask_caching.backends.rediscache import RedisCache
+from redis.exceptions import RedisError
+
+from GeorchestraMonitoring import (
+    CACHE_BYTES,
+    CACHE_COMPRESSION_RATIO,
+    CACHE_REJECTED,
+    CACHE_REQUESTS,
+    register_collect_callback,
+)
+
+logger = logging.getLogger(__name__)
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+decompression_errors = (struct.error, zlib.error)
+if zstandard is not None:
+    decompression_errors += (zstandard.ZstdError,)
+
+
+class CacheValueTooLarge(ValueError):
+    pass
+
+
+class CacheSerializer(RedisSerializer):
+    """
+    cachelib's Redis serializer (integers as plain text, anything else pickled with a
+    "!" marker), compressing the values of at least `threshold` bytes. A compressed
+    value is stored as:
+      "~" | codec (1 byte: "z" for zlib, "s" for zstd) | original size (8 bytes) | data
+    Values without the "~" marker, e.g. written before compression was enabled, are
+    read as before.
+    Values bigger than `max_size` bytes once compressed are refused
+    (CacheValueTooLarge)
+    """
+
+    marker = b"~"
+    header = struct.Struct(">cQ")
+    codecs = {"zlib": b"z", "zstd": b"s"}
+
+    def __init__(
+        self,
+        name: str,
+        threshold: Optional[int] = None,
+        codec: Optional[str] = None,
+        level: Optional[int] = None,
+        max_size: Optional[int] = None,
+    ):
+        """
+        :param name: name of the cache, for the metrics
+        :param threshold: compress the values of at least this size, in bytes. None
+        to never compress
+        :param codec: zstd or zlib. Defaults to zstd if the zstandard package is
+        installed, zlib otherwise
+        :param level: compression level, defaults to the codec's default
+        :param max_size: max size of a stored value, in bytes. None for no limit
+        """
+        self.name = name
+        self.threshold = threshold
+        self.max_size = max_size
+        if codec is None:
+            codec = "zstd" if zstandard is not None else "zlib"
+        if codec not in self.codecs:
+            raise ValueError(f"Unknown cache compression codec {codec}")
+        if codec == "zstd" and zstandard is None:
+            logger.warning(
+                f"zstandard package not found. Cache {name} is compressed with zlib"
+            )
+            codec = "zlib"
+        self.codec = codec
+        if codec == "zstd":
+            self._compress = zstandard.ZstdCompressor(level=level or 3).compress
+        else:
+            self._compress = lambda data: zlib.compress(data, level or 6)
+
+    def dumps(self, value, protocol: int = pickle.HIGHEST_PROTOCOL) -> bytes:
+        dump = super().dumps(value, protocol)
+        # Integers stay plain text, for INCR/DECR
+        if self.threshold is not None and len(dump) >= self.threshold and dump[:1] == b"!":
+            compressed = self._compress(dump)
+            if len(compressed) + 1 + self.header.size < len(dump):
+                CACHE_COMPRESSION_RATIO.labels(self.name).observe(len(dump) / len(compressed))
+                dump = (
+                    self.marker
+                    + self.header.pack(self.codecs[self.codec], len(dump))
+                    + compressed
+                )
+        if self.max_size is not None and len(dump) > self.max_size:
+            raise CacheValueTooLarge(
+                f"{len(dump)} bytes, more than the {self.max_size} allowed"
+            )
+        return dump
+
+    def loads(self, value: Optional[bytes]):
+        if value is None or not value.startswith(self.marker):
+            return super().loads(value)
+        try:
+            codec, size = self.header.unpack_from(value, 1)
+            data = value[1 + self.header.size :]
+            if codec == b"z":
+                dump = zlib.decompress(data)
+            elif codec == b"s" and zstandard is not None:
+                dump = zstandard.ZstdDecompressor().decompress(data, max_output_size=size)
+            else:
+                logger.warning(f"Can't decompress a {codec!r} entry of cache {self.name}")
+                return None
+        except decompression_errors as e:
+            logger.warning(f"Invalid compressed entry in cache {self.name}: {e}")
+            return None
+        return super().loads(dump)
+
+
+class LocalCache(object):
+    """
+    In-process LRU with TTL eviction, capped in number of items and in total size.
+    Holds the values as serialized in Redis, so that each caller gets its own copy of
+    the object
+    """
+
+    def __init__(
+        self,
+        max_items: int = 1000,
+        ttl: float = 10,
+        max_item_size: int = 65536,
+        max_size: int = 16777216,
+    ):
+        self.max_items = max_items
+        self.ttl = ttl
+        self.max_item_size = max_item_size
+        self.max_size = max_size
+        # key -> (expiration time, serialized value), least recently used first
+        self._items: OrderedDict[str, tuple[float, bytes]] = OrderedDict()
+        # Total size of the values
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            if time.monotonic() >= item[0]:
+                self._pop(key)
+                return None
+            self._items.move_to_end(key)
+            return item[1]
+
+    def put(self, key: str, value: bytes, ttl: Optional[float] = None) -> None:
+        """
+        :param ttl: time to live of the entry in Redis, in seconds (None: no
+        expiration). The entry is kept locally for the shortest of it and self.ttl
+        """
+        ttl = self.ttl if ttl is None else min(self.ttl, ttl)
+        if len(value) > self.max_item_size or ttl <= 0:
+            # Not worth it: the transfer time dominates the round trip
+            self.delete(key)
+            return
+        with self._lock:
+            self._pop(key)
+            self._items[key] = (time.monotonic() + ttl, value)
+            self._size += len(value)
+            while len(self._items) > self.max_items or self._size > self.max_size:
+                self._pop(next(iter(self._items)))
+
+    def _pop(self, key: str) -> None:
+        item = self._items.pop(key, None)
+        if item is not None:
+            self._size -= len(item[1])
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._pop(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+            self._size = 0
+
+
+class GeorchestraRedisCache(RedisCache):
+    """
+    Redis cache backend, instrumented: lookups (hits/misses) and memory used are
+    exposed as metrics, labelled with the cache's CACHE_KEY_PREFIX.
+    Use it as CACHE_TYPE: "GeorchestraCaches.GeorchestraRedisCache"
+
+    Optionally (CACHE_LOCAL_ENABLED), a small in-process LRU with a short TTL sits in
+    front of Redis, to spare the round trips for hot keys. Writes go to Redis, and
+    either update the local LRU (CACHE_LOCAL_WRITE_THROUGH) or just drop the key from
+    it. Either way, the other processes are told to drop the key through a Redis
+    pub/sub channel.
+    """
+
+    # All the instances, to compute their memory usage on demand
+    instances = weakref.WeakSet()
+    # Minimum interval, in seconds, between two computations of the memory usage.
+    # Means a SCAN over all the keys of the cache
+    size_refresh_interval = 300
+    _next_size_refresh = 0.0
+
+    # Local tier, if enabled
+    local: Optional[LocalCache] = None
+    write_through = False
+    invalidation_channel = None
+
+    @classmethod
+    def factory(cls, app, config, args, kwargs):
+        cache = super().factory(app, config, args, kwargs)
+        cache.name = config.get("CACHE_KEY_PREFIX") or "default"
+        cls.size_refresh_interval = int(
+            app.config.get(
+                "GEORCHESTRA_METRICS_CACHE_SIZE_INTERVAL", cls.size_refresh_interval
+            )
+        )
+        cls.instances.add(cache)
+        # Always set, to read the compressed entries even if compression got disabled
+        cache.serializer = CacheSerializer(
+            cache.name,
+            threshold=config.get("CACHE_COMPRESSION_THRESHOLD"),
+            codec=config.get("CACHE_COMPRESSION_CODEC"),
+            level=config.get("CACHE_COMPRESSION_LEVEL"),
+            max_size=config.get("CACHE_MAX_VALUE_SIZE"),
+        )
+        if config.get("CACHE_LOCAL_ENABLED", False):
+            cache.local = LocalCache(
+                max_items=int(config.get("CACHE_LOCAL_MAX_ITEMS", 1000)),
+                ttl=float(config.get("CACHE_LOCAL_TIMEOUT", 10)),
+                max_item_size=int(config.get("CACHE_LOCAL_MAX_ITEM_SIZE", 65536)),
+                max_size=int(config.get("CACHE_LOCAL_MAX_SIZE", 16777216)),
+            )
+            cache.write_through = bool(config.get("CACHE_LOCAL_WRITE_THROUGH", False))
+            cache.invalidation_channel = config.get(
+                "CACHE_LOCAL_INVALIDATION_CHANNEL",
+                f"georchestra_cache_invalidation_{cache.name}",
+            )
+            cache._listener_pid = None
+            cache._listener_lock = threading.Lock()
+        return cache
+
+    # Reads
+
+    def get(self, key):
+        if self.local is None:
+            value = super().get(key)
+            CACHE_REQUESTS.labels(self.name, "redis", "miss" if value is None else "hit").inc()
+            return value
+        dump = self.local.get(key)
+        if dump is not None:
+            CACHE_REQUESTS.labels(self.name, "local", "hit").inc()
+            return self.serializer.loads(dump)
+        CACHE_REQUESTS.labels(self.name, "local", "miss").inc()
+        self._start_listener()
+        (dump,), (ttl,) = self._read([key])
+        CACHE_REQUESTS.labels(self.name, "redis", "miss" if dump is None else "hit").inc()
+        if dump is not None:
+            self.local.put(key, dump, ttl)
+        return self.serializer.loads(dump)
+
+    def get_many(self, *keys):
+        if self.local is None:
+            values = super().get_many(*keys)
+            self._count_lookups("redis", values)
+            return values
+        dumps = [self.local.get(key) for key in keys]
+        self._count_lookups("local", dumps)
+        missing = [i for i, dump in enumerate(dumps) if dump is None]
+        if missing:
+            self._start_listener()
+            redis_dumps, ttls = self._read([keys[i] for i in missing])
+            self._count_lookups("redis", redis_dumps)
+            for i, dump, ttl in zip(missing, redis_dumps, ttls):
+                dumps[i] = dump
+                if dump is not None:
+                    self.local.put(keys[i], dump, ttl)
+        return [self.serializer.loads(dump) for dump in dumps]
+
+    def _read(self, keys: list[str]) -> tuple[list, list]:
+        """
+        Read from Redis, in a single round trip, the entries and how long they have
+        left to live, for the local tier not to keep them longer
+        :return: the serialized values, and their time to live in seconds (None: no
+        expiration)
+        """
+        names = [self._get_prefix() + key for key in keys]
+        pipeline = self._read_client.pipeline(transaction=False)
+        pipeline.mget(names)
+        for name in names:
+            pipeline.pttl(name)
+        dumps, *ttls = pipeline.execute()
+        return dumps, [ttl / 1000 if ttl >= 0 else None for ttl in ttls]
+
+    def has(self, key):
+        if self.local is not None and self.local.get(key) is not None:
+            return True
+        return super().has(key)
+
+    def _count_lookups(self, tier: str, values: list) -> None:
+        hits = sum(1 for value in values if value is not None)
+        if hits:
+            CACHE_REQUESTS.labels(self.name, tier, "hit").inc(hits)
+        if len(values) > hits:
+            CACHE_REQUESTS.labels(self.name, tier, "miss").inc(len(values) - hits)
+
+    # Writes
+
+    def _dump(self, value) -> Optional[bytes]:
+        """
+        :return: the serialized value, None if it is too big to be cached
+        """
+        try:
+            return self.serializer.dumps(value)
+        except CacheValueTooLarge as e:
+            CACHE_REJECTED.labels(self.name).inc()
+            logger.info(f"Value not stored in cache {self.name}: {e}")
+            return None
+
+    def _expiration(self, timeout) -> Optional[int]:
+        timeout = self._normalize_timeout(timeout)
+        return None if timeout == -1 else timeout
+
+    def set(self, key, value, timeout=None):
+        dump = self._dump(value)
+        if dump is None:
+            # Don't leave a previous value behind
+            self.delete(key)
+            return False
+        result = self._write_client.set(
+            name=self._get_prefix() + key, value=dump, ex=self._expiration(timeout)
+        )
+        if self.local is not None:
+            self._written(
+                [key], {key: dump} if result else None, self._expiration(timeout)
+            )
+        return result
+
+    def add(self, key, value, timeout=None):
+        dump = self._dump(value)
+        if dump is None:
+            return False
+        name = self._get_prefix() + key
+        created = self._write_client.setnx(name=name, value=dump)
+        expiration = self._expiration(timeout)
+        if created and expiration is not None:
+            self._write_client.expire(name=name, time=expiration)
+        if self.local is not None and created:
+            self._written([key], {key: dump}, expiration)
+        return created
+
+    def set_many(self, mapping, timeout=None):
+        expiration = self._expiration(timeout)
+        dumps = {key: self._dump(value) for key, value in mapping.items()}
+        pipeline = self._write_client.pipeline(transaction=False)
+        for key, dump in dumps.items():
+            if dump is None:
+                pipeline.delete(self._get_prefix() + key)
+            else:
+                pipeline.set(name=self._get_prefix() + key, value=dump, ex=expiration)
+        results = pipeline.execute()
+        written = [
+            key
+            for (key, dump), result in zip(dumps.items(), results)
+            if dump is not None and result
+        ]
+        if self.local is not None:
+            self._written(
+                list(mapping), {key: dumps[key] for key in written}, expiration
+            )
+        return written
+
+    def delete(self, key):
+        result = super().delete(key)
+        if self.local is not None:
+            self._written([key])
+        return result
+
+    def delete_many(self, *keys):
+        result = super().delete_many(*keys)
+        if self.local is not None:
+            self._written(list(keys))
+        return result
+
+    def inc(self, key, delta=1):
+        result = super().inc(key, delta)
+        if self.local is not None:
+            self._written([key])
+        return result
+
+    def dec(self, key, delta=1):
+        result = super().dec(key, delta)
+        if self.local is not None:
+            self._written([key])
+        return result
+
+    def clear(self):
+        result = super().clear()
+        if self.local is not None:
+            self.local.clear()
+            self._publish(None)
+        return result
+
+    def _written(
+        self,
+        keys: list[str],
+        values: Optional[dict] = None,
+        expiration: Optional[int] = None,
+    ) -> None:
+        """
+        Keep the local tier consistent after a write, in this process and the others
+        :param keys: the keys that were written or deleted
+        :param values: the serialized values actually written in Redis, by key
+        :param expiration: their time to live in Redis, in seconds (None: none)
+        """
+        for key in keys:
+            if self.write_through and values and key in values:
+                self.local.put(key, values[key], expiration)
+            else:
+                self.local.delete(key)
+        self._publish(keys)
+
+    # Invalidation of the other processes' local tier
+
+    def _publish(self, keys: Optional[list[str]]) -> None:
+        """
+        :param keys: keys to drop, None to clear the whole local tier
+        """
+        self._start_listener()
+        try:
+            self._write_client.publish(
+                self.invalidation_channel,
+                json.dumps({"sender": self._sender, "keys": keys}),
+            )
+        except RedisError as e:
+            logger.warning(f"Could not publish the {self.name} cache invalidation ({e})")
+
+    def _start_listener(self) -> None:
+        # Threads don't survive a fork: start one per process, on first use
+        if self._listener_pid == os.getpid():
+            return
+        with self._listener_lock:
+            if self._listener_pid == os.getpid():
+                return
+            # Whatever was cached before the fork can't be trusted anymore
+            self.local.clear()
+            self._sender = uuid.uuid4().hex
+            threading.Thread(
+                target=self._listen,
+                name=f"georchestra-cache-invalidation-{self.name}",
+                daemon=True,
+            ).start()
+            self._listener_pid = os.getpid()
+
+    def _listen(self) -> None:
+        while True:
+            try:
+                pubsub = self._write_client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.invalidation_channel)
+                for message in pubsub.listen():
+                    self._invalidate(message["data"])
+            except RedisError as e:
+                # Invalidations may have been missed in the meantime
+                self.local.clear()
+                logger.warning(
+                    f"Lost the {self.name} cache invalidation channel ({e}). Retrying in 5s"
+                )
+                time.sleep(5)
+
+    def _invalidate(self, data: bytes) -> None:
+        try:
+            message = json.loads(data)
+        except ValueError:
+            logger.warning(f"Invalid {self.name} cache invalidation message: {data!r}")
+            return
+        if message.get("sender") == self._sender:
+            return
+        keys = message.get("keys")
+        if keys is None:
+            self.local.clear()
+            return
+        for key in keys:
+            self.local.delete(key)
+
+    # Memory usage
+
+    def get_memory_usage(self, batch_size: int = 1000) -> int:
+        """
+        :return: memory used in Redis by the keys of this cache, in bytes
+        """
+        total = 0
+        keys = []
+        for key in self._read_client.scan_iter(
+            match=self._get_prefix() + "*", count=batch_size
+        ):
+            keys.append(key)
+            if len(keys) >= batch_size:
+                total += self._get_keys_memory_usage(keys)
+                keys = []
+        if keys:
+            total += self._get_keys_memory_usage(keys)
+        return total
+
+    def _get_keys_memory_usage(self, keys) -> int:
+        pipeline = self._read_client.pipeline(transaction=False)
+        for key in keys:
+            pipeline.memory_usage(key)
+        return sum(usage or 0 for usage in pipeline.execute())
+
+    @classmethod
+    def update_size_metrics(cls) -> None:
+        now = time.monotonic()
+        if now < cls._next_size_refresh:
+            return
+        cls._next_size_refresh = now + cls.size_refresh_interval
+        for cache in list(cls.instances):
+            try:
+                CACHE_BYTES.labels(cache.name).set(cache.get_memory_usage())
+            except Exception as e:
+                logger.warning(f"Could not compute the size of cache {cache.name}: {e}")
+
+
+register_collect_callback(GeorchestraRedisCache.update_size_metrics)
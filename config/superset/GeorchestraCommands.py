@@ -0,0 +1,366 @@
+import base64
+import csv
+import json
+import logging
+import os
+import time
+from typing import Iterator, Optional
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from flask_appbuilder.security.sqla.models import User as FabUser
+from sqlalchemy import func, Index, inspect
+from sqlalchemy.orm import selectinload
+
+from superset import db, security_manager as sm
+
+logger = logging.getLogger(__name__)
+
+# `superset georchestra ...` commands
+georchestra_cli = AppGroup("georchestra", help="geOrchestra integration commands")
+
+
+def _with_trailing_blank_line(lines) -> Iterator[str]:
+    # So that the last entry gets yielded
+    yield from lines
+    yield ""
+
+
+def _read_ldif(path: str) -> Iterator[dict[str, list[str]]]:
+    """
+    Minimal LDIF reader: yields one dict (attribute name, lower-cased -> values) per
+    entry. Handles continuation lines and base64-encoded values
+    """
+    entry: dict[str, list[str]] = {}
+    last_attribute = None
+    with open(path, encoding="utf-8") as lines:
+        for line in _with_trailing_blank_line(lines):
+            line = line.rstrip("\r\n")
+            if not line:
+                if entry:
+                    yield entry
+                entry, last_attribute = {}, None
+                continue
+            if line.startswith("#"):
+                continue
+            if line.startswith(" ") and last_attribute:
+                entry[last_attribute][-1] += line[1:]
+                continue
+            attribute, _, value = line.partition(":")
+            if value.startswith(":"):
+                value = base64.b64decode(value[1:].strip()).decode("utf-8")
+            else:
+                value = value.strip()
+            last_attribute = attribute.lower()
+            entry.setdefault(last_attribute, []).append(value)
+
+
+def _rdn_value(dn: str) -> str:
+    """
+    :return: value of the first RDN of a DN, e.g. jdoe for uid=jdoe,ou=users,...
+    """
+    return dn.split(",", 1)[0].partition("=")[2].strip()
+
+
+def read_ldif_export(path: str) -> list[dict]:
+    """
+    Read a geOrchestra LDAP export (users in ou=users, roles in ou=roles, organizations
+    in ou=orgs). The users' roles are taken from the `member` attribute of the roles
+    entries, and prefixed with ROLE_, like the gateway does in the sec-roles header.
+    Their organization (sec-org header) is the cn of the organization they are a member
+    of, or else their `o` attribute
+    """
+    users = {}
+    memberships = []
+    org_memberships = []
+    for entry in _read_ldif(path):
+        object_classes = {value.lower() for value in entry.get("objectclass", [])}
+        dn = entry.get("dn", [""])[0]
+        if "ou=pendingusers" in dn.lower():
+            # Not validated yet by an administrator
+            continue
+        if "uid" in entry and object_classes & {"person", "inetorgperson"}:
+            username = entry["uid"][0]
+            users[dn.lower()] = {
+                "username": username,
+                "email": entry.get("mail", [""])[0],
+                "first_name": entry.get("givenname", [username])[0],
+                "last_name": entry.get("sn", [""])[0],
+                "roles": [],
+                "org": entry.get("o", [""])[0],
+            }
+        elif "ou=orgs" in dn.lower():
+            if "member" in entry:
+                org = entry.get("cn", [_rdn_value(dn)])[0]
+                org_memberships.extend(
+                    (member.lower(), org) for member in entry["member"]
+                )
+        elif "groupofmembernames" in object_classes or "member" in entry:
+            role = f"ROLE_{entry.get('cn', [_rdn_value(dn)])[0]}"
+            memberships.extend((member.lower(), role) for member in entry.get("member", []))
+    for member, role in memberships:
+        if member in users:
+            users[member]["roles"].append(role)
+    for member, org in org_memberships:
+        if member in users:
+            users[member]["org"] = org
+    return list(users.values())
+
+
+# Accepted column names / keys in the CSV and JSON exports, lower-cased
+_field_aliases = {
+    "username": ("username", "uid", "login"),
+    "email": ("email", "mail"),
+    "first_name": ("first_name", "firstname", "givenname", "first name"),
+    "last_name": ("last_name", "lastname", "sn", "surname", "last name"),
+    "roles": ("roles", "role"),
+    "org": ("org", "organization", "organisation", "o"),
+}
+
+
+def _normalize_user(record: dict) -> Optional[dict]:
+    record = {str(key).strip().lower(): value for key, value in record.items()}
+    user = {}
+    for field, aliases in _field_aliases.items():
+        user[field] = next(
+            (record[alias] for alias in aliases if record.get(alias) is not None), ""
+        )
+    if not user["username"]:
+        return None
+    roles = user["roles"]
+    if isinstance(roles, str):
+        roles = roles.replace(",", ";").split(";")
+    user["roles"] = [role.strip() for role in roles if role and role.strip()]
+    user["first_name"] = user["first_name"] or user["username"]
+    user["org"] = str(user["org"]).strip()
+    return user
+
+
+def read_csv_export(path: str) -> list[dict]:
+    with open(path, encoding="utf-8", newline="") as f:
+        return [user for user in map(_normalize_user, csv.DictReader(f)) if user]
+
+
+def read_json_export(path: str) -> list[dict]:
+    with open(path, encoding="utf-8") as f:
+        content = json.load(f)
+    if isinstance(content, dict):
+        content = content.get("users", [])
+    return [user for user in map(_normalize_user, content) if user]
+
+
+readers = {
+    "ldif": read_ldif_export,
+    "csv": read_csv_export,
+    "json": read_json_export,
+}
+
+
+def _describe_roles(roles) -> str:
+    return "[" + ", ".join(sorted(role.name for role in roles)) + "]"
+
+
+class UsersProvisioner(object):
+    """
+    Creates or updates the Superset users from a geOrchestra users export, mapping
+    their roles like RemoteUserLogin does at login time. All the changes are done in a
+    single transaction, in batches of `batch_size` users. Running it again with the
+    same export changes nothing.
+    """
+
+    compared_fields = ("username", "email", "first_name", "last_name")
+
+    def __init__(self, batch_size: int = 500):
+        from GeorchestraCustomizations import RemoteUserLogin
+
+        self.batch_size = batch_size
+        self.login = RemoteUserLogin(current_app)
+        self.created = 0
+        self.updated = 0
+        self.unchanged = 0
+
+    def map_roles(self, georchestra_roles: list[str], org: str = ""):
+        # With the org, like at login time (sec-org header): org-scoped mapping rules
+        return self.login._get_valid_roles_from_header(";".join(georchestra_roles), org)
+
+    def _load_existing(self, users: list[dict]) -> tuple[dict, dict]:
+        """
+        :return: the existing users matching the batch, by lower-cased username and
+        by lower-cased email
+        """
+        usernames = [user["username"].lower() for user in users]
+        emails = [user["email"].lower() for user in users if user["email"]]
+        query = db.session.query(FabUser).options(selectinload(FabUser.roles))
+        by_username = {
+            user.username.lower(): user
+            for user in query.filter(func.lower(FabUser.username).in_(usernames))
+        }
+        by_email = {}
+        if emails:
+            by_email = {
+                user.email.lower(): user
+                for user in query.filter(func.lower(FabUser.email).in_(emails))
+            }
+        return by_username, by_email
+
+    def _diff(self, user: FabUser, profile: dict, roles) -> list[str]:
+        changes = [
+            f"{field}: {getattr(user, field)!r} -> {profile[field]!r}"
+            for field in self.compared_fields
+            if (getattr(user, field) or "") != profile[field]
+        ]
+        if {role.id for role in user.roles} != {role.id for role in roles}:
+            changes.append(
+                f"roles: {_describe_roles(user.roles)} -> {_describe_roles(roles)}"
+            )
+        return changes
+
+    def _provision_batch(self, users: list[dict]) -> None:
+        by_username, by_email = self._load_existing(users)
+        for profile in users:
+            roles = self.map_roles(profile["roles"], profile.get("org", ""))
+            user = by_username.get(profile["username"].lower())
+            if user is None and profile["email"]:
+                # Same as at login time: the username may have changed
+                user = by_email.get(profile["email"].lower())
+            if user is None:
+                click.echo(f"+ {profile['username']} {_describe_roles(roles)}")
+                user = sm.user_model(
+                    **{field: profile[field] for field in self.compared_fields},
+                    active=True,
+                    roles=roles,
+                )
+                db.session.add(user)
+                self.created += 1
+                continue
+            changes = self._diff(user, profile, roles)
+            if not changes:
+                self.unchanged += 1
+                continue
+            click.echo(f"~ {user.username}: " + ", ".join(changes))
+            for field in self.compared_fields:
+                setattr(user, field, profile[field])
+            user.roles = roles
+            self.updated += 1
+
+    def provision(self, users: list[dict], dry_run: bool = False) -> None:
+        # Last occurrence wins if a user is listed twice
+        users = list({user["username"].lower(): user for user in users}.values())
+        try:
+            for start in range(0, len(users), self.batch_size):
+                self._provision_batch(users[start : start + self.batch_size])
+                db.session.flush()
+            if dry_run:
+                db.session.rollback()
+            else:
+                db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        click.echo(
+            f"{'Dry run: ' if dry_run else ''}{self.created} users created, "
+            f"{self.updated} updated, {self.unchanged} unchanged"
+        )
+
+
+@georchestra_cli.command("provision")
+@click.argument("export_file", type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "--format",
+    "file_format",
+    type=click.Choice(list(readers)),
+    help="Format of the export. Default: guessed from the file extension",
+)
+@click.option(
+    "--dry-run", is_flag=True, help="Only show what would be created or updated"
+)
+@click.option("--batch-size", default=500, show_default=True, help="Users per batch")
+def provision(
+    export_file: str, file_format: Optional[str], dry_run: bool, batch_size: int
+) -> None:
+    """
+    Create or update the Superset users from a geOrchestra users export (LDIF, CSV or
+    JSON), so that they don't get created on their first login.
+    Roles are mapped like at login time (GEORCHESTRA_ROLES_MAPPING), with the users'
+    organization (LDIF: ou=orgs membership, CSV/JSON: org column). Safe to run
+    again: users already up-to-date are left unchanged.
+    """
+    if not file_format:
+        file_format = os.path.splitext(export_file)[1].lstrip(".").lower()
+        if file_format not in readers:
+            raise click.UsageError(
+                f"Could not guess the format of {export_file}. Use --format"
+            )
+    users = readers[file_format](export_file)
+    click.echo(f"{len(users)} users read from {export_file}")
+    UsersProvisioner(batch_size).provision(users, dry_run=dry_run)
+
+
+# Indexes supporting the users lookups done at login time (see
+# GeorchestraSecurityManager.find_user_by_username_or_email). ab_user.username
+# already has a unique index
+user_indexes = {
+    "ix_ab_user_lower_username": "username",
+    "ix_ab_user_lower_email": "email",
+}
+
+
+@georchestra_cli.command("ensure-indexes")
+def ensure_indexes() -> None:
+    """
+    Create the indexes on the Superset metadata DB used by the geOrchestra login logic,
+    if they don't exist yet. Run it after `superset db upgrade`
+    """
+    table = FabUser.__table__
+    engine = db.engine
+    existing = {index["name"] for index in inspect(engine).get_indexes(table.name)}
+    for name, column in user_indexes.items():
+        if engine.dialect.name in ("postgresql", "sqlite"):
+            # Expression-based indexes might not be reflected: rely on the DB instead
+            with engine.begin() as connection:
+                connection.exec_driver_sql(
+                    f"CREATE INDEX IF NOT EXISTS {name} ON {table.name} (lower({column}))"
+                )
+        elif name not in existing:
+            Index(name, func.lower(table.c[column])).create(engine)
+        click.echo(f"Index {name} on {table.name} (lower({column})): OK")
+
+
+@georchestra_cli.command("warm-up-caches")
+@click.option(
+    "--loop", is_flag=True, help="Run again every --interval seconds, until stopped"
+)
+@click.option(
+    "--interval",
+    type=int,
+    help="Seconds between two runs. Default: GEORCHESTRA_WARMUP_INTERVAL (3600)",
+)
+def warm_up_caches(loop: bool, interval: Optional[int]) -> None:
+    """
+    Compute the charts of the public and most viewed dashboards, to fill the chart
+    data cache (see the GEORCHESTRA_WARMUP_* settings). Alternatively, schedule the
+    georchestra.cache_warmup Celery task
+    """
+    from GeorchestraWarmup import CacheWarmer
+
+    warmer = CacheWarmer(current_app)
+    interval = interval or current_app.config.get("GEORCHESTRA_WARMUP_INTERVAL", 3600)
+    while True:
+        start = time.monotonic()
+        try:
+            report = warmer.run()
+            click.echo(
+                f"{report['warmed']}/{report['charts']} charts warmed up "
+                f"({report['errors']} errors) from {report['dashboards']} dashboards, "
+                f"in {report['seconds']}s"
+            )
+        except Exception:
+            if not loop:
+                raise
+            logger.exception("Cache warm-up failed")
+        if not loop:
+            return
+        # Don't keep stale dashboards around until the next run
+        db.session.remove()
+        time.sleep(max(0, interval - (time.monotonic() - start)))
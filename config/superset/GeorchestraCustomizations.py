@@ -1,11 +1,36 @@
+import atexit
+import hashlib
+import hmac
+import json
 import logging
+import os
+import queue
+import random
+import re
+import threading
+import time
 import warnings
+import weakref
+from collections import OrderedDict
 from configparser import ConfigParser
-from datetime import datetime, timedelta
+from functools import lru_cache
+from datetime import datetime, timedelta, timezone
 from itertools import chain
-from typing import Any, Optional
+from logging.handlers import QueueHandler, QueueListener
+from string import Formatter
+from typing import Any, Iterable, NamedTuple, Optional
 
-from flask import config as flask_config, flash, g, redirect, request, url_for
+from flask import (
+    config as flask_config,
+    flash,
+    g,
+    jsonify,
+    redirect,
+    request,
+    Response,
+    session,
+    url_for,
+)
 from flask_appbuilder import expose, IndexView
 from flask_appbuilder._compat import as_unicode
 from flask_appbuilder.security.decorators import no_cache
@@ -18,10 +43,19 @@ from flask_login import (
     login_user as flask_login_user,
     logout_user as flask_logout_user,
 )
+from sqlalchemy import event as sqla_event, func, or_
+from sqlalchemy.orm import (
+    joinedload,
+    make_transient_to_detached,
+    object_session,
+    Session,
+)
+from sqlalchemy.orm.attributes import set_committed_value
 from werkzeug.local import LocalProxy
 
-from superset import appbuilder, security_manager as sm, SupersetSecurityManager
+from superset import appbuilder, db, security_manager as sm, SupersetSecurityManager
 from superset.app import SupersetAppInitializer
+from superset.extensions import csrf
 from superset.superset_typing import FlaskResponse
 from superset.utils.log import AbstractEventLogger
 from superset.utils.logging_configurator import LoggingConfigurator
@@ -29,6 +63,16 @@ from superset.utils.logging_configurator import LoggingConfigurator
 logger = logging.getLogger(__name__)
 
 
+def _monitoring():
+    """
+    :return: the GeorchestraMonitoring module (metrics), imported on first use: it
+    pulls prometheus_client and the event loggers
+    """
+    import GeorchestraMonitoring
+
+    return GeorchestraMonitoring
+
+
 class GeorchestraRemoteUserView(AuthRemoteUserView):
     # Handle custom login/logout logic.
     # But actually, most of the custom logic will be found in RemoteUserLogin class
@@ -113,15 +157,91 @@ class GeorchestraRemoteUserView(AuthRemoteUserView):
                         f"Could not determine the host root url when calling logout"
                     )
                 next_url = root_url + self.LOGIN_REDIRECT_URL
-        logger.debug(f"Redirecting to {next_url}")
+        logger.debug("Redirecting to %s", next_url)
         return redirect(get_safe_redirect(next_url))
 
 
+class UserSnapshot(NamedTuple):
+    """
+    Compact view of a user profile: the fields telling whether the user record needs an
+    update
+    """
+
+    username: str
+    email: str
+    role_ids: frozenset[int]
+
+    @classmethod
+    def of_user(cls, user: FabUser) -> "UserSnapshot":
+        return cls(
+            user.username, user.email or "", frozenset(role.id for role in user.roles)
+        )
+
+    @classmethod
+    def of_profile(cls, user_profile: dict) -> "UserSnapshot":
+        """
+        :param user_profile: user profile, as read from the HTTP headers
+        """
+        return cls(
+            user_profile["username"],
+            user_profile["email"] or "",
+            frozenset(role.id for role in user_profile["roles"]),
+        )
+
+
 class GeorchestraSecurityManager(SupersetSecurityManager):
     authremoteuserview = GeorchestraRemoteUserView
 
     def __init__(self, appbuilder):
         super(GeorchestraSecurityManager, self).__init__(appbuilder)
+        self.stateless_auth = appbuilder.get_app.config.get(
+            "GEORCHESTRA_STATELESS_AUTH", False
+        )
+
+    def load_user(self, user_id):
+        # In stateless mode, the user comes from the HTTP headers only (see
+        # RemoteUserLogin.log_user_stateless), never from the session
+        if self.stateless_auth:
+            return None
+        return super().load_user(user_id)
+
+    def find_user_by_username_or_email(
+        self, username: str, email: Optional[str] = None
+    ) -> Optional[FabUser]:
+        """
+        Find a user by username or, failing that, by email (the username may have
+        changed), in a single query, with the roles loaded along.
+        The username match honours AUTH_USERNAME_CI, the email match is case-insensitive
+        (see the `ensure-indexes` command for the supporting indexes)
+        :param username:
+        :param email:
+        :return: the user, or None if not found
+        """
+        user_model = self.user_model
+        if self.auth_username_ci:
+            criteria = func.lower(user_model.username) == func.lower(username)
+        else:
+            criteria = user_model.username == username
+        if email:
+            criteria = or_(criteria, func.lower(user_model.email) == email.lower())
+        users = (
+            db.session.query(user_model)
+            .options(joinedload(user_model.roles))
+            .filter(criteria)
+            .all()
+        )
+
+        def normalize(name: str) -> str:
+            return name.lower() if self.auth_username_ci else name
+
+        # Prefer the username match
+        for user in users:
+            if normalize(user.username) == normalize(username):
+                return user
+        if len(users) > 1:
+            logger.error(f"Several users found with email {email}")
+            return None
+        return users[0] if users else None
 
 
 def get_flask_current_user() -> Optional[FabUser]:
@@ -141,6 +261,739 @@ def get_flask_current_user() -> Optional[FabUser]:
     return flask_current_user
 
 
+class RolesCheckStore(object):
+    """
+    Keeps track, for each logged-in username, of the last time their roles were checked
+    against the HTTP headers. Used by RemoteUserLogin to throttle the roles checks
+    (means DB access).
+    """
+
+    def claim(self, username: str) -> bool:
+        """
+        Tell whether a roles check is due for this user. If it is, record it right away,
+        so that concurrent requests don't run the same check.
+        :param username:
+        :return: True if the caller is expected to run the roles check
+        """
+        raise NotImplementedError
+
+    def forget(self, username: str) -> None:
+        """
+        Drop the user's entry: next call to claim() will trigger a roles check
+        :param username:
+        :return:
+        """
+        raise NotImplementedError
+
+
+class MemoryRolesCheckStore(RolesCheckStore):
+    """
+    In-process store: a LRU with TTL eviction and a size cap. Each gunicorn worker has
+    its own, so a user might get checked once per worker and per check period.
+    """
+
+    def __init__(self, ttl: timedelta, max_size: int = 10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        # username -> last check datetime, least recently checked first
+        self._checks: OrderedDict[str, datetime] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def claim(self, username: str) -> bool:
+        now = datetime.now()
+        with self._lock:
+            last_check = self._checks.get(username)
+            if last_check is not None and now < last_check + self.ttl:
+                return False
+            self._checks[username] = now
+            self._checks.move_to_end(username)
+            self._evict(now)
+        return True
+
+    def forget(self, username: str) -> None:
+        with self._lock:
+            self._checks.pop(username, None)
+
+    def _evict(self, now: datetime) -> None:
+        """
+        Drop the expired entries, then the oldest ones if we are still over the size
+        cap. Must be called with the lock held
+        """
+        while self._checks:
+            username, last_check = next(iter(self._checks.items()))
+            if len(self._checks) <= self.max_size and now < last_check + self.ttl:
+                break
+            del self._checks[username]
+
+
+class RedisRolesCheckStore(RolesCheckStore):
+    """
+    Store shared by all gunicorn workers (and all pods) through Redis. A roles check
+    done by one of them covers all the others for the check period.
+    Falls back to an in-process store if Redis is not reachable, and then leaves Redis
+    alone for `retry_interval` seconds, so that the requests don't all wait for it.
+    """
+
+    def __init__(
+        self,
+        redis_url: str,
+        ttl: timedelta,
+        key_prefix: str = "georchestra_roles_check_",
+        fallback: Optional[RolesCheckStore] = None,
+        timeout: float = 0.5,
+        retry_interval: float = 30,
+    ):
+        """
+        :param timeout: connection and socket timeout, in seconds
+        :param retry_interval: after a failure, seconds during which Redis is not used
+        """
+        from redis import from_url as redis_from_url
+
+        self.ttl_seconds = max(int(ttl.total_seconds()), 1)
+        self.key_prefix = key_prefix
+        self.fallback = fallback or MemoryRolesCheckStore(ttl)
+        self.retry_interval = retry_interval
+        self._redis = redis_from_url(
+            redis_url, socket_connect_timeout=timeout, socket_timeout=timeout
+        )
+        # time.monotonic() until which Redis is not used
+        self._unavailable_until = 0.0
+
+    def _available(self) -> bool:
+        return time.monotonic() >= self._unavailable_until
+
+    def _failed(self, e: Exception) -> None:
+        self._unavailable_until = time.monotonic() + self.retry_interval
+        logger.warning(
+            f"Could not reach redis for the roles check store ({e}). Using the "
+            f"in-process store for {self.retry_interval}s"
+        )
+
+    def claim(self, username: str) -> bool:
+        from redis.exceptions import RedisError
+
+        if not self._available():
+            return self.fallback.claim(username)
+        try:
+            # SET NX: only one worker gets to create the key, and run the check
+            return bool(
+                self._redis.set(
+                    self.key_prefix + username, 1, nx=True, ex=self.ttl_seconds
+                )
+            )
+        except RedisError as e:
+            self._failed(e)
+            return self.fallback.claim(username)
+
+    def forget(self, username: str) -> None:
+        from redis.exceptions import RedisError
+
+        self.fallback.forget(username)
+        if not self._available():
+            return
+        try:
+            self._redis.delete(self.key_prefix + username)
+        except RedisError as e:
+            self._failed(e)
+
+
+def get_roles_check_store(app, ttl: timedelta) -> RolesCheckStore:
+    """
+    Instantiate the roles check store configured by GEORCHESTRA_ROLES_CHECK_STORE
+    ("memory" or "redis")
+    """
+    max_size = int(app.config.get("GEORCHESTRA_ROLES_CHECK_STORE_SIZE", 10000))
+    memory_store = MemoryRolesCheckStore(ttl, max_size)
+    store_type = app.config.get("GEORCHESTRA_ROLES_CHECK_STORE", "memory")
+    if store_type == "redis":
+        redis_url = app.config.get("GEORCHESTRA_REDIS_URL")
+        if redis_url:
+            try:
+                return RedisRolesCheckStore(
+                    redis_url,
+                    ttl,
+                    fallback=memory_store,
+                    timeout=float(
+                        app.config.get("GEORCHESTRA_ROLES_CHECK_STORE_TIMEOUT", 0.5)
+                    ),
+                    retry_interval=float(
+                        app.config.get("GEORCHESTRA_ROLES_CHECK_STORE_RETRY_INTERVAL", 30)
+                    ),
+                )
+            except ImportError:
+                logger.warning(
+                    "redis package not found. Using the in-process roles check store"
+                )
+        else:
+            logger.warning(
+                "GEORCHESTRA_REDIS_URL is not set. Using the in-process roles check store"
+            )
+    elif store_type != "memory":
+        logger.warning(
+            f"Invalid value for GEORCHESTRA_ROLES_CHECK_STORE: {store_type}. Using the in-process roles check store"
+        )
+    return memory_store
+
+
+class RoleCatalog(object):
+    """
+    In-process index of the Superset roles, keyed by upper-cased name. Matching the
+    roles from the HTTP headers is then a dict lookup per role, instead of loading and
+    scanning the whole roles list.
+    The index is invalidated when a role is created, renamed or deleted (SQLAlchemy
+    events, so it covers the FAB role views as well as the CLI imports). The
+    other workers are told about it through a version counter stored in Redis, that
+    they check at most every `check_interval` seconds. If Redis is not reachable, the
+    index is kept as is, and Redis is left alone for `retry_interval` seconds.
+    """
+
+    version_key = "georchestra_role_catalog_version"
+    # Live catalogs, notified by the SQLAlchemy listeners registered once below
+    instances = weakref.WeakSet()
+
+    def __init__(
+        self,
+        redis_url: Optional[str] = None,
+        check_interval: int = 30,
+        timeout: float = 0.5,
+        retry_interval: float = 30,
+    ):
+        """
+        :param timeout: Redis connection and socket timeout, in seconds
+        :param retry_interval: after a Redis failure, seconds during which it is not used
+        """
+        self.check_interval = check_interval
+        self.retry_interval = retry_interval
+        # upper-cased role name -> (role id, role name)
+        self._roles: dict[str, tuple[int, str]] = {}
+        # role id -> role name
+        self._names: dict[int, str] = {}
+        # Incremented on each (re)load, so that results computed from the index can be
+        # cached along with it
+        self.generation = 0
+        self._loaded = False
+        # Version of the shared counter the index was loaded with
+        self._version = None
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+        self._redis = None
+        # time.monotonic() until which Redis is not used
+        self._unavailable_until = 0.0
+        if redis_url:
+            try:
+                from redis import from_url as redis_from_url
+
+                self._redis = redis_from_url(
+                    redis_url, socket_connect_timeout=timeout, socket_timeout=timeout
+                )
+            except ImportError:
+                logger.warning(
+                    "redis package not found. Role catalog changes won't be shared between workers"
+                )
+
+        RoleCatalog.instances.add(self)
+
+    @classmethod
+    def _on_role_change(cls, mapper, connection, target) -> None:
+        # Only advertise the change once committed, or the other workers might
+        # reload the roles before it is visible to them
+        for catalog in list(cls.instances):
+            catalog._loaded = False
+        session = object_session(target)
+        if session is not None:
+            session.info[cls.version_key] = True
+
+    @classmethod
+    def _on_commit(cls, session) -> None:
+        if session.info.pop(cls.version_key, False):
+            for catalog in list(cls.instances):
+                catalog.invalidate()
+
+    def _available(self) -> bool:
+        return (
+            self._redis is not None and time.monotonic() >= self._unavailable_until
+        )
+
+    def _failed(self, message: str) -> None:
+        self._unavailable_until = time.monotonic() + self.retry_interval
+        logger.warning(f"{message}. Not using redis for {self.retry_interval}s")
+
+    def invalidate(self) -> None:
+        """
+        Mark the index as stale, in this worker and in all the others
+        :return:
+        """
+        self.mark_stale()
+        if self._available():
+            from redis.exceptions import RedisError
+
+            try:
+                self._redis.incr(self.version_key)
+            except RedisError as e:
+                self._failed(f"Could not publish the role catalog version ({e})")
+
+    def mark_stale(self) -> None:
+        """
+        Mark the index as stale, in this worker only
+        :return:
+        """
+        logger.debug("Role catalog invalidated")
+        self._loaded = False
+
+    def _get_shared_version(self) -> Optional[int]:
+        if not self._redis:
+            return None
+        if not self._available():
+            return self._version
+        from redis.exceptions import RedisError
+
+        try:
+            version = self._redis.get(self.version_key)
+        except RedisError as e:
+            self._failed(f"Could not read the role catalog version ({e})")
+            return self._version
+        return int(version) if version else 0
+
+    def _ensure_loaded(self) -> None:
+        now = time.monotonic()
+        if self._loaded and now < self._next_check:
+            return
+        with self._lock:
+            if self._loaded and now < self._next_check:
+                return
+            version = self._get_shared_version()
+            if not self._loaded or version != self._version:
+                self._roles = {
+                    role.name.upper(): (role.id, role.name)
+                    for role in sm.get_all_roles()
+                }
+                self._names = {role_id: name for role_id, name in self._roles.values()}
+                self.generation += 1
+                self._version = version
+                self._loaded = True
+                logger.debug("Role catalog loaded (%d roles)", len(self._roles))
+            self._next_check = now + self.check_interval
+
+    @staticmethod
+    def _attach(role_id: int, role_name: str) -> FabRole:
+        """
+        Get the role as a member of the current DB session, without querying the DB
+        (the instance from the session's identity map is reused if there is one)
+        """
+        role = FabRole(id=role_id, name=role_name)
+        make_transient_to_detached(role)
+        return db.session.merge(role, load=False)
+
+    def get(self, name: str) -> Optional[FabRole]:
+        """
+        :param name: role name, case-insensitive
+        :return: the role or None if there is no such role
+        """
+        self._ensure_loaded()
+        entry = self._roles.get(name.upper())
+        return self._attach(*entry) if entry else None
+
+    def find(self, names: Iterable[str]) -> list[FabRole]:
+        """
+        :param names: role names, case-insensitive
+        :return: the existing roles matching those names, without duplicates
+        """
+        self._ensure_loaded()
+        entries = {}
+        for name in names:
+            entry = self._roles.get(name.upper())
+            if entry:
+                entries[entry[0]] = entry
+        return [self._attach(*entry) for entry in entries.values()]
+
+    def get_generation(self) -> int:
+        """
+        :return: the generation of the index, reloading it first if it is stale
+        """
+        self._ensure_loaded()
+        return self.generation
+
+    def find_ids(self, names: Iterable[str]) -> set[int]:
+        """
+        :param names: role names, case-insensitive
+        :return: the ids of the existing roles matching those names
+        """
+        self._ensure_loaded()
+        return {
+            entry[0] for entry in map(self._roles.get, map(str.upper, names)) if entry
+        }
+
+    def get_by_ids(self, role_ids: Iterable[int]) -> list[FabRole]:
+        """
+        :param role_ids:
+        :return: the existing roles with those ids
+        """
+        self._ensure_loaded()
+        return [
+            self._attach(role_id, self._names[role_id])
+            for role_id in role_ids
+            if role_id in self._names
+        ]
+
+
+# Registered once for all the role catalogs, see RoleCatalog.instances
+for _event_name in ("after_insert", "after_update", "after_delete"):
+    sqla_event.listen(FabRole, _event_name, RoleCatalog._on_role_change)
+sqla_event.listen(Session, "after_commit", RoleCatalog._on_commit)
+
+
+class RolesMapper(object):
+    """
+    Maps the geOrchestra roles (sec-roles header) to Superset role names, following a
+    list of rules (see GEORCHESTRA_ROLES_MAPPING), compiled once:
+    - {"role": "ROLE_X", "superset_roles": [...]}: exact match. All the exact rules
+    matching a role apply
+    - {"pattern": "ROLE_(?P<name>.+)", "superset_roles": ["{name}"]}: regex, that must
+    match the whole role. Only tried if no exact rule matched, the first matching one
+    applies. Its named groups can be used in the Superset role names
+    - any rule can have an "org" key: it then only applies to the members of this
+    organization (sec-org header). {org} can be used in the Superset role names
+    The exact rules are turned into a dict, the patterns into a single regex (one per
+    organization having specific rules).
+    """
+
+    def __init__(self, rules: list[dict]):
+        self.rules = [self._validate(rule) for rule in rules]
+        orgs = {rule.get("org") for rule in self.rules}
+        # org -> (exact rules dict, pattern rules, combined regex)
+        self._compiled = {org: self._compile(org) for org in orgs | {None}}
+
+    @classmethod
+    def from_prefix(cls, prefix: str) -> "RolesMapper":
+        """
+        :return: the legacy mapping: ROLE_SUPERSET_XXX gives the XXX Superset role
+        """
+        return cls(
+            [{"pattern": f"{re.escape(prefix)}(?P<name>.+)", "superset_roles": ["{name}"]}]
+        )
+
+    @staticmethod
+    def _validate(rule: dict) -> dict:
+        rule = dict(rule)
+        if ("role" in rule) == ("pattern" in rule):
+            raise ValueError(f"Role mapping rule {rule}: expected either role or pattern")
+        targets = rule.get("superset_roles")
+        if isinstance(targets, str):
+            targets = [targets]
+        if not targets or not all(isinstance(target, str) for target in targets):
+            raise ValueError(f"Role mapping rule {rule}: expected superset_roles names")
+        rule["superset_roles"] = tuple(targets)
+        allowed_fields = {"org"}
+        if "pattern" in rule:
+            try:
+                rule["regex"] = re.compile(rule["pattern"])
+            except re.error as e:
+                raise ValueError(f"Role mapping rule {rule}: invalid pattern ({e})")
+            allowed_fields |= set(rule["regex"].groupindex)
+        for target in targets:
+            fields = {field for _, field, _, _ in Formatter().parse(target) if field}
+            if not fields <= allowed_fields:
+                raise ValueError(
+                    f"Role mapping rule {rule}: unknown fields {fields - allowed_fields}"
+                )
+        return rule
+
+    def _compile(self, org: Optional[str]) -> tuple[dict, list, Optional[re.Pattern]]:
+        rules = [rule for rule in self.rules if rule.get("org") in (None, org)]
+        exact: dict[str, tuple[str, ...]] = {}
+        for rule in rules:
+            if "role" in rule:
+                exact[rule["role"]] = exact.get(rule["role"], ()) + rule["superset_roles"]
+        patterns = [rule for rule in rules if "pattern" in rule]
+        return exact, patterns, self._combine(patterns)
+
+    @staticmethod
+    def _combine(patterns: list[dict]) -> Optional[re.Pattern]:
+        """
+        Combine the patterns into a single regex: (?P<_0>pattern0)|(?P<_1>pattern1)...
+        Their named groups get prefixed (_0_name), since a name can't be used twice.
+        :return: the regex, or None if the patterns can't be combined (numbered
+        references would point to the wrong groups): they are then tried one by one
+        """
+        parts = []
+        for i, rule in enumerate(patterns):
+            pattern = rule["pattern"]
+            if re.search(r"\\[1-9]|\(\?\(", pattern):
+                return None
+            pattern = re.sub(r"\(\?P<(\w+)>", rf"(?P<_{i}_\1>", pattern)
+            pattern = re.sub(r"\(\?P=(\w+)\)", rf"(?P=_{i}_\1)", pattern)
+            parts.append(f"(?P<_{i}>{pattern})")
+        if not parts:
+            return None
+        try:
+            return re.compile("|".join(parts))
+        except re.error:
+            return None
+
+    @staticmethod
+    def _match_pattern(
+        role: str, patterns: list[dict], combined: Optional[re.Pattern]
+    ) -> Optional[tuple[dict, dict]]:
+        """
+        :return: the first pattern rule matching the role and the named groups values
+        """
+        if combined is not None:
+            match = combined.fullmatch(role)
+            if not match:
+                return None
+            # The outer group of the matching alternative is the last one closed
+            i = int(match.lastgroup[1:])
+            prefix = f"_{i}_"
+            groups = {
+                name[len(prefix) :]: value
+                for name, value in match.groupdict().items()
+                if name.startswith(prefix)
+            }
+            return patterns[i], groups
+        for rule in patterns:
+            match = rule["regex"].fullmatch(role)
+            if match:
+                return rule, match.groupdict()
+        return None
+
+    def map(self, georchestra_roles: Iterable[str], org: str = "") -> set[str]:
+        """
+        :param georchestra_roles:
+        :param org: the user's organization
+        :return: the Superset role names
+        """
+        exact, patterns, combined = self._compiled.get(org) or self._compiled[None]
+        names = set()
+        for role in georchestra_roles:
+            targets = exact.get(role)
+            if targets:
+                names.update(target.format(org=org) for target in targets)
+                continue
+            matched = self._match_pattern(role, patterns, combined) if patterns else None
+            if matched:
+                rule, groups = matched
+                names.update(
+                    target.format(org=org, **groups) for target in rule["superset_roles"]
+                )
+        return names
+
+
+class StatelessUserCache(object):
+    """
+    Per-worker cache of the user profiles, for the stateless auth mode: keyed by the
+    fingerprint of the HTTP headers, a LRU with TTL eviction and a size cap. Stores
+    plain values, that are turned into a user object of the current DB session on each
+    request without querying the DB.
+    """
+
+    user_fields = ("id", "username", "email", "first_name", "last_name", "active")
+
+    def __init__(self, ttl: timedelta, max_size: int = 10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        # fingerprint -> (expiration datetime, user values), oldest first
+        self._users: OrderedDict[str, tuple[datetime, dict]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, fingerprint: str) -> Optional[dict]:
+        now = datetime.now()
+        with self._lock:
+            entry = self._users.get(fingerprint)
+            if entry is None:
+                return None
+            if now >= entry[0]:
+                del self._users[fingerprint]
+                return None
+            return entry[1]
+
+    def put(self, fingerprint: str, user: FabUser) -> None:
+        values = {field: getattr(user, field) for field in self.user_fields}
+        values["role_names"] = tuple(role.name for role in user.roles)
+        now = datetime.now()
+        with self._lock:
+            self._users[fingerprint] = (now + self.ttl, values)
+            self._users.move_to_end(fingerprint)
+            while len(self._users) > self.max_size:
+                self._users.popitem(last=False)
+
+
+class ProfileWriteBehind(object):
+    """
+    Persists the user profile updates out of the request thread (write-behind).
+    Updates are coalesced per user: only the latest profile of each user gets written,
+    by a background thread, in batches of up to `batch_size` users per transaction,
+    every `flush_interval` seconds. A failed batch is retried on the next flushes, up to
+    `max_retries` times.
+    Pending updates are flushed when the process exits.
+    """
+
+    profile_fields = ("username", "email", "first_name", "last_name")
+
+    def __init__(
+        self,
+        app,
+        flush_interval: float = 1.0,
+        batch_size: int = 100,
+        max_retries: int = 3,
+    ):
+        self.app = app
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        # Latest profile to write, by user id. Entries are removed once written
+        self._pending: dict[int, dict] = {}
+        # Failed attempts, by user id
+        self._attempts: dict[int, int] = {}
+        self._lock = threading.Lock()
+        self._wakeup = None
+        self._stopping = None
+        self._thread = None
+        self._pid = None
+
+    def start(self) -> None:
+        # Threads don't survive a fork: start one per process (e.g. gunicorn worker),
+        # on first use
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pending = {}
+            self._attempts = {}
+            self._wakeup = threading.Event()
+            self._stopping = threading.Event()
+            self._thread = threading.Thread(
+                target=self._run, name="georchestra-profile-writer", daemon=True
+            )
+            self._thread.start()
+            self._pid = os.getpid()
+            atexit.register(self.close)
+
+    def submit(self, user: FabUser) -> None:
+        """
+        Queue the current state of the user object for persistence
+        :param user:
+        :return:
+        """
+        profile = {field: getattr(user, field) for field in self.profile_fields}
+        profile["role_ids"] = tuple(sorted(role.id for role in user.roles))
+        profile["role_names"] = tuple(role.name for role in user.roles)
+        self.start()
+        with self._lock:
+            self._pending[user.id] = profile
+            # A new profile gets a fresh set of retries
+            self._attempts.pop(user.id, None)
+            if len(self._pending) >= self.batch_size:
+                self._wakeup.set()
+
+    def get_pending(self, user_id: int) -> Optional[dict]:
+        """
+        :return: the profile waiting to be written for this user, if any
+        """
+        return self._pending.get(user_id)
+
+    def close(self, timeout: float = 10) -> None:
+        """
+        Stop the background thread, after it wrote the pending updates
+        :param timeout: max time to wait for it, in seconds
+        :return:
+        """
+        if self._pid != os.getpid() or self._stopping.is_set():
+            return
+        self._stopping.set()
+        self._wakeup.set()
+        self._thread.join(timeout)
+
+    def _run(self) -> None:
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            stopping = self._stopping.is_set()
+            self.flush(retry=not stopping)
+            if stopping:
+                return
+
+    def flush(self, retry: bool = True) -> None:
+        """
+        Write the pending updates, one transaction per batch
+        :param retry: whether failed updates are kept for a later attempt
+        :return:
+        """
+        with self._lock:
+            pending = list(self._pending.items())
+        for start in range(0, len(pending), self.batch_size):
+            batch = dict(pending[start : start + self.batch_size])
+            try:
+                self._write(batch)
+            except Exception as e:
+                logger.warning(
+                    f"Could not write the profile of {len(batch)} users: {e}"
+                )
+                self._failed(batch, retry)
+            else:
+                _monitoring().PROFILE_WRITES.labels("written").inc(len(batch))
+                self._forget(batch)
+
+    def _write(self, batch: dict[int, dict]) -> None:
+        with self.app.app_context():
+            try:
+                user_model, role_model = sm.user_model, sm.role_model
+                users = (
+                    db.session.query(user_model).filter(user_model.id.in_(batch)).all()
+                )
+                role_ids = set(chain.from_iterable(p["role_ids"] for p in batch.values()))
+                roles = {
+                    role.id: role
+                    for role in db.session.query(role_model).filter(
+                        role_model.id.in_(role_ids)
+                    )
+                }
+                for user in users:
+                    profile = batch[user.id]
+                    for field in self.profile_fields:
+                        setattr(user, field, profile[field])
+                    user.roles = [
+                        roles[role_id] for role_id in profile["role_ids"] if role_id in roles
+                    ]
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+        logger.debug("Wrote the profile of %d users", len(users))
+
+    def _forget(self, batch: dict[int, dict]) -> None:
+        with self._lock:
+            for user_id, profile in batch.items():
+                # Unless it was updated again in the meantime
+                if self._pending.get(user_id) is profile:
+                    del self._pending[user_id]
+                    self._attempts.pop(user_id, None)
+
+    def _failed(self, batch: dict[int, dict], retry: bool) -> None:
+        given_up = {}
+        retried = 0
+        with self._lock:
+            for user_id, profile in batch.items():
+                if self._pending.get(user_id) is not profile:
+                    # Updated in the meantime: the new profile will be written instead
+                    continue
+                attempts = self._attempts.get(user_id, 0) + 1
+                self._attempts[user_id] = attempts
+                if not retry or attempts > self.max_retries:
+                    given_up[user_id] = profile
+                else:
+                    retried += 1
+        if retried:
+            _monitoring().PROFILE_WRITES.labels("retried").inc(retried)
+        if given_up:
+            _monitoring().PROFILE_WRITES.labels("failed").inc(len(given_up))
+            logger.error(
+                "Giving up writing the profile of users "
+                + ", ".join(profile["username"] for profile in given_up.values())
+            )
+            self._forget(given_up)
+
+
 class RemoteUserLogin(object):
     """
     Middleware to extract user info from HTTP headers and login the user.
@@ -153,8 +1006,37 @@ class RemoteUserLogin(object):
     # access so we don't want it to happen too often
     roles_default_check_frequency = 5
 
-    # A dict. Stores for each logged-in username the last time the roles were checked
-    roles_checks = dict()
+    # HTTP headers the user profile is built from
+    profile_headers = (
+        "HTTP_SEC_USERNAME",
+        "HTTP_SEC_ROLES",
+        "HTTP_SEC_EMAIL",
+        "HTTP_SEC_FIRSTNAME",
+        "HTTP_SEC_LASTNAME",
+        # The roles mapping may depend on the organization
+        "HTTP_SEC_ORG",
+    )
+    # Max number of invalidated users waiting for their next request
+    max_dirty_users = 10000
+    # Session key where the fingerprint of those headers is stored
+    fingerprint_session_key = "_georchestra_headers_fingerprint"
+
+    # Requests to those paths and endpoints don't need a logged-in user: they bypass the
+    # login logic. Paths ending with a / are prefixes, the others must match exactly
+    default_bypass_paths = (
+        "/static/",
+        "/health",
+        "/ping",
+        "/favicon.ico",
+        "/robots.txt",
+    )
+    default_bypass_endpoints = (
+        "static",
+        "appbuilder.static",
+        "health",
+        "georchestra_metrics",
+        "georchestra_invalidate",
+    )
 
     def __init__(self, app):
         self.app = app
@@ -176,6 +1058,88 @@ class RemoteUserLogin(object):
         )
         # We need the user to have at least a Public role, no role at all is _bad_
 
+        # Fast mode: only sync the user profile when the sec-headers change, instead
+        # of checking it every ROLES_CHECK_FREQUENCY minutes
+        self.USE_HEADERS_FINGERPRINT = app.config.get(
+            "GEORCHESTRA_HEADERS_FINGERPRINT", False
+        )
+
+        # Stores for each logged-in username the last time the roles were checked
+        self.roles_checks = get_roles_check_store(
+            app, timedelta(minutes=self.ROLES_CHECK_FREQUENCY)
+        )
+
+        bypass_paths = app.config.get(
+            "GEORCHESTRA_LOGIN_BYPASS_PATHS", self.default_bypass_paths
+        )
+        self.BYPASS_PATHS = frozenset(
+            path for path in bypass_paths if not path.endswith("/")
+        )
+        # Path prefixes as a tuple: str.startswith will check them all at once
+        self.BYPASS_PATH_PREFIXES = tuple(
+            path for path in bypass_paths if path.endswith("/")
+        )
+        self.BYPASS_ENDPOINTS = frozenset(
+            app.config.get(
+                "GEORCHESTRA_LOGIN_BYPASS_ENDPOINTS", self.default_bypass_endpoints
+            )
+        )
+        # Anonymous requests with no logged-in session skip the logout logic
+        self.ANONYMOUS_FAST_PATH = app.config.get(
+            "GEORCHESTRA_ANONYMOUS_FAST_PATH", True
+        )
+        self.SESSION_COOKIE_NAME = app.config.get("SESSION_COOKIE_NAME", "session")
+        self.REMEMBER_COOKIE_NAME = app.config.get(
+            "REMEMBER_COOKIE_NAME", "remember_token"
+        )
+        # Index of the Superset roles, to match the ones from the HTTP headers
+        self.role_catalog = RoleCatalog(
+            app.config.get("GEORCHESTRA_REDIS_URL"),
+            int(app.config.get("GEORCHESTRA_ROLE_CATALOG_CHECK_INTERVAL", 30)),
+            timeout=float(
+                app.config.get("GEORCHESTRA_ROLES_CHECK_STORE_TIMEOUT", 0.5)
+            ),
+            retry_interval=float(
+                app.config.get("GEORCHESTRA_ROLES_CHECK_STORE_RETRY_INTERVAL", 30)
+            ),
+        )
+        # Stateless mode: the user is built from the HTTP headers on each request,
+        # nothing is stored in the session
+        self.STATELESS_AUTH = app.config.get("GEORCHESTRA_STATELESS_AUTH", False)
+        self.stateless_users = StatelessUserCache(
+            timedelta(minutes=self.ROLES_CHECK_FREQUENCY),
+            int(app.config.get("GEORCHESTRA_STATELESS_CACHE_SIZE", 10000)),
+        )
+        # Users whose profile must be checked on their next request, whatever the
+        # roles check period (see RolesInvalidation)
+        self._dirty_users: set[str] = set()
+        # Shared by the request threads and the invalidation subscriber thread
+        self._dirty_users_lock = threading.Lock()
+        # Mapping of the geOrchestra roles to the Superset ones. Compiled once, and the
+        # result memoized for each distinct roles header
+        mapping = app.config.get("GEORCHESTRA_ROLES_MAPPING")
+        self.roles_mapper = (
+            RolesMapper(mapping) if mapping else RolesMapper.from_prefix(self.ROLES_PREFIX)
+        )
+        self._map_roles_header = lru_cache(
+            maxsize=int(app.config.get("GEORCHESTRA_ROLES_MAPPING_CACHE_SIZE", 4096))
+        )(self._map_roles_header_uncached)
+        # Write-behind mode: profile updates are persisted by a background thread
+        self.profile_writer = None
+        if app.config.get("GEORCHESTRA_PROFILE_WRITE_BEHIND", False):
+            self.profile_writer = ProfileWriteBehind(
+                app,
+                flush_interval=float(
+                    app.config.get("GEORCHESTRA_PROFILE_WRITE_BEHIND_INTERVAL", 1.0)
+                ),
+                batch_size=int(
+                    app.config.get("GEORCHESTRA_PROFILE_WRITE_BEHIND_BATCH_SIZE", 100)
+                ),
+                max_retries=int(
+                    app.config.get("GEORCHESTRA_PROFILE_WRITE_BEHIND_MAX_RETRIES", 3)
+                ),
+            )
+
     def _get_username(self) -> Optional[str]:
         """
         In geOrchestra context, the username is passed on the HTTP_SEC_USERNAME http header
@@ -187,6 +1151,32 @@ class RemoteUserLogin(object):
         request.environ["REMOTE_USER"] = user
         return user
 
+    def _get_headers_fingerprint(self) -> str:
+        """
+        Hash of the HTTP headers the user profile is built from. Stored in the session
+        when the profile gets synced, so we can tell if anything changed since.
+        """
+        values = "\x1f".join(
+            request.environ.get(header, "") for header in self.profile_headers
+        )
+        return hashlib.blake2b(values.encode("utf-8"), digest_size=16).hexdigest()
+
+    def _has_logged_in_session(self) -> bool:
+        """
+        Whether the request comes with a session (or remember-me cookie) that might hold
+        a logged-in user. Avoids reading the session when there is no session cookie
+        """
+        cookies = request.cookies
+        if self.REMEMBER_COOKIE_NAME in cookies:
+            return True
+        if self.SESSION_COOKIE_NAME not in cookies:
+            return False
+        return "_user_id" in session
+
+    def _logout_user(self) -> None:
+        flask_logout_user()
+        session.pop(self.fingerprint_session_key, None)
+
     def _user_from_http_headers(self) -> dict:
         """
         Read the HTTP headers. Return a dict with the geOrchestra user profile, with
@@ -198,7 +1188,9 @@ class RemoteUserLogin(object):
             return {}
 
         georchestra_roles = request.environ.get("HTTP_SEC_ROLES", "")
-        superset_roles = self._get_valid_roles_from_header(georchestra_roles)
+        superset_roles = self._get_valid_roles_from_header(
+            georchestra_roles, request.environ.get("HTTP_SEC_ORG", "")
+        )
         return {
             "username": username,
             "roles": superset_roles,
@@ -207,28 +1199,38 @@ class RemoteUserLogin(object):
             "email": request.environ.get("HTTP_SEC_EMAIL", ""),
         }
 
-    def _get_valid_roles_from_header(self, georchestra_roles: str) -> list[FabRole]:
+    def _map_roles_header_uncached(
+        self, georchestra_roles: str, org: str, catalog_generation: int
+    ) -> tuple[int, ...]:
+        """
+        :param catalog_generation: only there to be part of the memoization key: the
+        result depends on the roles existing in Superset
+        :return: the ids of the Superset roles, sorted
+        """
+        names = self.roles_mapper.map(georchestra_roles.split(";"), org)
+        return tuple(sorted(self.role_catalog.find_ids(names)))
+
+    def _get_valid_roles_from_header(
+        self, georchestra_roles: str, org: str = ""
+    ) -> list[FabRole]:
         """
         Split and filter roles based on the list provided in the HTTP headers
-        :param georchestra_roles: comma-separated list of geOrchestra roles. Superset
-        relevant roles are expected to have a ROLE_SUPERSET_ prefix
+        :param georchestra_roles: semicolon-separated list of geOrchestra roles,
+        mapped to Superset roles following GEORCHESTRA_ROLES_MAPPING (by default,
+        Superset relevant roles are expected to have a ROLE_SUPERSET_ prefix)
+        :param org: the user's organization, for the org-scoped mapping rules
         :return: a list of superset-relevant roles
         """
-        all_superset_roles = sm.get_all_roles()
-
-        roles_list = georchestra_roles.split(";")
-        superset_roles = [
-            role.replace(self.ROLES_PREFIX, "", 1).upper()
-            for role in roles_list
-            if role.startswith(self.ROLES_PREFIX)
-        ]
-
-        valid_roles = [
-            r for r in all_superset_roles if r.name.upper() in superset_roles
-        ]
+        role_ids = self._map_roles_header(
+            georchestra_roles, org, self.role_catalog.get_generation()
+        )
+        valid_roles = self.role_catalog.get_by_ids(role_ids)
         if not valid_roles:
             # We need the user to have at least a role. If none, let it be `Public`
-            valid_roles = [sm.find_role(self.AUTH_USER_DEFAULT_ROLE)]
+            valid_roles = [
+                self.role_catalog.get(self.AUTH_USER_DEFAULT_ROLE)
+                or sm.find_role(self.AUTH_USER_DEFAULT_ROLE)
+            ]
         return valid_roles
 
     def _update_user(self, user: FabUser, user_profile: Optional[dict] = None) -> FabUser:
@@ -242,20 +1244,134 @@ class RemoteUserLogin(object):
         """
         if not user_profile:
             user_profile = self._user_from_http_headers()
-        if (
-            set(user_profile["roles"]) != set(user.roles)
-            or user_profile["email"] != user.email
-            or user_profile["username"] != user.username
-        ):
+        if UserSnapshot.of_profile(user_profile) != UserSnapshot.of_user(user):
             logger.debug(
-                f"User {user.username} changed since last connection. Updating the profile"
+                "User %s changed since last connection. Updating the profile",
+                user.username,
             )
+            _monitoring().PROFILE_UPDATES.inc()
+            if self.profile_writer:
+                # Update the user object for the current request only, without marking
+                # it dirty (it won't be flushed with the request's session). The DB
+                # record is updated in the background
+                for k, v in user_profile.items():
+                    set_committed_value(user, k, v)
+                self.profile_writer.submit(user)
+                return user
             # Then update user definition
             for k, v in user_profile.items():
                 setattr(user, k, v)
             success = sm.update_user(user)
         return user
 
+    def invalidate_user(self, username: str) -> None:
+        """
+        Have the user's profile checked against the HTTP headers on their next request
+        :param username:
+        :return:
+        """
+        self.roles_checks.forget(username)
+        with self._dirty_users_lock:
+            if len(self._dirty_users) >= self.max_dirty_users:
+                # Users who don't come back: the roles check store still covers them
+                self._dirty_users.clear()
+            self._dirty_users.add(username)
+
+    def _pop_dirty_user(self, username: str) -> bool:
+        """
+        :return: True if the user was invalidated since their last request
+        """
+        with self._dirty_users_lock:
+            if username not in self._dirty_users:
+                return False
+            self._dirty_users.discard(username)
+            return True
+
+    def _apply_pending_profile(self, user: FabUser) -> None:
+        """
+        In write-behind mode, the user loaded from the DB may not have the latest
+        profile yet: apply the one waiting to be written, if any (in this process)
+        :param user:
+        :return:
+        """
+        profile = self.profile_writer.get_pending(user.id)
+        if not profile:
+            return
+        for field in ProfileWriteBehind.profile_fields:
+            set_committed_value(user, field, profile[field])
+        set_committed_value(user, "roles", self.role_catalog.find(profile["role_names"]))
+
+    def _attach_user(self, values: dict) -> FabUser:
+        """
+        Get a user object of the current DB session from the cached values, without
+        querying the DB
+        """
+        user = FabUser(**{field: values[field] for field in StatelessUserCache.user_fields})
+        make_transient_to_detached(user)
+        # No backref events: the roles must not get the user added to the session
+        set_committed_value(user, "roles", self.role_catalog.find(values["role_names"]))
+        return db.session.merge(user, load=False)
+
+    def _sync_user(self, headers_username: str) -> Optional[FabUser]:
+        """
+        Get the user matching the HTTP headers from the DB, updating or creating it
+        :return: the user, None if it couldn't be created
+        """
+        user_profile = self._user_from_http_headers()
+        # Retrieve the user from the DB, if he exists. If not found by username, we
+        # still can get one through the email address (his username may change)
+        user = sm.find_user_by_username_or_email(
+            headers_username, user_profile.get("email")
+        )
+        # Update the user if he exists, create him if not
+        if user:
+            logger.debug("New user logged in: %s", user.username)
+            g.georchestra_login_path = "new_login"
+            return self._update_user(user, user_profile)
+        logger.debug("User not found, creating it")
+        g.georchestra_login_path = "user_creation"
+        # Rename key "roles" to "role" to match the add_user function definition"
+        user_profile["role"] = user_profile.pop("roles", [])
+        sm.add_user(**user_profile)
+        return sm.auth_user_remote_user(headers_username)
+
+    def log_user_stateless(self) -> tuple[object, bool]:
+        """
+        Stateless counterpart of log_user: the user is taken from the HTTP headers on
+        each request, and set as the current user for this request only. Nothing is
+        written to the session, so there is no login/logout when the user changes.
+        The DB is only hit when the headers fingerprint is not in this worker's cache
+        (new user, changed headers, or cache entry older than the roles check
+        frequency)
+        :return: (user:object, is_different_user:bool) tuple. is_different_user is
+        always False, there is no session to compare with
+        """
+        headers_username = self._get_username()
+        if not headers_username:
+            g.georchestra_login_path = "anonymous"
+            g._login_user = sm.lm.anonymous_user()
+            return None, False
+        fingerprint = self._get_headers_fingerprint()
+        values = self.stateless_users.get(fingerprint)
+        if values is not None and not self._pop_dirty_user(headers_username):
+            _monitoring().ROLES_CHECKS.labels("hit").inc()
+            g.georchestra_login_path = "fast_path"
+            user = self._attach_user(values)
+            if self.profile_writer:
+                self._apply_pending_profile(user)
+        else:
+            _monitoring().ROLES_CHECKS.labels("miss").inc()
+            user = self._sync_user(headers_username)
+            if user:
+                self.stateless_users.put(fingerprint, user)
+        if not user or not user.is_active:
+            # Same as Flask-Login, that doesn't log in inactive users
+            g._login_user = sm.lm.anonymous_user()
+            return None, False
+        # Where Flask-Login looks for the current user, before the session
+        g._login_user = user
+        return user, False
+
     def log_user(self) -> tuple[object, bool]:
         """
         Handle the login logic based on the HTTP headers and the currently logged-in
@@ -290,82 +1406,310 @@ class RemoteUserLogin(object):
         is_different_user = False
         # Username as advertised by the HTTP headers
         headers_username = self._get_username()
+        if (
+            not headers_username
+            and self.ANONYMOUS_FAST_PATH
+            and not self._has_logged_in_session()
+        ):
+            # Anonymous request, and nobody to log out: leave the session alone, so
+            # that we don't set any cookie (keeps the response cacheable)
+            g.georchestra_login_path = "anonymous_fast_path"
+            return None, False
         # User as stored by Flask_login session
         current_user = get_flask_current_user()
 
         # If they match:
         if current_user and current_user.is_authenticated:
             if current_user.username == headers_username:
-                logger.debug(f"Remote user {headers_username} already logged")
+                logger.debug("Remote user %s already logged", headers_username)
+                if self.USE_HEADERS_FINGERPRINT:
+                    # Fast mode: the user profile can only have changed if the
+                    # sec-headers changed since they were last stored in the session
+                    fingerprint = self._get_headers_fingerprint()
+                    if self._pop_dirty_user(headers_username) or (
+                        session.get(self.fingerprint_session_key) != fingerprint
+                    ):
+                        logger.debug(
+                            "HTTP headers for %s changed. Updating the profile",
+                            headers_username,
+                        )
+                        _monitoring().ROLES_CHECKS.labels("miss").inc()
+                        g.georchestra_login_path = "recheck"
+                        current_user = self._update_user(current_user)
+                        session[self.fingerprint_session_key] = fingerprint
+                    else:
+                        _monitoring().ROLES_CHECKS.labels("hit").inc()
+                        g.georchestra_login_path = "fast_path"
+                        if self.profile_writer:
+                            self._apply_pending_profile(current_user)
+                    return current_user, False
                 # Check if roles have changed since the session was started
                 # Check is done every GEORCHESTRA_ROLES_CHECK_FREQUENCY times only,
                 # to avoid calling DB on each call of the log_user function
-                # (can happen more than 10 times per page load)
-                last_check = self.roles_checks.get(
-                    headers_username, datetime.fromtimestamp(0)
-                )
-                if datetime.now() > last_check + timedelta(
-                    minutes=self.ROLES_CHECK_FREQUENCY
+                # (can happen more than 10 times per page load), or when the user was
+                # invalidated (see RolesInvalidation)
+                if self._pop_dirty_user(headers_username) or self.roles_checks.claim(
+                    headers_username
                 ):
                     logger.debug(
-                        f"Checking if roles for {headers_username} are up-to-date since last check ({last_check})"
+                        "Checking if roles for %s are up-to-date", headers_username
                     )
-                    self.roles_checks[headers_username] = datetime.now()
+                    _monitoring().ROLES_CHECKS.labels("miss").inc()
+                    g.georchestra_login_path = "recheck"
                     current_user = self._update_user(current_user)
+                else:
+                    _monitoring().ROLES_CHECKS.labels("hit").inc()
+                    g.georchestra_login_path = "fast_path"
+                    if self.profile_writer:
+                        self._apply_pending_profile(current_user)
                 return current_user, False
             else:
                 # No match, the user changed since last request, log him out
                 # and switch to new user
-                flask_logout_user()
+                self._logout_user()
                 is_different_user = True
 
         # Handle anonymous case (not logged-in)
         if not headers_username:
             # Log out eventually logged-in previous user and switch to anonymous
-            flask_logout_user()
+            self._logout_user()
+            g.georchestra_login_path = "anonymous"
             return None, True
         else:
-            logger.debug(f"Remote user {headers_username} logs in")
+            logger.debug("Remote user %s logs in", headers_username)
 
         # We're left with the case where the user has just logged in (no current_user)
         # but http sec-headers indicate a logged-in user
 
-        # Retrieve the user from the DB, if he exists
-        user = sm.find_user(username=headers_username)
-        # If not found by username, we still can get one through the email address
-        # (his username may change)
-        user_profile = self._user_from_http_headers()
-        if not user:
-            user = sm.find_user(email=user_profile.get("email"))
-        # Retrieve roles from http header and filter to the ones relevant in Superset context
-
-        # Update the user if he exists, create him if not
-        if user:
-            logger.debug("New user logged in: %s", user.username)
-            user = self._update_user(user, user_profile)
-        else:
-            # Create user
-            logger.debug("User not found, creating it")
-            # Rename key "roles" to "role" to match the add_user function definition"
-            user_profile["role"] = user_profile.pop("roles", [])
-            user = sm.add_user(**user_profile)
-            user = sm.auth_user_remote_user(headers_username)
+        user = self._sync_user(headers_username)
 
         flask_login_user(user)
+        if self.USE_HEADERS_FINGERPRINT:
+            session[self.fingerprint_session_key] = self._get_headers_fingerprint()
         return user, is_different_user
 
+    def is_bypassed(self) -> bool:
+        """
+        Whether the current request can skip the login logic: static assets, health
+        checks etc.
+        """
+        path = request.path
+        return (
+            path in self.BYPASS_PATHS
+            or path.startswith(self.BYPASS_PATH_PREFIXES)
+            or request.endpoint in self.BYPASS_ENDPOINTS
+        )
+
     def before_request(self):
         """
         Manage user REMOTE login
         Important things here happen in log_user function
         :return:
         """
-        user, is_different_user = self.log_user()
+        if self.is_bypassed():
+            _monitoring().LOGIN_REQUESTS.labels("bypassed").inc()
+            return
+        _monitoring().LOGIN_REQUESTS.labels("processed").inc()
+
+        start = time.perf_counter()
+        if self.STATELESS_AUTH:
+            user, is_different_user = self.log_user_stateless()
+        else:
+            user, is_different_user = self.log_user()
+        _monitoring().LOG_USER_SECONDS.labels(
+            g.pop("georchestra_login_path", "unknown")
+        ).observe(time.perf_counter() - start)
         # logger.debug(f"Current user object is of type {type(user)}")
         if not user:
             logger.debug("Logged in as anonymous user")
-        else:
-            logger.debug(f"User logged in as {user} ({user.username}), roles {user.roles}")
+        elif logger.isEnabledFor(logging.DEBUG):
+            # Reading user.roles may load them from the DB: only when actually logged
+            logger.debug(
+                "User logged in as %s (%s), roles %s", user, user.username, user.roles
+            )
+
+
+class RolesInvalidation(object):
+    """
+    Push-based invalidation of the user profiles and of the role catalog: a change
+    made in the geOrchestra console applies within seconds, whatever the
+    GEORCHESTRA_ROLES_CHECK_FREQUENCY.
+    Events are JSON objects like {"users": ["username", ...], "roles": true}:
+    - users: those users get their profile checked against the HTTP headers on their
+    next request
+    - roles: the role catalog gets reloaded
+    They can be published on the GEORCHESTRA_INVALIDATION_CHANNEL Redis channel, that
+    every worker listens to, or POSTed to the GEORCHESTRA_INVALIDATION_PATH endpoint,
+    that relays them on the channel. The endpoint is only enabled if
+    GEORCHESTRA_INVALIDATION_TOKEN is set, and expects it as a bearer token.
+    """
+
+    endpoint = "georchestra_invalidate"
+
+    def __init__(self, app, login: RemoteUserLogin):
+        self.login = login
+        self.token = app.config.get("GEORCHESTRA_INVALIDATION_TOKEN")
+        self.path = app.config.get(
+            "GEORCHESTRA_INVALIDATION_PATH", "/georchestra/invalidate"
+        )
+        self.channel = app.config.get(
+            "GEORCHESTRA_INVALIDATION_CHANNEL", "georchestra_invalidation"
+        )
+        self._redis = None
+        redis_url = app.config.get("GEORCHESTRA_REDIS_URL")
+        if redis_url:
+            try:
+                from redis import from_url as redis_from_url
+
+                timeout = float(
+                    app.config.get("GEORCHESTRA_ROLES_CHECK_STORE_TIMEOUT", 0.5)
+                )
+                # The health checks (PING) detect the dead subscriber connections
+                self._redis = redis_from_url(
+                    redis_url,
+                    socket_connect_timeout=timeout,
+                    socket_timeout=timeout,
+                    health_check_interval=30,
+                )
+            except ImportError:
+                logger.warning(
+                    "redis package not found. Invalidation events will only reach the "
+                    "worker that receives them"
+                )
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app) -> None:
+        if self._redis:
+            # Subscribe on the first request: threads don't survive a fork
+            app.before_request(self.start)
+        if not self.token:
+            logger.info(
+                "GEORCHESTRA_INVALIDATION_TOKEN is not set. The invalidation endpoint is disabled"
+            )
+            return
+        logger.info(f"Registering the invalidation endpoint on {self.path}")
+        app.add_url_rule(self.path, self.endpoint, self.post, methods=["POST"])
+        # Called by machines, with a token
+        csrf.exempt(self.post)
+
+    def start(self) -> None:
+        """
+        Start the thread listening to the invalidation channel, once per process
+        """
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            threading.Thread(
+                target=self._listen, name="georchestra-invalidation", daemon=True
+            ).start()
+            self._pid = os.getpid()
+
+    def _listen(self) -> None:
+        from redis.exceptions import RedisError
+
+        while True:
+            pubsub = None
+            try:
+                pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                logger.debug("Listening to the %s channel", self.channel)
+                while True:
+                    # Polled rather than listen(), which would hit the socket timeout
+                    message = pubsub.get_message(timeout=1)
+                    if message is None:
+                        continue
+                    try:
+                        self.apply(json.loads(message["data"]))
+                    except ValueError as e:
+                        logger.warning(f"Invalid invalidation event: {e}")
+                    except Exception:
+                        # Keep listening: the thread must not die for one event
+                        logger.exception("Could not apply the invalidation event")
+            except RedisError as e:
+                logger.warning(
+                    f"Lost the connection to the invalidation channel ({e}). Retrying in 5s"
+                )
+                time.sleep(5)
+            except Exception:
+                logger.exception(
+                    "Error while listening to the invalidation channel. Retrying in 5s"
+                )
+                time.sleep(5)
+            finally:
+                if pubsub is not None:
+                    try:
+                        pubsub.close()
+                    except RedisError:
+                        pass
+
+    @staticmethod
+    def validate(event: Any) -> dict:
+        """
+        :return: the event
+        :raise ValueError: if it is not a valid event
+        """
+        if not isinstance(event, dict):
+            raise ValueError("expected a JSON object")
+        users = event.get("users", [])
+        if not isinstance(users, list) or not all(
+            isinstance(username, str) for username in users
+        ):
+            raise ValueError("users: expected a list of usernames")
+        if not isinstance(event.get("roles", False), bool):
+            raise ValueError("roles: expected a boolean")
+        return event
+
+    def apply(self, event: dict) -> None:
+        """
+        Apply an invalidation event to this worker
+        :param event:
+        :return:
+        """
+        event = self.validate(event)
+        for username in event.get("users", []):
+            self.login.invalidate_user(username)
+        if event.get("roles"):
+            self.login.role_catalog.mark_stale()
+        logger.debug("Invalidation event applied: %s", event)
+
+    def publish(self, event: dict) -> bool:
+        """
+        Send the event to all the workers
+        :return: False if it could not be published
+        """
+        if not self._redis:
+            return False
+        from redis.exceptions import RedisError
+
+        try:
+            self._redis.publish(self.channel, json.dumps(event))
+        except RedisError as e:
+            logger.warning(f"Could not publish the invalidation event ({e})")
+            return False
+        return True
+
+    def post(self) -> tuple[Response, int]:
+        authorization = request.headers.get("Authorization", "")
+        if not hmac.compare_digest(authorization, f"Bearer {self.token}"):
+            return jsonify(message="Unauthorized"), 401
+        try:
+            event = self.validate(request.get_json(silent=True))
+        except ValueError as e:
+            return jsonify(message=str(e)), 400
+        if event.get("roles"):
+            # Also bumps the shared version, checked by the workers that would miss
+            # the event
+            self.login.role_catalog.invalidate()
+        published = self.publish(event)
+        if not published:
+            logger.warning(
+                "Invalidation event applied to this worker only (no redis channel)"
+            )
+            self.apply(event)
+        return jsonify(message="OK", published=published), 202
 
 
 class GeorchestraContextProcessor(object):
@@ -384,6 +1728,17 @@ class GeorchestraContextProcessor(object):
             "GEORCHESTRA_PROPERTIES_FILE_PATH", ""
         )
         self.noheader = app.config.get("GEORCHESTRA_NOHEADER", False)
+        # Minimum interval, in seconds, between two checks of the properties file
+        # modification time
+        self.check_interval = int(
+            app.config.get("GEORCHESTRA_PROPERTIES_CHECK_INTERVAL", 30)
+        )
+        # Cached result of the context processor and (mtime, size) of the properties
+        # file it was computed from
+        self._properties = None
+        self._file_signature = None
+        self._next_check = 0.0
+        self._lock = threading.Lock()
 
     def init_app(self) -> None:
         """
@@ -397,26 +1752,75 @@ class GeorchestraContextProcessor(object):
     def get_georchestra_properties(self):
         """
         Try to parse geOrchestra default.properties file if provided,
-        then override any value by uppercase params from the Superset config files
+        then override any value by uppercase params from the Superset config files.
+        The result is cached: the file is parsed again only if its modification time
+        or size changed, which is checked at most every `check_interval` seconds
         :return:
         """
-        if self.noheader:
-            return {
-                "georchestra": {
-                    "noheader": True,
-                }
-            }
+        start = time.perf_counter()
+        if self._properties is None or time.monotonic() >= self._next_check:
+            self._refresh()
+        _monitoring().CONTEXT_PROCESSOR_SECONDS.observe(time.perf_counter() - start)
+        return self._properties
+
+    def _get_file_signature(self) -> Optional[tuple[int, int]]:
+        if not self.properties_file_path:
+            return None
+        try:
+            stat = os.stat(self.properties_file_path)
+        except OSError as e:
+            logger.error(f"Could not read the geOrchestra properties file: {e}")
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _refresh(self) -> None:
+        """
+        (Re)compute the properties if the properties file changed since last time
+        :return:
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self._properties is not None and now < self._next_check:
+                # Another thread just did it
+                return
+            self._next_check = now + self.check_interval
+            signature = self._get_file_signature()
+            if self._properties is not None and signature == self._file_signature:
+                return
+
+            start = time.perf_counter()
+            if self.noheader:
+                properties = {"noheader": True}
+            else:
+                self._load_sections()
+                properties = self._build_properties()
+            self._properties = {"georchestra": properties}
+            self._file_signature = signature
+            _monitoring().PROPERTIES_RELOADS.inc()
+            logger.info(
+                f"geOrchestra properties loaded in {(time.perf_counter() - start) * 1000:.1f} ms"
+            )
 
-        self.sections = dict()
-        if self.properties_file_path:
-            parser = ConfigParser()
+    def _load_sections(self) -> None:
+        if not self.properties_file_path:
+            self.sections = dict()
+            return
+        parser = ConfigParser()
+        try:
             with open(self.properties_file_path) as lines:
                 # ConfigParser complains about missing sections in the file. This line
                 # does the trick:
                 lines = chain(("[section]",), lines)
                 parser.read_file(lines)
-                self.sections["default"] = parser["section"]
-        properties = {
+        except OSError as e:
+            logger.error(f"Could not read the geOrchestra properties file: {e}")
+            # Keep the previously loaded values, if any
+            self.sections = self.sections or dict()
+            return
+        self.sections = {"default": parser["section"]}
+
+    def _build_properties(self) -> dict:
+        return {
             "headerScript": self.get("GEORCHESTRA_HEADER_SCRIPT", "headerScript"),
             "headerHeight": self.get("GEORCHESTRA_HEADER_HEIGHT", "headerHeight"),
             "headerUrl": self.get("GEORCHESTRA_HEADER_URL", "headerUrl"),
@@ -432,7 +1836,6 @@ class GeorchestraContextProcessor(object):
             "logoUrl": self.get("GEORCHESTRA_LOGO_URL", "logoUrl"),
             "noheader": self.noheader,
         }
-        return {"georchestra": properties}
 
     def get(self, param_key, prop_key, section="default"):
         """
@@ -467,9 +1870,29 @@ class SupersetIndexView(IndexView):
 
 
 def app_init(app):
+    # The optional subsystems are only imported here, so that the login logic can be
+    # imported on its own
+    from GeorchestraCommands import georchestra_cli
+    from GeorchestraGeo import GeoExport, VectorTiles
+    from GeorchestraMonitoring import init_metrics, RequestProfiler
+
+    # Prometheus metrics endpoint. Not subject to the login logic
+    init_metrics(app)
+    # On-demand requests profiler
+    RequestProfiler(app).init_app(app)
+
     # Activate the geOrchestra REMOTE_USER logic
     logger.info("REMOTE_USER Registering RemoteUserLogin")
-    app.before_request(RemoteUserLogin(app).before_request)
+    remote_user_login = RemoteUserLogin(app)
+    app.before_request(remote_user_login.before_request)
+    # Push-based invalidation of the user profiles and roles
+    RolesInvalidation(app, remote_user_login).init_app(app)
+    # Streaming GeoJSON export of the datasets and charts, and vector tiles
+    GeoExport(app).init_app(app)
+    VectorTiles(app).init_app(app)
+
+    # `superset georchestra ...` commands
+    app.cli.add_command(georchestra_cli)
 
     # Set the home page
     app.config["FAB_INDEX_VIEW"] = (
@@ -508,7 +1931,125 @@ class NullEventLogger(AbstractEventLogger):
         pass
 
 
-# TODO: an event logger that will log interesting events to the analytics module
+# More event loggers (asynchronous, batched) are available in GeorchestraEventLoggers.py
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON document per record, for log collectors
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        document = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "process": record.process,
+            "thread": record.threadName,
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            document["exception"] = record.exc_text
+        if record.stack_info:
+            document["stack"] = self.formatStack(record.stack_info)
+        return json.dumps(document, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps only a fraction of the records below WARNING of some loggers (and of their
+    children), e.g. {"GeorchestraCustomizations": 0.01} keeps 1% of the debug and info
+    messages of the login logic
+    """
+
+    def __init__(self, rates: dict[str, float]):
+        super().__init__()
+        self.rates = rates
+        # logger name -> rate of the closest configured ancestor (1 if none)
+        self._resolved: dict[str, float] = {}
+
+    def get_rate(self, name: str) -> float:
+        rate = self._resolved.get(name)
+        if rate is None:
+            candidate = name
+            while candidate not in self.rates and "." in candidate:
+                candidate = candidate.rsplit(".", 1)[0]
+            rate = self.rates.get(candidate, 1.0)
+            self._resolved[name] = rate
+        return rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.get_rate(record.name)
+        return rate >= 1 or random.random() < rate
+
+
+class AsyncLogHandler(QueueHandler):
+    """
+    Hands the records over to a background thread, which writes them with the
+    `targets` handlers: logging never blocks the caller on I/O. When the queue is
+    full, records are dropped.
+    The message is rendered by the caller (its arguments may not be safe to read from
+    another thread, e.g. lazy-loaded DB relationships), the formatting is left to the
+    targets
+    """
+
+    def __init__(self, targets: list[logging.Handler], max_queue_size: int = 10000):
+        super().__init__(queue.Queue(max_queue_size))
+        self.targets = targets
+        self.dropped = 0
+        self._listener = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def start(self) -> None:
+        # Threads don't survive a fork: start one per process, on first use
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            # What was queued before the fork belongs to the parent process
+            self.queue = queue.Queue(self.queue.maxsize)
+            self._listener = QueueListener(
+                self.queue, *self.targets, respect_handler_level=True
+            )
+            self._listener.start()
+            self._pid = os.getpid()
+            atexit.register(self.stop)
+
+    def stop(self) -> None:
+        """
+        Write the queued records and stop the background thread
+        """
+        if self._pid != os.getpid():
+            return
+        self._pid = None
+        try:
+            self._listener.stop()
+        except queue.Full:
+            pass
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            # Don't keep the frames alive until the record is written
+            if not record.exc_text:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        self.start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
 
 
 class CustomLoggingConfigurator(LoggingConfigurator):
@@ -522,8 +2063,21 @@ class CustomLoggingConfigurator(LoggingConfigurator):
         # https://github.com/apache/superset/issues/29403#issuecomment-2532848376
         warnings.filterwarnings("ignore", message=".*werkzeug.local.LocalProxy.*")
 
-        # basicConfig() will set up a default StreamHandler on stderr
-        logging.basicConfig(format=app_config["LOG_FORMAT"])
+        # Records are written to stderr, by a background thread if
+        # GEORCHESTRA_LOG_ASYNC is set
+        handler = logging.StreamHandler()
+        if app_config.get("GEORCHESTRA_LOG_JSON", False):
+            handler.setFormatter(JsonFormatter())
+        else:
+            handler.setFormatter(logging.Formatter(app_config["LOG_FORMAT"]))
+        if app_config.get("GEORCHESTRA_LOG_ASYNC", False):
+            handler = AsyncLogHandler(
+                [handler], app_config.get("GEORCHESTRA_LOG_QUEUE_SIZE", 10000)
+            )
+        if app_config.get("GEORCHESTRA_LOG_SAMPLING"):
+            handler.addFilter(SamplingFilter(app_config["GEORCHESTRA_LOG_SAMPLING"]))
+        # Like before, does nothing if the root logger already has handlers
+        logging.basicConfig(handlers=[handler])
         logging.getLogger().setLevel(app_config["LOG_LEVEL"])
 
         logger.info(
@@ -0,0 +1,511 @@
+import atexit
+import bisect
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import urllib.request
+from datetime import datetime, timezone
+from typing import Any, Callable, Iterable, Optional
+
+import sqlalchemy as sa
+from flask import g, has_app_context
+
+from superset.utils.log import AbstractEventLogger
+
+logger = logging.getLogger(__name__)
+
+
+class EventSink(object):
+    """
+    Destination of the batches of records written by a BatchWriter
+    """
+
+    def prepare(self, columns: list[tuple[str, Any]]) -> None:
+        """
+        Called once, from the writer thread, before the first batch is written
+        :param columns: (name, SQLAlchemy type) of the records' fields
+        :return:
+        """
+        pass
+
+    def write(self, records: list[dict]) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class JsonLinesSink(EventSink):
+    """
+    Appends the records to a file, one JSON document per line. Each batch is written
+    with a single append, so several gunicorn workers can share the same file
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def write(self, records: list[dict]) -> None:
+        data = "".join(json.dumps(record, default=str) + "\n" for record in records)
+        data = data.encode("utf-8")
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            while data:
+                written = os.write(fd, data)
+                data = data[written:]
+        finally:
+            os.close(fd)
+
+
+class PostgresSink(EventSink):
+    """
+    Bulk-inserts the records into a table (created if it doesn't exist). Any database
+    supported by SQLAlchemy will do, but it is designed with PostgreSQL in mind: one
+    multi-values INSERT per batch
+    """
+
+    def __init__(self, sqlalchemy_uri: str, table_name: str, schema: Optional[str] = None):
+        self.sqlalchemy_uri = sqlalchemy_uri
+        self.table_name = table_name
+        self.schema = schema
+        self.table = None
+        self._engine = None
+
+    def prepare(self, columns: list[tuple[str, Any]]) -> None:
+        self._engine = sa.create_engine(self.sqlalchemy_uri, pool_pre_ping=True)
+        self.table = sa.Table(
+            self.table_name,
+            sa.MetaData(),
+            *[sa.Column(name, column_type) for name, column_type in columns],
+            schema=self.schema,
+        )
+        self.table.create(self._engine, checkfirst=True)
+
+    def write(self, records: list[dict]) -> None:
+        with self._engine.begin() as connection:
+            connection.execute(self.table.insert(), records)
+
+    def close(self) -> None:
+        if self._engine:
+            self._engine.dispose()
+
+
+class HttpPostSink(EventSink):
+    """
+    POSTs each batch as a JSON array to an HTTP endpoint
+    """
+
+    def __init__(
+        self, url: str, timeout: float = 10, headers: Optional[dict[str, str]] = None
+    ):
+        self.url = url
+        self.timeout = timeout
+        self.headers = {"Content-Type": "application/json", **(headers or {})}
+
+    def write(self, records: list[dict]) -> None:
+        data = json.dumps(records, default=str).encode("utf-8")
+        http_request = urllib.request.Request(
+            self.url, data=data, headers=self.headers, method="POST"
+        )
+        with urllib.request.urlopen(http_request, timeout=self.timeout) as response:
+            response.read()
+
+
+class BatchWriter(object):
+    """
+    Pushes records onto a bounded in-memory queue, and returns immediately. A
+    background thread drains the queue and writes the records in batches to a sink,
+    every `flush_interval` seconds or as soon as `batch_size` records are waiting.
+    When the queue is full, records are either dropped right away
+    (overflow_policy="drop") or the caller waits up to `block_timeout` seconds for
+    some room (overflow_policy="block").
+    Remaining records are flushed when the process exits.
+    """
+
+    overflow_policies = ("drop", "block")
+
+    def __init__(
+        self,
+        sink: EventSink,
+        columns: list[tuple[str, Any]],
+        batch_size: int = 500,
+        flush_interval: float = 5.0,
+        max_queue_size: int = 10000,
+        overflow_policy: str = "drop",
+        block_timeout: float = 1.0,
+        on_tick: Optional[Callable[[bool], Iterable[dict]]] = None,
+        name: str = "georchestra-batch-writer",
+    ):
+        """
+        :param on_tick: optional callable, called by the background thread on each
+        flush interval (and on close, with True as argument). The records it
+        returns are written with the next batch
+        """
+        if overflow_policy not in self.overflow_policies:
+            raise ValueError(
+                f"Invalid overflow_policy {overflow_policy}. Expected one of {self.overflow_policies}"
+            )
+        self.sink = sink
+        self.columns = columns
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue_size = max_queue_size
+        self.overflow_policy = overflow_policy
+        self.block_timeout = block_timeout
+        self.on_tick = on_tick
+        self.name = name
+        self.dropped = 0
+        self.written = 0
+        self._queue = None
+        self._thread = None
+        self._stopping = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        # Threads don't survive a fork: start one per process (e.g. gunicorn worker),
+        # on first use
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(maxsize=self.max_queue_size)
+            self._stopping = threading.Event()
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+            atexit.register(self.close)
+
+    def put(self, record: dict) -> bool:
+        """
+        :param record:
+        :return: False if the record had to be dropped
+        """
+        self.start()
+        try:
+            if self.overflow_policy == "block":
+                self._queue.put(record, timeout=self.block_timeout)
+            else:
+                self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped == 1 or self.dropped % 1000 == 0:
+                logger.warning(
+                    f"{self.name}: queue is full, {self.dropped} records dropped so far"
+                )
+            return False
+        return True
+
+    def close(self, timeout: float = 10) -> None:
+        """
+        Stop the background thread, after it wrote the pending records
+        :param timeout: max time to wait for it, in seconds
+        :return:
+        """
+        if self._pid != os.getpid() or self._stopping.is_set():
+            return
+        self._stopping.set()
+        self._thread.join(timeout)
+
+    def _run(self) -> None:
+        try:
+            self.sink.prepare(self.columns)
+        except Exception:
+            logger.exception(f"{self.name}: could not prepare the sink")
+        next_tick = time.monotonic() + self.flush_interval
+        while True:
+            stopping = self._stopping.is_set()
+            batch = self._drain(next_tick, stopping)
+            if time.monotonic() >= next_tick or stopping:
+                next_tick = time.monotonic() + self.flush_interval
+                if self.on_tick:
+                    try:
+                        batch.extend(self.on_tick(stopping))
+                    except Exception:
+                        logger.exception(f"{self.name}: error while collecting records")
+            if batch:
+                self._write(batch)
+            if stopping:
+                self.sink.close()
+                return
+
+    def _drain(self, deadline: float, stopping: bool) -> list[dict]:
+        """
+        Get records from the queue, until we have a full batch or the deadline is
+        reached. When stopping, just take everything that is left
+        """
+        batch = []
+        while stopping or len(batch) < self.batch_size:
+            try:
+                if stopping:
+                    batch.append(self._queue.get_nowait())
+                    continue
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                # Wake up regularly to notice a close() request
+                batch.append(self._queue.get(timeout=min(timeout, 1)))
+            except queue.Empty:
+                if stopping or self._stopping.is_set():
+                    break
+        return batch
+
+    def _write(self, batch: list[dict]) -> None:
+        for start in range(0, len(batch), self.batch_size):
+            chunk = batch[start : start + self.batch_size]
+            try:
+                self.sink.write(chunk)
+                self.written += len(chunk)
+            except Exception:
+                self.dropped += len(chunk)
+                logger.exception(
+                    f"{self.name}: could not write a batch of {len(chunk)} records"
+                )
+
+
+def _to_int(value: Any) -> Optional[int]:
+    try:
+        return int(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def get_current_user_info() -> tuple[Optional[str], list[str]]:
+    """
+    :return: username and role names of the user running the current request, if any
+    """
+    if not has_app_context():
+        return None, []
+    user = getattr(g, "user", None)
+    if user is None or not getattr(user, "is_authenticated", False):
+        return None, []
+    return user.username, sorted(role.name for role in user.roles)
+
+
+class AsyncEventLogger(AbstractEventLogger):
+    """
+    Event logger that doesn't slow the requests down: events are pushed onto a
+    bounded in-memory queue, written in batches to a sink (JsonLinesSink, PostgresSink,
+    HttpPostSink) by a background thread. See BatchWriter for the parameters
+    """
+
+    columns = [
+        ("ts", sa.DateTime(timezone=True)),
+        ("user_id", sa.Integer),
+        ("username", sa.String(255)),
+        ("roles", sa.JSON),
+        ("action", sa.String(512)),
+        ("event_name", sa.String(512)),
+        ("dashboard_id", sa.Integer),
+        ("slice_id", sa.Integer),
+        ("duration_ms", sa.Integer),
+        ("referrer", sa.String(1024)),
+        ("payload", sa.JSON),
+    ]
+
+    def __init__(
+        self,
+        sink: EventSink,
+        batch_size: int = 500,
+        flush_interval: float = 5.0,
+        max_queue_size: int = 10000,
+        overflow_policy: str = "drop",
+        block_timeout: float = 1.0,
+    ):
+        self.writer = BatchWriter(
+            sink,
+            self.columns,
+            batch_size=batch_size,
+            flush_interval=flush_interval,
+            max_queue_size=max_queue_size,
+            overflow_policy=overflow_policy,
+            block_timeout=block_timeout,
+            on_tick=self.on_tick,
+            name=self.__class__.__name__,
+        )
+
+    def on_tick(self, closing: bool) -> Iterable[dict]:
+        return []
+
+    def log(  # pylint: disable=too-many-arguments
+        self,
+        user_id: int | None,
+        action: str,
+        dashboard_id: int | None,
+        duration_ms: int | None,
+        slice_id: int | None,
+        referrer: str | None,
+        curated_payload: dict[str, Any] | None,
+        curated_form_data: dict[str, Any] | None,
+        *args: Any,
+        **kwargs: Any,
+    ) -> None:
+        for event in self.get_events(
+            user_id, action, dashboard_id, duration_ms, slice_id, referrer, **kwargs
+        ):
+            event["payload"] = curated_payload
+            self.writer.put(event)
+
+    @staticmethod
+    def get_events(
+        user_id: int | None,
+        action: str,
+        dashboard_id: int | None,
+        duration_ms: int | None,
+        slice_id: int | None,
+        referrer: str | None,
+        **kwargs: Any,
+    ) -> Iterable[dict]:
+        """
+        One event per record (the frontend sends its events in batches), like
+        Superset's DBEventLogger does
+        """
+        username, roles = get_current_user_info()
+        ts = datetime.now(timezone.utc)
+        for record in kwargs.get("records") or [{}]:
+            yield {
+                "ts": ts,
+                "user_id": user_id,
+                "username": username,
+                "roles": roles,
+                "action": action,
+                "event_name": record.get("event_name"),
+                "dashboard_id": _to_int(dashboard_id or record.get("dashboard_id")),
+                "slice_id": _to_int(slice_id or record.get("slice_id")),
+                "duration_ms": _to_int(
+                    duration_ms if duration_ms is not None else record.get("duration")
+                ),
+                "referrer": referrer[:1024] if referrer else referrer,
+            }
+
+
+class RollupEventLogger(AsyncEventLogger):
+    """
+    Instead of one record per event, keeps in-memory counters and duration histograms
+    per time bucket and per combination of `dimensions`. Only the aggregated rows
+    are written, once their time bucket is over.
+    Each worker process writes its own rows: sum them (grouping by bucket_start and
+    dimensions) to get the totals.
+    """
+
+    # Values allowed in `dimensions`. `role` is the comma-separated list of the
+    # user's roles
+    available_dimensions = ("action", "event_name", "dashboard_id", "slice_id", "role")
+    dimension_types = {
+        "action": sa.String(512),
+        "event_name": sa.String(512),
+        "dashboard_id": sa.Integer,
+        "slice_id": sa.Integer,
+        "role": sa.String(1024),
+    }
+    # Upper bounds of the duration histogram buckets, in ms. The last histogram value
+    # counts the durations above the last bound
+    duration_bounds = (50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+    def __init__(
+        self,
+        sink: EventSink,
+        dimensions: Iterable[str] = available_dimensions,
+        bucket_seconds: int = 300,
+        max_keys: int = 100000,
+        flush_interval: float = 60.0,
+        **kwargs: Any,
+    ):
+        """
+        :param dimensions: what the events are aggregated by, among available_dimensions
+        :param bucket_seconds: size of the time buckets
+        :param max_keys: max number of rows kept in memory. Beyond it, events are dropped
+        :param flush_interval: how often (seconds) the finished buckets are written
+        :param kwargs: see AsyncEventLogger
+        """
+        self.dimensions = tuple(dimensions)
+        unknown = set(self.dimensions) - set(self.available_dimensions)
+        if unknown:
+            raise ValueError(
+                f"Invalid rollup dimensions {unknown}. Expected some of {self.available_dimensions}"
+            )
+        self.bucket_seconds = bucket_seconds
+        self.max_keys = max_keys
+        self.dropped = 0
+        # (bucket start, *dimensions values) -> [count, duration count, duration sum,
+        # duration max, histogram]
+        self._rollups: dict[tuple, list] = {}
+        self._rollups_lock = threading.Lock()
+        self.columns = (
+            [("bucket_start", sa.DateTime(timezone=True)), ("bucket_seconds", sa.Integer)]
+            + [(dimension, self.dimension_types[dimension]) for dimension in self.dimensions]
+            + [
+                ("count", sa.Integer),
+                ("duration_count", sa.Integer),
+                ("duration_sum_ms", sa.BigInteger),
+                ("duration_max_ms", sa.Integer),
+                ("duration_histogram", sa.JSON),
+            ]
+        )
+        super().__init__(sink, flush_interval=flush_interval, **kwargs)
+
+    def log(  # pylint: disable=too-many-arguments
+        self,
+        user_id: int | None,
+        action: str,
+        dashboard_id: int | None,
+        duration_ms: int | None,
+        slice_id: int | None,
+        referrer: str | None,
+        curated_payload: dict[str, Any] | None,
+        curated_form_data: dict[str, Any] | None,
+        *args: Any,
+        **kwargs: Any,
+    ) -> None:
+        self.writer.start()
+        bucket = int(time.time() // self.bucket_seconds * self.bucket_seconds)
+        for event in self.get_events(
+            user_id, action, dashboard_id, duration_ms, slice_id, referrer, **kwargs
+        ):
+            event["role"] = ",".join(event["roles"]) or None
+            key = (bucket,) + tuple(event[dimension] for dimension in self.dimensions)
+            duration = event["duration_ms"]
+            with self._rollups_lock:
+                rollup = self._rollups.get(key)
+                if rollup is None:
+                    if len(self._rollups) >= self.max_keys:
+                        self.dropped += 1
+                        if self.dropped == 1 or self.dropped % 1000 == 0:
+                            logger.warning(
+                                f"Too many rollup rows, {self.dropped} events dropped so far"
+                            )
+                        continue
+                    rollup = [0, 0, 0, 0, [0] * (len(self.duration_bounds) + 1)]
+                    self._rollups[key] = rollup
+                rollup[0] += 1
+                if duration is not None:
+                    rollup[1] += 1
+                    rollup[2] += duration
+                    rollup[3] = max(rollup[3], duration)
+                    rollup[4][bisect.bisect_left(self.duration_bounds, duration)] += 1
+
+    def on_tick(self, closing: bool) -> Iterable[dict]:
+        """
+        Hand the finished buckets (all of them when closing) over to the writer
+        """
+        current_bucket = time.time() // self.bucket_seconds * self.bucket_seconds
+        with self._rollups_lock:
+            keys = [
+                key for key in self._rollups if closing or key[0] < current_bucket
+            ]
+            rollups = [(key, self._rollups.pop(key)) for key in keys]
+        for key, (count, duration_count, duration_sum, duration_max, histogram) in rollups:
+            row = {
+                "bucket_start": datetime.fromtimestamp(key[0], timezone.utc),
+                "bucket_seconds": self.bucket_seconds,
+                "count": count,
+                "duration_count": duration_count,
+                "duration_sum_ms": duration_sum,
+                "duration_max_ms": duration_max if duration_count else None,
+                "duration_histogram": histogram,
+            }
+            row.update(zip(self.dimensions, key[1:]))
+            yield row
@@ -0,0 +1,776 @@
+import hashlib
+import json
+import logging
+from contextlib import closing, contextmanager
+from typing import Any, Iterator, NamedTuple, Optional, TYPE_CHECKING
+
+from flask import abort, current_app, request, Response, stream_with_context
+from flask_caching import Cache
+from sqlalchemy.engine import Connection, CursorResult
+from sqlalchemy.exc import DBAPIError
+from werkzeug.utils import secure_filename
+
+from superset import db, security_manager as sm
+from superset.exceptions import QueryObjectValidationError, SupersetSecurityException
+from superset.utils.core import QuerySource
+from superset.utils.json import pessimistic_json_iso_dttm_ser
+
+if TYPE_CHECKING:
+    # Those read the app config when imported: they get imported when needed, as this
+    # module is imported with the config, outside of any app context
+    from superset.connectors.sqla.models import SqlaTable
+    from superset.models.slice import Slice
+
+try:
+    from shapely import wkb, wkt
+    from shapely.geometry import mapping
+except ImportError:
+    wkb = wkt = mapping = None
+
+try:
+    import mapbox_vector_tile
+except ImportError:
+    mapbox_vector_tile = None
+
+logger = logging.getLogger(__name__)
+
+# Label of the geometry column in the export queries
+GEOMETRY_LABEL = "__georchestra_geometry"
+# Filters of a chart kept in its export
+CHART_QUERY_KEYS = ("granularity", "from_dttm", "to_dttm", "filter")
+
+
+class GeometrySpec(NamedTuple):
+    # Column holding the geometry (PostGIS geometry or geography, GeoJSON text...)
+    column: Optional[str] = None
+    # Or longitude and latitude columns
+    lon: Optional[str] = None
+    lat: Optional[str] = None
+
+
+def postgis_geojson(expression: str) -> str:
+    """
+    :return: SQL converting a PostGIS geometry (or geography) to GeoJSON in WGS84.
+    Geometries without SRID are left as they are
+    """
+    geometry = f"CAST({expression} AS geometry)"
+    return (
+        f"ST_AsGeoJSON(CASE WHEN ST_SRID({geometry}) IN (0, 4326) THEN {geometry} "
+        f"ELSE ST_Transform({geometry}, 4326) END)"
+    )
+
+
+def parse_geometry(value: Any) -> Optional[dict]:
+    """
+    Geometry read from a database other than PostGIS: GeoJSON (text or already
+    decoded), or WKT / WKB if shapely is installed
+    :return: the GeoJSON geometry, None if it can't be read
+    """
+    if value is None or isinstance(value, dict):
+        return value
+    if isinstance(value, memoryview):
+        value = bytes(value)
+    try:
+        if isinstance(value, str) and value.lstrip().startswith("{"):
+            return json.loads(value)
+        if mapping is not None:
+            if isinstance(value, bytes):
+                return mapping(wkb.loads(value))
+            if isinstance(value, str):
+                return mapping(wkt.loads(value))
+    except Exception:
+        pass
+    logger.debug("Unreadable geometry %r", value)
+    return None
+
+
+@contextmanager
+def connect(dataset: "SqlaTable") -> Iterator[Connection]:
+    """
+    :return: a connection to the dataset's database, with its catalog and schema set
+    """
+    database = dataset.database
+    with database.get_sqla_engine(
+        catalog=dataset.catalog, schema=dataset.schema, source=QuerySource.CHART
+    ) as engine, closing(engine.connect()) as connection:
+        for prequery in database.db_engine_spec.get_prequeries(
+            catalog=dataset.catalog, schema=dataset.schema
+        ):
+            connection.exec_driver_sql(prequery)
+        yield connection
+
+
+def execute(
+    connection: Connection, dataset: "SqlaTable", sql: str, module: str, **options
+) -> CursorResult:
+    """
+    Run SQL generated by Superset (no bound parameters), through QUERY_LOGGER
+    """
+    query_logger = current_app.config.get("QUERY_LOGGER")
+    if query_logger:
+        query_logger(connection.engine.url, sql, dataset.schema, module, sm)
+    return connection.execution_options(no_parameters=True, **options).exec_driver_sql(
+        sql
+    )
+
+
+def get_properties(
+    dataset: "SqlaTable", geometry: GeometrySpec, allowed: Optional[set[str]] = None
+) -> list[str]:
+    """
+    :param allowed: the columns that may be exported. Default: all the columns
+    :return: the columns to export as the features properties: the `columns` query
+    parameter, or all the (allowed) columns of the dataset but the geometry ones
+    """
+    columns = [
+        column.column_name
+        for column in dataset.columns
+        if allowed is None or column.column_name in allowed
+    ]
+    unknown = {geometry.column, geometry.lon, geometry.lat} - set(columns) - {None}
+    if request.args.get("columns"):
+        properties = [
+            column.strip() for column in request.args["columns"].split(",")
+        ]
+        unknown |= set(properties) - set(columns)
+    else:
+        properties = [
+            column
+            for column in columns
+            if column not in (geometry.column, geometry.lon, geometry.lat)
+        ]
+    if unknown:
+        abort(400, f"Unknown columns {', '.join(sorted(unknown))}")
+    return properties
+
+
+def check_dataset_access(pk: int) -> "SqlaTable":
+    """
+    :return: the dataset, if the current user can access it (404 or 403 otherwise)
+    """
+    from superset.connectors.sqla.models import SqlaTable
+
+    dataset = db.session.query(SqlaTable).filter_by(id=pk).one_or_none()
+    if dataset is None:
+        abort(404)
+    try:
+        sm.raise_for_access(datasource=dataset)
+    except SupersetSecurityException:
+        abort(403)
+    return dataset
+
+
+class GeoExport(object):
+    """
+    Streaming GeoJSON export of the datasets and of the geospatial (deck.gl) charts.
+
+    GET {GEORCHESTRA_GEO_EXPORT_PATH}/dataset/<id>.<format>
+    GET {GEORCHESTRA_GEO_EXPORT_PATH}/chart/<id>.<format>
+
+    with format `geojson` (a FeatureCollection) or `ndjson` (one Feature per line).
+    Query parameters:
+    - geometry: column holding the geometries, or lon and lat: columns of the
+      coordinates. Default, for the charts: the ones of the chart
+    - columns: comma-separated columns to export as the features properties. Default:
+      all the columns of the dataset. For the charts of a dataset the user can't
+      access (e.g. through a dashboard), only the columns used by the chart
+    - limit: max number of features
+
+    The SQL is built by Superset, so the export is subject to the same permissions
+    and row level security filters as the charts of the calling user. The rows are
+    read through a server-side cursor, GEORCHESTRA_GEO_EXPORT_CHUNK_SIZE at a time, and
+    written as they come: the memory used doesn't depend on the size of the export.
+    """
+
+    formats = {
+        "geojson": ("application/geo+json", ".geojson"),
+        "ndjson": ("application/x-ndjson", ".geojsonl"),
+    }
+
+    def __init__(self, app):
+        config = app.config
+        self.path = config.get("GEORCHESTRA_GEO_EXPORT_PATH", "/georchestra/export")
+        self.chunk_size = config.get("GEORCHESTRA_GEO_EXPORT_CHUNK_SIZE", 1000)
+        # None: no limit
+        self.row_limit = config.get("GEORCHESTRA_GEO_EXPORT_ROW_LIMIT")
+
+    def init_app(self, app) -> None:
+        if not self.path:
+            return
+        app.add_url_rule(
+            f"{self.path}/dataset/<int:pk>.<file_format>",
+            "georchestra_export_dataset",
+            self.export_dataset,
+        )
+        app.add_url_rule(
+            f"{self.path}/chart/<int:pk>.<file_format>",
+            "georchestra_export_chart",
+            self.export_chart,
+        )
+
+    # Views
+
+    def export_dataset(self, pk: int, file_format: str) -> Response:
+        self._check_format(file_format)
+        dataset = check_dataset_access(pk)
+        geometry = self._get_geometry_spec(GeometrySpec())
+        return self._export(dataset, geometry, {}, dataset.table_name, file_format)
+
+    def export_chart(self, pk: int, file_format: str) -> Response:
+        from superset.connectors.sqla.models import SqlaTable
+        from superset.models.slice import Slice
+
+        self._check_format(file_format)
+        chart = db.session.query(Slice).filter_by(id=pk).one_or_none()
+        if chart is None or not isinstance(chart.datasource, SqlaTable):
+            abort(404)
+        try:
+            sm.raise_for_access(chart=chart)
+        except SupersetSecurityException:
+            abort(403)
+        form_data = chart.form_data
+        geometry = self._get_geometry_spec(self.get_chart_geometry(form_data))
+        try:
+            query = self.get_chart_filters(chart)
+        except QueryObjectValidationError as e:
+            abort(400, str(e))
+        # Having access to the chart (e.g. through a dashboard) doesn't give access to
+        # the other columns of its dataset
+        allowed = (
+            None
+            if sm.can_access_datasource(chart.datasource)
+            else self.get_chart_columns(form_data)
+        )
+        return self._export(
+            chart.datasource, geometry, query, chart.slice_name, file_format, allowed
+        )
+
+    # Query
+
+    @staticmethod
+    def get_chart_geometry(form_data: dict) -> GeometrySpec:
+        """
+        :return: the geometry columns of a deck.gl chart
+        """
+        spatial = form_data.get("spatial") or {}
+        if spatial.get("type") == "latlong":
+            return GeometrySpec(lon=spatial.get("lonCol"), lat=spatial.get("latCol"))
+        if isinstance(form_data.get("geojson"), str):
+            return GeometrySpec(column=form_data["geojson"])
+        return GeometrySpec()
+
+    @staticmethod
+    def get_chart_columns(form_data: dict) -> set[str]:
+        """
+        :return: the dataset columns a chart shows (physical or calculated columns,
+        not adhoc SQL)
+        """
+        columns = set()
+        for key in ("all_columns", "columns", "groupby", "js_columns"):
+            values = form_data.get(key) or []
+            columns.update(value for value in values if isinstance(value, str))
+        for key in ("geojson", "line_column", "dimension"):
+            if isinstance(form_data.get(key), str):
+                columns.add(form_data[key])
+        # deck.gl spatial controls (spatial, start_spatial, end_spatial...)
+        for value in form_data.values():
+            if isinstance(value, dict) and "type" in value:
+                for key in ("lonCol", "latCol", "lonlatCol", "geohashCol"):
+                    if isinstance(value.get(key), str):
+                        columns.add(value[key])
+        return columns
+
+    @staticmethod
+    def get_chart_filters(chart: "Slice") -> dict:
+        """
+        :return: the filters (time range, adhoc filters, custom WHERE) of the chart,
+        as query object items
+        """
+        from superset.views.utils import get_viz
+        from superset.viz import viz_types
+
+        if chart.viz_type in viz_types:
+            # Legacy charts, like the deck.gl ones
+            query_obj = get_viz(
+                chart.form_data, chart.datasource_type, chart.datasource_id
+            ).query_obj()
+        else:
+            query_context = chart.get_query_context()
+            if query_context is None or not query_context.queries:
+                return {}
+            query_obj = query_context.queries[0].to_dict()
+        query = {key: query_obj.get(key) for key in CHART_QUERY_KEYS}
+        # No GROUP BY in the export: HAVING doesn't apply
+        query["extras"] = {"where": (query_obj.get("extras") or {}).get("where", "")}
+        return query
+
+    @staticmethod
+    def _check_format(file_format: str) -> None:
+        if file_format not in GeoExport.formats:
+            abort(404)
+
+    @staticmethod
+    def _get_geometry_spec(default: GeometrySpec) -> GeometrySpec:
+        geometry = GeometrySpec(
+            column=request.args.get("geometry"),
+            lon=request.args.get("lon"),
+            lat=request.args.get("lat"),
+        )
+        if geometry == GeometrySpec():
+            geometry = default
+        if not geometry.column and not (geometry.lon and geometry.lat):
+            abort(400, "Missing geometry column, or lon and lat columns")
+        return geometry
+
+    def _get_limit(self) -> Optional[int]:
+        try:
+            limit = int(request.args.get("limit") or 0) or None
+        except ValueError:
+            abort(400, "Invalid limit")
+        if self.row_limit and (limit is None or limit > self.row_limit):
+            return self.row_limit
+        return limit
+
+    def get_query(
+        self, dataset: "SqlaTable", geometry: GeometrySpec, properties: list[str], query: dict
+    ) -> str:
+        """
+        :return: the SQL of the export, with the dataset's row level security filters
+        """
+        columns_by_name = {column.column_name: column for column in dataset.columns}
+        geometry_columns = [geometry.lon, geometry.lat] if geometry.lon else []
+        if geometry.column:
+            column = columns_by_name[geometry.column]
+            if dataset.database.backend == "postgresql":
+                expression = column.expression or dataset.database.quote_identifier(
+                    column.column_name
+                )
+                geometry_columns = [
+                    {
+                        "label": GEOMETRY_LABEL,
+                        "sqlExpression": postgis_geojson(expression),
+                        "expressionType": "SQL",
+                    }
+                ]
+            else:
+                geometry_columns = [geometry.column]
+        query_obj = {
+            **query,
+            "columns": properties + geometry_columns,
+            "metrics": None,
+            "groupby": None,
+            "is_timeseries": False,
+            "row_limit": self._get_limit(),
+            "orderby": [],
+        }
+        return dataset.get_query_str_extended(query_obj).sql
+
+    def _export(
+        self,
+        dataset: "SqlaTable",
+        geometry: GeometrySpec,
+        query: dict,
+        name: str,
+        file_format: str,
+        allowed: Optional[set[str]] = None,
+    ) -> Response:
+        properties = get_properties(dataset, geometry, allowed)
+        try:
+            sql = self.get_query(dataset, geometry, properties, query)
+        except QueryObjectValidationError as e:
+            abort(400, str(e))
+        features = self.get_features(dataset, sql, geometry, properties)
+        mimetype, extension = self.formats[file_format]
+        encode = self.encode_ndjson if file_format == "ndjson" else self.encode_geojson
+        filename = secure_filename(name or "") or "export"
+        return Response(
+            stream_with_context(encode(features)),
+            mimetype=mimetype,
+            headers={
+                "Content-Disposition": f'attachment; filename="{filename}{extension}"',
+                # Don't let the reverse proxies buffer the whole export
+                "X-Accel-Buffering": "no",
+            },
+        )
+
+    # Reading and writing
+
+    def get_features(
+        self, dataset: "SqlaTable", sql: str, geometry: GeometrySpec, properties: list[str]
+    ) -> Iterator[list[str]]:
+        """
+        :return: the features, encoded in JSON, chunk_size at a time
+        """
+        # ST_AsGeoJSON already gives JSON, written as it is
+        geojson_sql = bool(geometry.column) and dataset.database.backend == "postgresql"
+        with connect(dataset) as connection:
+            result = execute(
+                connection,
+                dataset,
+                sql,
+                __name__,
+                stream_results=True,
+                max_row_buffer=self.chunk_size,
+            )
+            count = len(properties)
+            for rows in result.partitions(self.chunk_size):
+                chunk = []
+                for row in rows:
+                    values = dict(zip(properties, row[:count]))
+                    if geojson_sql:
+                        feature_geometry = row[count] or "null"
+                    else:
+                        if geometry.column:
+                            feature_geometry = parse_geometry(row[count])
+                        elif row[count] is None or row[count + 1] is None:
+                            feature_geometry = None
+                        else:
+                            feature_geometry = {
+                                "type": "Point",
+                                "coordinates": [float(row[count]), float(row[count + 1])],
+                            }
+                        feature_geometry = json.dumps(feature_geometry)
+                    chunk.append(
+                        '{"type":"Feature","geometry":'
+                        + feature_geometry
+                        + ',"properties":'
+                        + json.dumps(
+                            values,
+                            default=pessimistic_json_iso_dttm_ser,
+                            separators=(",", ":"),
+                        )
+                        + "}"
+                    )
+                yield chunk
+
+    @staticmethod
+    def encode_geojson(features: Iterator[list[str]]) -> Iterator[str]:
+        yield '{"type":"FeatureCollection","features":[\n'
+        separator = ""
+        try:
+            for chunk in features:
+                yield separator + ",\n".join(chunk)
+                separator = ",\n"
+        except Exception:
+            # Too late for an error response: the unterminated FeatureCollection
+            # tells the client that the export is incomplete
+            logger.exception("GeoJSON export failed")
+            return
+        yield "\n]}\n"
+
+    @staticmethod
+    def encode_ndjson(features: Iterator[list[str]]) -> Iterator[str]:
+        try:
+            for chunk in features:
+                yield "\n".join(chunk) + "\n"
+        except Exception:
+            logger.exception("GeoJSON export failed")
+
+
+# Half the width of the Web Mercator (EPSG:3857) world, in meters
+MERCATOR_HALF_WIDTH = 20037508.342789244
+
+
+def tile_bounds(z: int, x: int, y: int) -> tuple[float, float, float, float]:
+    """
+    :return: the bounds of a XYZ tile in EPSG:3857 (min x, min y, max x, max y)
+    """
+    size = 2 * MERCATOR_HALF_WIDTH / 2**z
+    min_x = -MERCATOR_HALF_WIDTH + x * size
+    max_y = MERCATOR_HALF_WIDTH - y * size
+    return min_x, max_y - size, min_x + size, max_y
+
+
+def sql_string(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
+class VectorTiles(object):
+    """
+    Mapbox Vector Tiles of the geometries of a dataset:
+
+    GET {GEORCHESTRA_TILES_PATH}/dataset/<id>/<z>/<x>/<y>.mvt?geometry=<column>
+
+    with the optional `columns` query parameter, like the GeoJSON export. The tiles
+    hold the features intersecting the tile (plus a buffer), simplified according to
+    the zoom level, at most GEORCHESTRA_TILES_MAX_FEATURES of them.
+
+    On PostGIS (3.0 or later), the tiles are made by the database (ST_AsMVT). On
+    SQLite, the geometries are read with SpatiaLite and the tiles encoded here, which
+    requires the mapbox-vector-tile and shapely packages. The geometries must have an
+    SRID.
+
+    Like the GeoJSON export, the SQL is built by Superset, with the permissions and row
+    level security filters of the calling user. The tiles are cached in
+    GEORCHESTRA_TILES_CACHE_CONFIG, under keys depending on the dataset's last change
+    and on the row level security filters that apply.
+    """
+
+    mimetype = "application/vnd.mapbox-vector-tile"
+    # Tiles coordinates space and buffer around the tiles, in tiles units
+    extent = 4096
+    buffer = 64
+    # Module name given to QUERY_LOGGER
+    query_source = f"{__name__}.tiles"
+
+    def __init__(self, app):
+        config = app.config
+        self.path = config.get("GEORCHESTRA_TILES_PATH", "/georchestra/tiles")
+        self.max_zoom = config.get("GEORCHESTRA_TILES_MAX_ZOOM", 22)
+        self.max_features = config.get("GEORCHESTRA_TILES_MAX_FEATURES", 50000)
+        # Simplification tolerance, in tiles units
+        self.simplify = config.get("GEORCHESTRA_TILES_SIMPLIFY", 1)
+        self.max_age = config.get("GEORCHESTRA_TILES_MAX_AGE", 3600)
+        self.cache_timeout = config.get("GEORCHESTRA_TILES_CACHE_TIMEOUT")
+        self.spatialite_extension = config.get(
+            "GEORCHESTRA_TILES_SPATIALITE_EXTENSION", "mod_spatialite"
+        )
+        self.cache_config = config.get("GEORCHESTRA_TILES_CACHE_CONFIG")
+        self.cache = None
+        # (dataset id, changed_on, geometry column) -> SRID of the geometries, and
+        # whether they are geography values (PostGIS)
+        self._srids: dict = {}
+
+    def init_app(self, app) -> None:
+        if not self.path:
+            return
+        if self.cache_config:
+            self.cache = Cache(app, config=self.cache_config)
+        app.add_url_rule(
+            f"{self.path}/dataset/<int:pk>/<int:z>/<int:x>/<int:y>.mvt",
+            "georchestra_tile",
+            self.get_tile,
+        )
+
+    def get_tile(self, pk: int, z: int, x: int, y: int) -> Response:
+        if not 0 <= z <= self.max_zoom or not (0 <= x < 2**z and 0 <= y < 2**z):
+            abort(404)
+        dataset = check_dataset_access(pk)
+        column = request.args.get("geometry")
+        if not column:
+            abort(400, "Missing geometry column")
+        backend = dataset.database.backend
+        if backend not in ("postgresql", "sqlite"):
+            abort(400, f"Vector tiles are not supported on {backend} databases")
+        geometry = GeometrySpec(column=column)
+        properties = get_properties(dataset, geometry)
+        key = self.get_cache_key(dataset, column, properties, z, x, y)
+        tile = self.cache.get(key) if self.cache is not None else None
+        if tile is None:
+            try:
+                tile = self.make_tile(dataset, column, properties, z, x, y)
+            except QueryObjectValidationError as e:
+                abort(400, str(e))
+            if self.cache is not None:
+                self.cache.set(key, tile, timeout=self.cache_timeout)
+        return Response(
+            tile,
+            mimetype=self.mimetype,
+            headers={"Cache-Control": f"private, max-age={self.max_age}"},
+        )
+
+    @staticmethod
+    def get_cache_key(
+        dataset: "SqlaTable", column: str, properties: list[str], z: int, x: int, y: int
+    ) -> str:
+        """
+        :return: the cache key of a tile. Changes with the dataset, and is shared by
+        the users having the same row level security filters
+        """
+        key = json.dumps(
+            [
+                dataset.id,
+                dataset.changed_on.isoformat() if dataset.changed_on else None,
+                column,
+                properties,
+                sm.get_rls_cache_key(dataset),
+            ]
+        )
+        return f"{hashlib.sha1(key.encode()).hexdigest()}/{z}/{x}/{y}"
+
+    # Queries
+
+    def _get_query(
+        self, dataset: "SqlaTable", column: str, properties: list[str], expression: str
+    ) -> str:
+        """
+        :return: the SQL of the dataset's features, the geometry (`expression` of the
+        geometry column) labelled GEOMETRY_LABEL
+        """
+        query_obj = {
+            "columns": [
+                *properties,
+                {
+                    "label": GEOMETRY_LABEL,
+                    "sqlExpression": expression,
+                    "expressionType": "SQL",
+                },
+            ],
+            "metrics": None,
+            "groupby": None,
+            "is_timeseries": False,
+            "row_limit": None,
+            "orderby": [],
+            "extras": {},
+            "filter": [],
+        }
+        # No LIMIT in there, for the database to apply the bounding box filter of the
+        # outer query on the table (and its spatial index)
+        return dataset.get_query_str_extended(query_obj).sql.rstrip().rstrip(";")
+
+    def get_srid(
+        self, connection: Connection, dataset: "SqlaTable", column: str
+    ) -> tuple[Optional[int], bool]:
+        """
+        :return: the SRID of the geometries of the column, None if there are none, and
+        whether the column is a PostGIS geography
+        """
+        key = (dataset.id, dataset.changed_on, column)
+        if key not in self._srids:
+            if len(self._srids) >= 1000:
+                # Outdated entries, after datasets changes
+                self._srids.clear()
+            geometry = f"features.{GEOMETRY_LABEL}"
+            if dataset.database.backend == "postgresql":
+                select = (
+                    f"ST_SRID({geometry}), "
+                    f"pg_typeof({geometry}) = 'geography'::regtype"
+                )
+            else:
+                select = f"SRID({geometry}), 0"
+            sql = (
+                f"SELECT {select} FROM "
+                f"({self._get_query(dataset, column, [], self._quote(dataset, column))}) "
+                f"AS features WHERE {geometry} IS NOT NULL LIMIT 1"
+            )
+            row = execute(connection, dataset, sql, self.query_source).first()
+            self._srids[key] = (row[0], bool(row[1])) if row else (None, False)
+        return self._srids[key]
+
+    @staticmethod
+    def _quote(dataset: "SqlaTable", column: str) -> str:
+        table_column = next(c for c in dataset.columns if c.column_name == column)
+        return table_column.expression or dataset.database.quote_identifier(column)
+
+    def make_tile(
+        self, dataset: "SqlaTable", column: str, properties: list[str], z: int, x: int, y: int
+    ) -> bytes:
+        with connect(dataset) as connection:
+            if dataset.database.backend == "sqlite":
+                self._load_spatialite(connection)
+            srid, geography = self.get_srid(connection, dataset, column)
+            if srid is None:
+                return b""
+            if dataset.database.backend == "postgresql":
+                return self._make_postgis_tile(
+                    connection, dataset, column, properties, srid, geography, z, x, y
+                )
+            return self._make_spatialite_tile(
+                connection, dataset, column, properties, srid, z, x, y
+            )
+
+    def _tolerances(self, z: int) -> tuple[float, float]:
+        """
+        :return: the simplification tolerance and the buffer, in EPSG:3857 units
+        """
+        tile_units = 2 * MERCATOR_HALF_WIDTH / 2**z / self.extent
+        return self.simplify * tile_units, self.buffer * tile_units
+
+    def _make_postgis_tile(
+        self,
+        connection: Connection,
+        dataset: "SqlaTable",
+        column: str,
+        properties: list[str],
+        srid: int,
+        geography: bool,
+        z: int,
+        x: int,
+        y: int,
+    ) -> bytes:
+        quote = dataset.database.quote_identifier
+        tolerance, buffer = self._tolerances(z)
+        envelope = f"ST_TileEnvelope({z}, {x}, {y})"
+        bbox = f"ST_Transform(ST_Expand({envelope}, {buffer}), {srid})"
+        if geography:
+            # Compared as geography, so that the column's spatial index is used
+            bbox = f"CAST({bbox} AS geography)"
+        geometry = f"features.{GEOMETRY_LABEL}"
+        columns = "".join(f"features.{quote(name)}, " for name in properties)
+        sql = (
+            f"SELECT ST_AsMVT(tile, {sql_string(dataset.table_name)}, {self.extent}, "
+            f"'{GEOMETRY_LABEL}') FROM ("
+            f"SELECT {columns}ST_AsMVTGeom(ST_Simplify(ST_Transform(CAST({geometry} AS "
+            f"geometry), 3857), {tolerance}, true), {envelope}, {self.extent}, "
+            f"{self.buffer}, true) AS {GEOMETRY_LABEL} "
+            f"FROM ({self._get_query(dataset, column, properties, self._quote(dataset, column))}) "
+            f"AS features "
+            f"WHERE {geometry} && {bbox} "
+            f"LIMIT {int(self.max_features)}"
+            f") AS tile WHERE tile.{GEOMETRY_LABEL} IS NOT NULL"
+        )
+        tile = execute(connection, dataset, sql, self.query_source).scalar()
+        return bytes(tile) if tile is not None else b""
+
+    def _load_spatialite(self, connection: Connection) -> None:
+        try:
+            connection.exec_driver_sql("SELECT spatialite_version()")
+        except DBAPIError:
+            dbapi_connection = connection.connection
+            dbapi_connection.enable_load_extension(True)
+            dbapi_connection.load_extension(self.spatialite_extension)
+
+    def _make_spatialite_tile(
+        self,
+        connection: Connection,
+        dataset: "SqlaTable",
+        column: str,
+        properties: list[str],
+        srid: int,
+        z: int,
+        x: int,
+        y: int,
+    ) -> bytes:
+        if mapbox_vector_tile is None or wkb is None:
+            abort(501, "Vector tiles on SQLite require mapbox-vector-tile and shapely")
+        quote = dataset.database.quote_identifier
+        tolerance, buffer = self._tolerances(z)
+        min_x, min_y, max_x, max_y = tile_bounds(z, x, y)
+        geometry = f"features.{GEOMETRY_LABEL}"
+        columns = "".join(f"features.{quote(name)}, " for name in properties)
+        sql = (
+            f"SELECT {columns}AsBinary(Transform({geometry}, 3857)) "
+            f"FROM ({self._get_query(dataset, column, properties, self._quote(dataset, column))}) "
+            f"AS features "
+            f"WHERE MbrIntersects({geometry}, Transform(BuildMbr({min_x - buffer}, "
+            f"{min_y - buffer}, {max_x + buffer}, {max_y + buffer}, 3857), {srid})) "
+            f"LIMIT {int(self.max_features)}"
+        )
+        count = len(properties)
+        features = []
+        for row in execute(connection, dataset, sql, self.query_source):
+            if row[count] is None:
+                continue
+            features.append(
+                {
+                    "geometry": wkb.loads(bytes(row[count])).simplify(tolerance),
+                    "properties": {
+                        name: (
+                            value
+                            if isinstance(value, (bool, int, float, str))
+                            else str(value)
+                        )
+                        for name, value in zip(properties, row[:count])
+                        if value is not None
+                    },
+                }
+            )
+        if not features:
+            return b""
+        return mapbox_vector_tile.encode(
+            [{"name": dataset.table_name, "features": features}],
+            default_options={
+                "quantize_bounds": (min_x, min_y, max_x, max_y),
+                "extents": self.extent,
+            },
+        )
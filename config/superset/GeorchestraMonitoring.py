@@ -0,0 +1,602 @@
+import cProfile
+import hashlib
+import hmac
+import logging
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from functools import lru_cache
+from typing import Any, Callable, Iterable, Optional
+
+import sqlalchemy as sa
+from flask import (
+    abort,
+    has_request_context,
+    request,
+    Response,
+    send_from_directory,
+    url_for,
+)
+from markupsafe import escape
+from sqlalchemy.dialects import plugins as sqla_plugins
+from sqlalchemy.engine import CreateEnginePlugin, make_url
+
+from GeorchestraEventLoggers import BatchWriter, EventSink, get_current_user_info
+
+logger = logging.getLogger(__name__)
+
+try:
+    import prometheus_client
+    from prometheus_client import multiprocess
+except ImportError:
+    prometheus_client = None
+
+
+class NoopMetric(object):
+    """
+    Stands for the prometheus metrics when prometheus_client is not installed
+    """
+
+    def labels(self, *args, **kwargs) -> "NoopMetric":
+        return self
+
+    def inc(self, amount: float = 1) -> None:
+        pass
+
+    def observe(self, amount: float) -> None:
+        pass
+
+    def set(self, value: float) -> None:
+        pass
+
+
+def _metric(metric_type: str, name: str, documentation: str, labelnames=(), **kwargs):
+    if prometheus_client is None:
+        return NoopMetric()
+    return getattr(prometheus_client, metric_type)(
+        name, documentation, labelnames, **kwargs
+    )
+
+
+# Latency buckets for the per-request hooks, in seconds
+FAST_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+
+LOGIN_REQUESTS = _metric(
+    "Counter",
+    "georchestra_login_requests",
+    "Requests seen by the login hook. result: bypassed or processed",
+    ["result"],
+)
+LOG_USER_SECONDS = _metric(
+    "Histogram",
+    "georchestra_log_user_seconds",
+    "Time spent in RemoteUserLogin.log_user. path: fast_path, recheck, new_login, "
+    "user_creation or anonymous",
+    ["path"],
+    buckets=FAST_BUCKETS,
+)
+ROLES_CHECKS = _metric(
+    "Counter",
+    "georchestra_roles_checks",
+    "Roles checks for already logged-in users. result: hit (no check needed) or miss "
+    "(profile compared to the HTTP headers)",
+    ["result"],
+)
+PROFILE_UPDATES = _metric(
+    "Counter",
+    "georchestra_profile_updates",
+    "User profiles updated in the DB because the HTTP headers changed",
+)
+PROFILE_WRITES = _metric(
+    "Counter",
+    "georchestra_profile_writes",
+    "User profiles persisted by the write-behind writer. result: written, retried or "
+    "failed (given up)",
+    ["result"],
+)
+CONTEXT_PROCESSOR_SECONDS = _metric(
+    "Histogram",
+    "georchestra_context_processor_seconds",
+    "Time spent in the geOrchestra properties context processor",
+    buckets=FAST_BUCKETS,
+)
+PROPERTIES_RELOADS = _metric(
+    "Counter",
+    "georchestra_properties_reloads",
+    "Number of times the geOrchestra properties file was (re)loaded",
+)
+# Buckets for the queries on the analytics databases
+QUERY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+QUERY_ROWS_BUCKETS = (0, 1, 10, 100, 1000, 5000, 10000, 100000, 1000000)
+
+QUERY_SECONDS = _metric(
+    "Histogram",
+    "georchestra_query_seconds",
+    "Time spent running (and fetching) the queries on the analytics databases. "
+    "database, dataset, role, source: see QueryInstrumentation",
+    ["database", "dataset", "role", "source"],
+    buckets=QUERY_BUCKETS,
+)
+QUERY_ROWS = _metric(
+    "Histogram",
+    "georchestra_query_rows",
+    "Rows returned by the queries on the analytics databases, when the database "
+    "driver tells. database, dataset, role, source: see QueryInstrumentation",
+    ["database", "dataset", "role", "source"],
+    buckets=QUERY_ROWS_BUCKETS,
+)
+CACHE_REQUESTS = _metric(
+    "Counter",
+    "georchestra_cache_requests",
+    "Cache lookups. cache: key prefix of the cache, tier: local (in-process) or redis, "
+    "result: hit or miss",
+    ["cache", "tier", "result"],
+)
+CACHE_COMPRESSION_RATIO = _metric(
+    "Histogram",
+    "georchestra_cache_compression_ratio",
+    "Original size / compressed size of the compressed cache entries. cache: key "
+    "prefix of the cache",
+    ["cache"],
+    buckets=(1.25, 1.5, 2, 3, 5, 10, 20, 50),
+)
+CACHE_REJECTED = _metric(
+    "Counter",
+    "georchestra_cache_rejected",
+    "Values not stored in the cache because bigger than CACHE_MAX_VALUE_SIZE. cache: "
+    "key prefix of the cache",
+    ["cache"],
+)
+CACHE_BYTES = _metric(
+    "Gauge",
+    "georchestra_cache_bytes",
+    "Memory used in Redis by the cache entries. cache: key prefix of the cache",
+    ["cache"],
+    multiprocess_mode="livemax",
+)
+
+# Functions called before each scrape, to update the metrics that are computed on
+# demand
+_collect_callbacks: list[Callable[[], None]] = []
+
+
+def register_collect_callback(callback: Callable[[], None]) -> None:
+    _collect_callbacks.append(callback)
+
+
+class MetricsView(object):
+    """
+    Serves the metrics in the Prometheus text format. When running several processes
+    (gunicorn workers), set the PROMETHEUS_MULTIPROC_DIR environment variable to a
+    directory shared by all of them, so that they get aggregated
+    """
+
+    def __init__(self, app):
+        self.token = app.config.get("GEORCHESTRA_METRICS_TOKEN")
+
+    def __call__(self) -> Response:
+        authorization = request.headers.get("Authorization", "")
+        if not hmac.compare_digest(authorization, f"Bearer {self.token}"):
+            return Response("Unauthorized", status=401)
+        for callback in _collect_callbacks:
+            try:
+                callback()
+            except Exception:
+                logger.exception("Error while collecting the metrics")
+        if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+            registry = prometheus_client.CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        else:
+            registry = prometheus_client.REGISTRY
+        return Response(
+            prometheus_client.generate_latest(registry),
+            mimetype=prometheus_client.CONTENT_TYPE_LATEST,
+        )
+
+
+def init_metrics(app) -> None:
+    """
+    Register the /metrics endpoint (endpoint name: georchestra_metrics). It skips the
+    login logic: it requires GEORCHESTRA_METRICS_TOKEN
+    """
+    if not app.config.get("GEORCHESTRA_METRICS_ENABLED", True):
+        return
+    if not app.config.get("GEORCHESTRA_METRICS_TOKEN"):
+        logger.warning(
+            "GEORCHESTRA_METRICS_TOKEN is not set. The /metrics endpoint is disabled"
+        )
+        return
+    if prometheus_client is None:
+        logger.warning(
+            "prometheus_client package not found. The /metrics endpoint is disabled"
+        )
+        return
+    path = app.config.get("GEORCHESTRA_METRICS_PATH", "/metrics")
+    logger.info(f"Registering the metrics endpoint on {path}")
+    app.add_url_rule(path, "georchestra_metrics", MetricsView(app))
+
+
+def _slug(value: str, max_length: int = 80) -> str:
+    return re.sub(r"[^A-Za-z0-9.-]+", "-", value).strip("-")[:max_length] or "-"
+
+
+class RequestProfiler(object):
+    """
+    Records a cProfile profile of whole requests (at the WSGI level, so including the
+    before_request hooks), when they carry GEORCHESTRA_PROFILER_TOKEN in the
+    X-Georchestra-Profile header, or at random for a GEORCHESTRA_PROFILER_SAMPLING_RATE
+    fraction of them.
+    Profiles are written to a directory that keeps the `max_files` most recent ones,
+    named <time>_<duration>_<user>_<path>.prof. Admins list and download them on
+    GEORCHESTRA_PROFILER_PATH (endpoint names: georchestra_profiles and
+    georchestra_profile)
+    """
+
+    trigger_header = "HTTP_X_GEORCHESTRA_PROFILE"
+
+    def __init__(self, app):
+        config = app.config
+        self.token = config.get("GEORCHESTRA_PROFILER_TOKEN")
+        self.sampling_rate = float(config.get("GEORCHESTRA_PROFILER_SAMPLING_RATE", 0))
+        # Sampled requests faster than that (seconds) are not kept
+        self.min_duration = float(config.get("GEORCHESTRA_PROFILER_MIN_DURATION", 0))
+        self.directory = config.get("GEORCHESTRA_PROFILER_DIR") or os.path.join(
+            tempfile.gettempdir(), "georchestra_profiles"
+        )
+        self.max_files = int(config.get("GEORCHESTRA_PROFILER_MAX_FILES", 100))
+        self.path = config.get("GEORCHESTRA_PROFILER_PATH", "/georchestra/profiles")
+        self.wsgi_app = None
+        # Only one profiler can be active at a time in a process (Python >= 3.12):
+        # concurrent requests are not profiled
+        self._lock = threading.Lock()
+
+    def init_app(self, app) -> None:
+        if not self.token and not self.sampling_rate:
+            return
+        logger.info(f"Requests profiler enabled. Profiles are written to {self.directory}")
+        os.makedirs(self.directory, exist_ok=True)
+        self.wsgi_app = app.wsgi_app
+        app.wsgi_app = self
+        app.add_url_rule(self.path, "georchestra_profiles", self.list_profiles)
+        app.add_url_rule(
+            f"{self.path}/<name>", "georchestra_profile", self.download_profile
+        )
+
+    def _get_trigger(self, environ) -> Optional[str]:
+        """
+        :return: why the request gets profiled (header or sampling), None if it doesn't
+        """
+        trigger = environ.get(self.trigger_header)
+        if (
+            trigger
+            and self.token
+            and hmac.compare_digest(trigger.encode(), self.token.encode())
+        ):
+            return "header"
+        if self.sampling_rate and random.random() < self.sampling_rate:
+            return "sampling"
+        return None
+
+    def __call__(self, environ, start_response):
+        trigger = self._get_trigger(environ)
+        if trigger is None or not self._lock.acquire(blocking=False):
+            return self.wsgi_app(environ, start_response)
+        try:
+            profile = cProfile.Profile()
+            start = time.perf_counter()
+            profile.enable()
+            try:
+                # Streamed responses are only profiled up to their first chunk
+                return self.wsgi_app(environ, start_response)
+            finally:
+                profile.disable()
+                duration = time.perf_counter() - start
+                if trigger == "header" or duration >= self.min_duration:
+                    self._save(profile, environ, duration)
+        finally:
+            self._lock.release()
+
+    def _save(self, profile: cProfile.Profile, environ, duration: float) -> None:
+        name = "_".join(
+            [
+                datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S.%f"),
+                f"{round(duration * 1000)}ms",
+                _slug(environ.get("HTTP_SEC_USERNAME") or "anonymous"),
+                _slug(environ.get("PATH_INFO", "")),
+            ]
+        )
+        path = os.path.join(self.directory, f"{name}.prof")
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            temporary_path = f"{path}.{os.getpid()}.tmp"
+            profile.dump_stats(temporary_path)
+            os.replace(temporary_path, path)
+            self._prune()
+        except OSError as e:
+            logger.warning(f"Could not write the request profile {path}: {e}")
+
+    def _list(self) -> list[str]:
+        """
+        :return: the profiles names, most recent first
+        """
+        return sorted(
+            (name for name in os.listdir(self.directory) if name.endswith(".prof")),
+            reverse=True,
+        )
+
+    def _prune(self) -> None:
+        for name in self._list()[self.max_files :]:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                # Pruned by another process
+                pass
+
+    @staticmethod
+    def _check_admin() -> None:
+        from superset import security_manager
+
+        if not security_manager.is_admin():
+            abort(403)
+
+    def list_profiles(self) -> Response:
+        self._check_admin()
+        rows = []
+        for name in self._list():
+            fields = (name[: -len(".prof")].split("_", 3) + ["", "", ""])[:4]
+            cells = "".join(f"<td>{escape(field)}</td>" for field in fields)
+            link = url_for("georchestra_profile", name=name)
+            rows.append(f'<tr>{cells}<td><a href="{escape(link)}">download</a></td></tr>')
+        return Response(
+            "<!DOCTYPE html><html><head><title>Request profiles</title></head><body>"
+            "<h1>Request profiles</h1>"
+            "<p>Open them with <code>python -m pstats &lt;file&gt;</code> or snakeviz</p>"
+            "<table><tr><th>Time (UTC)</th><th>Duration</th><th>User</th><th>Path</th>"
+            "<th></th></tr>" + "".join(rows) + "</table></body></html>",
+            mimetype="text/html",
+        )
+
+    def download_profile(self, name: str) -> Response:
+        self._check_admin()
+        if not name.endswith(".prof"):
+            abort(404)
+        return send_from_directory(self.directory, name, as_attachment=True)
+
+
+@lru_cache(maxsize=256)
+def _database_label(database_uri: str) -> str:
+    """
+    :return: backend, host and database name of a SQLAlchemy URI, without credentials
+    """
+    url = make_url(database_uri)
+    return f"{url.get_backend_name()}://{url.host or ''}/{url.database or ''}"
+
+
+class QueryTimingPlugin(CreateEnginePlugin):
+    """
+    SQLAlchemy plugin, added by QueryInstrumentation.mutate_connection to the engines
+    of the analytics databases only: follows their connections in and out of the pool
+    """
+
+    def __init__(self, url, kwargs):
+        super().__init__(url, kwargs)
+        self.instrumentation = kwargs.pop(QueryInstrumentation.engine_argument)
+
+    def engine_created(self, engine) -> None:
+        sa.event.listen(engine.pool, "checkout", self.instrumentation.on_checkout)
+        sa.event.listen(engine.pool, "checkin", self.instrumentation.on_checkin)
+
+
+class QueryInstrumentation(object):
+    """
+    Times the queries that Superset runs on the analytics databases (charts, SQL Lab),
+    into the georchestra_query_seconds and georchestra_query_rows metrics. Queries
+    slower than `slow_query_threshold` seconds are also written to `slow_query_sink`,
+    asynchronously (see BatchWriter).
+
+    Superset calls QUERY_LOGGER right before running a query, on the connection
+    checked out of the database's pool. The query is considered done when that
+    connection gets back to the pool, or when the next query starts on it (SQL Lab
+    runs the statements one after another). So wire both hooks in the config:
+        QUERY_LOGGER = query_instrumentation.log_query
+        DB_CONNECTION_MUTATOR = query_instrumentation.mutate_connection
+
+    Metrics labels, among available_labels (the others are left empty):
+    - database: backend, host and database name
+    - dataset: type_id of the dataset, for the chart data API requests. Reads the
+      request body: only parsed when this label is enabled, or for the slow queries
+    - role: roles of the user, comma-separated. Can make many time series
+    - source: chart (chart data, samples...), sqllab, export (GeoJSON export) or tiles
+    """
+
+    available_labels = ("database", "dataset", "role", "source")
+    plugin_name = "georchestra_query_timing"
+    # create_engine argument passing the instance to the plugin
+    engine_argument = "georchestra_query_instrumentation"
+    sources = {
+        "superset.sql_lab": "sqllab",
+        "superset.models.core": "chart",
+        "GeorchestraGeo": "export",
+        "GeorchestraGeo.tiles": "tiles",
+    }
+    slow_query_columns = [
+        ("ts", sa.DateTime(timezone=True)),
+        ("duration_ms", sa.Integer),
+        ("rows", sa.Integer),
+        ("database", sa.String(255)),
+        ("schema", sa.String(255)),
+        ("dataset", sa.String(255)),
+        ("source", sa.String(255)),
+        ("username", sa.String(255)),
+        ("roles", sa.JSON),
+        ("sql_hash", sa.String(64)),
+        ("sql", sa.Text),
+    ]
+
+    def __init__(
+        self,
+        labels: Iterable[str] = ("database", "source"),
+        slow_query_threshold: Optional[float] = None,
+        slow_query_sink: Optional[EventSink] = None,
+        log_sql: bool = False,
+        **kwargs: Any,
+    ):
+        """
+        :param labels: metrics labels to fill, among available_labels
+        :param slow_query_threshold: in seconds. None to disable the slow query log
+        :param slow_query_sink: where the slow queries get written
+        :param log_sql: write the SQL of the slow queries, not only its hash
+        :param kwargs: BatchWriter parameters (batch_size, flush_interval...)
+        """
+        self.labels = set(labels)
+        unknown = self.labels - set(self.available_labels)
+        if unknown:
+            raise ValueError(
+                f"Invalid query metrics labels {unknown}. Expected some of {self.available_labels}"
+            )
+        self.slow_query_threshold = slow_query_threshold
+        self.log_sql = log_sql
+        self.slow_queries = None
+        if slow_query_sink is not None and slow_query_threshold is not None:
+            self.slow_queries = BatchWriter(
+                slow_query_sink,
+                self.slow_query_columns,
+                name="georchestra-slow-queries",
+                **kwargs,
+            )
+        self._local = threading.local()
+
+    # Superset hooks
+
+    def mutate_connection(
+        self, sqlalchemy_url, params, username, security_manager, source
+    ):
+        """
+        DB_CONNECTION_MUTATOR: adds the QueryTimingPlugin to the engine
+        """
+        params["plugins"] = [*params.get("plugins", []), self.plugin_name]
+        params[self.engine_argument] = self
+        return sqlalchemy_url, params
+
+    def log_query(
+        self,
+        database_uri,
+        sql: str,
+        schema: Optional[str],
+        module: str,
+        security_manager,
+        log_params: Optional[dict] = None,
+    ) -> None:
+        """
+        QUERY_LOGGER: called right before a query runs
+        """
+        local = self._local
+        connection = getattr(local, "connection", None)
+        if connection is None:
+            # Not on an instrumented connection (DB_CONNECTION_MUTATOR not set?)
+            local.query = None
+            return
+        if getattr(local, "query", None) is not None:
+            # Next statement on the same connection
+            self._done(local.query, connection)
+        local.query = {
+            "start": time.perf_counter(),
+            "sql": sql,
+            "schema": schema,
+            "database": _database_label(str(database_uri)),
+            "dataset": self._get_dataset() if "dataset" in self.labels else None,
+            "source": self.sources.get(module, module),
+        }
+
+    # Pool events
+
+    def on_checkout(
+        self, dbapi_connection, connection_record, connection_proxy
+    ) -> None:
+        self._local.connection = connection_record
+        self._local.query = None
+        original_cursor = connection_proxy.cursor
+
+        def cursor(*args, **kwargs):
+            # Keep the last cursor, to read its rowcount
+            connection_record.info["georchestra_cursor"] = original_cursor(
+                *args, **kwargs
+            )
+            return connection_record.info["georchestra_cursor"]
+
+        try:
+            connection_proxy.cursor = cursor
+        except AttributeError:
+            # Can't be overridden with this SQLAlchemy version: no row counts
+            pass
+
+    def on_checkin(self, dbapi_connection, connection_record) -> None:
+        local = self._local
+        if getattr(local, "connection", None) is not connection_record:
+            return
+        if local.query is not None:
+            self._done(local.query, connection_record)
+        local.connection = local.query = None
+        connection_record.info.pop("georchestra_cursor", None)
+
+    # Recording
+
+    @staticmethod
+    def _get_dataset() -> Optional[str]:
+        """
+        :return: the dataset of the chart data request being served, if any
+        """
+        if not has_request_context() or not request.is_json:
+            return None
+        body = request.get_json(silent=True)
+        datasource = body.get("datasource") if isinstance(body, dict) else None
+        if isinstance(datasource, dict) and datasource.get("id") is not None:
+            return f"{datasource.get('type') or 'table'}_{datasource['id']}"
+        return None
+
+    def _done(self, query: dict, connection_record) -> None:
+        duration = time.perf_counter() - query["start"]
+        cursor = connection_record.info.get("georchestra_cursor")
+        rows = getattr(cursor, "rowcount", -1)
+        rows = rows if isinstance(rows, int) and rows >= 0 else None
+        slow = self.slow_queries is not None and duration >= self.slow_query_threshold
+        username, roles = None, []
+        if slow or "role" in self.labels:
+            username, roles = get_current_user_info()
+        if slow and "dataset" not in self.labels:
+            query["dataset"] = self._get_dataset()
+        query["role"] = ",".join(roles)
+        labels = [
+            (query[label] or "") if label in self.labels else ""
+            for label in self.available_labels
+        ]
+        QUERY_SECONDS.labels(*labels).observe(duration)
+        if rows is not None:
+            QUERY_ROWS.labels(*labels).observe(rows)
+        if slow:
+            self.slow_queries.put(
+                {
+                    "ts": datetime.now(timezone.utc),
+                    "duration_ms": round(duration * 1000),
+                    "rows": rows,
+                    "database": query["database"],
+                    "schema": query["schema"],
+                    "dataset": query["dataset"],
+                    "source": query["source"],
+                    "username": username,
+                    "roles": roles,
+                    "sql_hash": hashlib.sha256(
+                        query["sql"].encode("utf-8")
+                    ).hexdigest(),
+                    "sql": query["sql"] if self.log_sql else None,
+                }
+            )
+
+
+sqla_plugins.register(
+    QueryInstrumentation.plugin_name, __name__, QueryTimingPlugin.__name__
+)
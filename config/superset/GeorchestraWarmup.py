@@ -0,0 +1,362 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from itertools import chain, zip_longest
+from typing import Iterator, NamedTuple, Optional
+
+import sqlalchemy as sa
+from flask import current_app
+
+from superset import db, security_manager as sm
+from superset.commands.chart.warm_up_cache import ChartWarmUpCacheCommand
+from superset.exceptions import SupersetSecurityException
+from superset.extensions import celery_app
+from superset.models.core import Log
+from superset.models.dashboard import Dashboard
+from superset.utils.core import override_user
+from superset.utils.log import DBEventLogger, get_event_logger_from_cfg_value
+
+from GeorchestraEventLoggers import (
+    AsyncEventLogger,
+    JsonLinesSink,
+    PostgresSink,
+    RollupEventLogger,
+)
+
+logger = logging.getLogger(__name__)
+
+
+# Action logged when the frontend loads a dashboard (on each display, including the
+# navigation within the app), with its dashboard_id. The other events carrying a
+# dashboard_id (chart data, frontend events...) are not views
+DASHBOARD_VIEW_ACTIONS = ("DashboardRestApi.get",)
+# Records are appended in batches, by several workers, and the rollup rows once their
+# bucket is over: the file is read a bit past `since` before stopping
+FILE_WRITE_DELAY = timedelta(hours=1)
+
+
+def _parse_timestamp(value) -> Optional[datetime]:
+    try:
+        timestamp = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return timestamp
+
+
+def _read_lines_backwards(path: str, block_size: int = 65536) -> Iterator[bytes]:
+    """
+    :return: the lines of the file, last one first
+    """
+    with open(path, "rb") as lines:
+        position = lines.seek(0, os.SEEK_END)
+        rest = b""
+        while position > 0:
+            size = min(block_size, position)
+            position -= size
+            lines.seek(position)
+            block = (lines.read(size) + rest).split(b"\n")
+            rest = block.pop(0)
+            yield from reversed(block)
+        yield rest
+
+
+def _count_views_in_file(
+    path: str, since: datetime, time_field: str, count_field: Optional[str]
+) -> Counter:
+    """
+    Reads the file from its end, and stops at the records older than `since`
+    """
+    views = Counter()
+    stop = since - FILE_WRITE_DELAY
+    for line in _read_lines_backwards(path):
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        timestamp = _parse_timestamp(record.get(time_field))
+        if timestamp is None:
+            continue
+        if timestamp < since:
+            if timestamp < stop:
+                break
+            continue
+        if (
+            record.get("dashboard_id") is None
+            or record.get("action") not in DASHBOARD_VIEW_ACTIONS
+        ):
+            continue
+        count = (record.get(count_field) or 0) if count_field else 1
+        views[record["dashboard_id"]] += count
+    return views
+
+
+def _count_views_in_table(
+    sink: PostgresSink,
+    since: datetime,
+    time_field: str,
+    count_field: Optional[str],
+    top_n: int,
+) -> Counter:
+    engine = sa.create_engine(sink.sqlalchemy_uri)
+    try:
+        table = sa.Table(
+            sink.table_name, sa.MetaData(), autoload_with=engine, schema=sink.schema
+        )
+        views = sa.func.sum(table.c[count_field]) if count_field else sa.func.count()
+        query = (
+            sa.select(table.c.dashboard_id, views)
+            .where(
+                table.c.dashboard_id.isnot(None),
+                table.c.action.in_(DASHBOARD_VIEW_ACTIONS),
+                table.c[time_field] >= since,
+            )
+            .group_by(table.c.dashboard_id)
+            .order_by(views.desc())
+            .limit(top_n)
+        )
+        with engine.connect() as connection:
+            return Counter(dict(connection.execute(query).all()))
+    finally:
+        engine.dispose()
+
+
+def get_most_viewed_dashboards(event_logger, top_n: int, since: datetime) -> list[int]:
+    """
+    Dashboards with the most views (see DASHBOARD_VIEW_ACTIONS) since `since`,
+    according to the event logger's records: Superset's logs table (DBEventLogger), or
+    the file or table written by AsyncEventLogger/RollupEventLogger (JsonLinesSink,
+    PostgresSink)
+    :return: IDs of the `top_n` most viewed dashboards, most viewed first
+    """
+    if isinstance(event_logger, DBEventLogger):
+        views = sa.func.count(Log.id)
+        rows = (
+            db.session.query(Log.dashboard_id, views)
+            .filter(
+                Log.dashboard_id.isnot(None),
+                Log.action.in_(DASHBOARD_VIEW_ACTIONS),
+                Log.dttm >= since.replace(tzinfo=None),
+            )
+            .group_by(Log.dashboard_id)
+            .order_by(views.desc())
+            .limit(top_n)
+        )
+        return [dashboard_id for dashboard_id, _ in rows]
+    if not isinstance(event_logger, AsyncEventLogger):
+        logger.warning(
+            f"Can't get the most viewed dashboards from {event_logger.__class__.__name__}"
+        )
+        return []
+    if isinstance(event_logger, RollupEventLogger):
+        if not {"action", "dashboard_id"}.issubset(event_logger.dimensions):
+            logger.warning(
+                "Can't get the most viewed dashboards: action and dashboard_id must be "
+                "among the rollup dimensions"
+            )
+            return []
+        time_field, count_field = "bucket_start", "count"
+    else:
+        time_field, count_field = "ts", None
+    sink = event_logger.writer.sink
+    if isinstance(sink, JsonLinesSink):
+        views = _count_views_in_file(sink.path, since, time_field, count_field)
+    elif isinstance(sink, PostgresSink):
+        views = _count_views_in_table(sink, since, time_field, count_field, top_n)
+    else:
+        logger.warning(
+            f"Can't get the most viewed dashboards from a {sink.__class__.__name__}"
+        )
+        return []
+    return [int(dashboard_id) for dashboard_id, _ in views.most_common(top_n)]
+
+
+class RateLimiter(object):
+    """
+    Spaces out the calls made for a same key, to at most `rate` per second
+    """
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate else 0
+        # key -> time of the next allowed call
+        self._next: dict = {}
+        self._lock = threading.Lock()
+
+    def wait(self, key) -> None:
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next.get(key, now))
+            self._next[key] = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+class WarmUpJob(NamedTuple):
+    # None for the anonymous user (Public role)
+    username: Optional[str]
+    chart_id: int
+    dashboard_id: int
+    database_id: Optional[int]
+
+
+class CacheWarmer(object):
+    """
+    Fills the chart data cache (DATA_CACHE_CONFIG) with the charts of the dashboards
+    visible to the Public role, and of the most viewed dashboards, so that the first
+    visitors after a Redis flush or a deployment don't pay for the cold queries.
+
+    Charts are computed in-process, like `superset warm-up-cache` does, as the user
+    who will read them (anonymous or GEORCHESTRA_WARMUP_USERNAME), for the cache keys
+    to match. `concurrency` threads share the work, starting at most `database_rate`
+    queries per second on each database.
+    """
+
+    def __init__(self, app):
+        config = app.config
+        self.app = app
+        self.public_dashboards = config.get("GEORCHESTRA_WARMUP_PUBLIC_DASHBOARDS", True)
+        self.top_n = config.get("GEORCHESTRA_WARMUP_TOP_N", 10)
+        self.top_n_days = config.get("GEORCHESTRA_WARMUP_TOP_N_DAYS", 7)
+        self.username = config.get("GEORCHESTRA_WARMUP_USERNAME")
+        self.concurrency = config.get("GEORCHESTRA_WARMUP_CONCURRENCY", 4)
+        self.rate_limiter = RateLimiter(config.get("GEORCHESTRA_WARMUP_DATABASE_RATE", 1))
+
+    @staticmethod
+    def get_user(username: Optional[str]):
+        if username is None:
+            return sm.lm.anonymous_user()
+        user = sm.find_user(username=username)
+        if user is None:
+            raise ValueError(f"Cache warm-up user {username} not found")
+        return user
+
+    @staticmethod
+    def _can_access(dashboard: Dashboard) -> bool:
+        try:
+            sm.raise_for_access(dashboard=dashboard)
+        except SupersetSecurityException:
+            return False
+        return True
+
+    def get_dashboards(self) -> list[tuple[Optional[str], Dashboard]]:
+        """
+        :return: the dashboards to warm up, with the user to compute them as
+        """
+        dashboards = []
+        if self.public_dashboards:
+            with override_user(self.get_user(None)):
+                dashboards.extend(
+                    (None, dashboard)
+                    for dashboard in db.session.query(Dashboard).filter(
+                        Dashboard.published.is_(True)
+                    )
+                    if self._can_access(dashboard)
+                )
+        if self.top_n:
+            event_logger = get_event_logger_from_cfg_value(
+                self.app.config.get("EVENT_LOGGER", DBEventLogger())
+            )
+            since = datetime.now(timezone.utc) - timedelta(days=self.top_n_days)
+            ids = get_most_viewed_dashboards(event_logger, self.top_n, since)
+            if ids:
+                with override_user(self.get_user(self.username)):
+                    dashboards.extend(
+                        (self.username, dashboard)
+                        for dashboard in db.session.query(Dashboard).filter(
+                            Dashboard.id.in_(ids)
+                        )
+                        if self._can_access(dashboard)
+                    )
+        return dashboards
+
+    def get_jobs(
+        self, dashboards: list[tuple[Optional[str], Dashboard]]
+    ) -> list[WarmUpJob]:
+        jobs = {}
+        for username, dashboard in dashboards:
+            for chart in dashboard.slices:
+                # Except for some legacy charts, the cache key doesn't depend on the
+                # dashboard: compute each chart once
+                if chart.datasource is None or (username, chart.id) in jobs:
+                    continue
+                jobs[(username, chart.id)] = WarmUpJob(
+                    username,
+                    chart.id,
+                    dashboard.id,
+                    getattr(chart.datasource, "database_id", None),
+                )
+        # Interleave the databases, so that the rate limit of one of them doesn't
+        # hold all the threads
+        by_database = {}
+        for job in jobs.values():
+            by_database.setdefault(job.database_id, []).append(job)
+        return [
+            job
+            for job in chain.from_iterable(zip_longest(*by_database.values()))
+            if job is not None
+        ]
+
+    def warm_up(self, job: WarmUpJob) -> Optional[str]:
+        """
+        :return: the error, if the chart could not be computed
+        """
+        self.rate_limiter.wait(job.database_id)
+        with self.app.app_context():
+            try:
+                with override_user(self.get_user(job.username)):
+                    result = ChartWarmUpCacheCommand(
+                        job.chart_id, job.dashboard_id, None
+                    ).run()
+            except Exception as e:
+                return str(e) or e.__class__.__name__
+        return result.get("viz_error")
+
+    def run(self) -> dict:
+        """
+        :return: a report: number of dashboards and charts, charts warmed up and in
+        error, duration in seconds
+        """
+        start = time.monotonic()
+        dashboards = self.get_dashboards()
+        jobs = self.get_jobs(dashboards)
+        warmed = errors = 0
+        with ThreadPoolExecutor(
+            max_workers=self.concurrency, thread_name_prefix="georchestra-warmup"
+        ) as executor:
+            for job, error in zip(jobs, executor.map(self.warm_up, jobs)):
+                if error:
+                    errors += 1
+                    logger.warning(
+                        f"Could not warm up chart {job.chart_id} of dashboard "
+                        f"{job.dashboard_id}: {error}"
+                    )
+                else:
+                    warmed += 1
+        report = {
+            "dashboards": len({dashboard.id for _, dashboard in dashboards}),
+            "charts": len(jobs),
+            "warmed": warmed,
+            "errors": errors,
+            "seconds": round(time.monotonic() - start, 1),
+        }
+        logger.info(
+            f"Cache warm-up: {warmed} charts warmed up, {errors} errors, from "
+            f"{report['dashboards']} dashboards, in {report['seconds']}s"
+        )
+        return report
+
+
+@celery_app.task(name="georchestra.cache_warmup")
+def cache_warmup() -> dict:
+    """
+    Celery task, to schedule with celery beat (see CELERY_CONFIG)
+    """
+    return CacheWarmer(current_app._get_current_object()).run()
@@ -13,6 +13,16 @@ LOG_LEVEL = environ.get('LOG_LEVEL', 'INFO').upper()
 # Override LOGGING_CONFIGURATOR from
 # https://github.com/apache/superset/blob/master/superset/config.py#L933
 LOGGING_CONFIGURATOR = CustomLoggingConfigurator()
+# Write the logs from a background thread, so that logging never blocks a request.
+# Records are dropped if more than GEORCHESTRA_LOG_QUEUE_SIZE are waiting
+GEORCHESTRA_LOG_ASYNC = environ.get('LOG_ASYNC', 'false') in ['true', 'yes']
+# GEORCHESTRA_LOG_QUEUE_SIZE = 10000
+# One JSON document per line instead of LOG_FORMAT, for log collectors
+GEORCHESTRA_LOG_JSON = environ.get('LOG_JSON', 'false') in ['true', 'yes']
+# Only keep a fraction of the debug and info messages of some loggers (and of their
+# children). Warnings and errors are always kept. E.g. for the login logic, which logs
+# on every request:
+# GEORCHESTRA_LOG_SAMPLING = {"GeorchestraCustomizations": 0.01}
 
 # Optionally import Preconfig.py (which will have been included on
 # the PYTHONPATH) in order to allow to set some variables that will be
@@ -54,10 +64,97 @@ AUTH_TYPE = AUTH_REMOTE_USER
 CUSTOM_SECURITY_MANAGER = GeorchestraSecurityManager
 APP_INITIALIZER = app_init
 GEORCHESTRA_ROLES_PREFIX = "ROLE_SUPERSET_"
+# Mapping of the geOrchestra roles (sec-roles header) to the Superset roles. If not set,
+# ROLE_SUPERSET_XXX gives the XXX Superset role (see GEORCHESTRA_ROLES_PREFIX). If set,
+# GEORCHESTRA_ROLES_PREFIX is not used: include the equivalent pattern rule if needed.
+# - exact rules ("role") are checked first, all the ones matching a role apply
+# - otherwise, the first pattern rule ("pattern", regex matching the whole role) applies.
+#   Its named groups can be used in the Superset role names
+# - rules with an "org" only apply to the members of this organization (sec-org header).
+#   {org} can be used in the Superset role names
+# Role names are case-insensitive. Unknown Superset roles are ignored.
+# GEORCHESTRA_ROLES_MAPPING = [
+#     {"role": "ROLE_ADMINISTRATOR", "superset_roles": ["Admin"]},
+#     {"role": "ROLE_USER", "org": "PSC", "superset_roles": ["PSC_Gamma"]},
+#     {"pattern": r"ROLE_ORG_(?P<profile>VIEWER|EDITOR)", "superset_roles": ["{org}_{profile}"]},
+#     {"pattern": r"ROLE_SUPERSET_(?P<name>.+)", "superset_roles": ["{name}"]},
+# ]
+# Number of distinct (sec-roles, sec-org) headers whose mapping is memoized, per worker
+# GEORCHESTRA_ROLES_MAPPING_CACHE_SIZE = 4096
 # Check if user roles list needs to be updated. Means DB access so we don't want it to happen too often
 GEORCHESTRA_ROLES_CHECK_FREQUENCY = 5 #minutes
+# Where to keep track of the roles checks: "memory" (one store per gunicorn worker) or
+# "redis" (shared by all workers and pods, one check covers them all)
+GEORCHESTRA_ROLES_CHECK_STORE = "redis"
+# Max number of users tracked by the in-process store (also used as fallback if redis is down)
+GEORCHESTRA_ROLES_CHECK_STORE_SIZE = 10000
+# Redis timeout (seconds) of the roles check store and of the role catalog, and how
+# long they leave redis alone after a failure (seconds). The roles check store then falls
+# back to the in-process store, the role catalog keeps its current index
+# GEORCHESTRA_ROLES_CHECK_STORE_TIMEOUT = 0.5
+# GEORCHESTRA_ROLES_CHECK_STORE_RETRY_INTERVAL = 30
+# Fast mode: store a fingerprint of the sec-* headers in the session and only sync the user
+# profile when it changes (replaces the periodic roles check)
+GEORCHESTRA_HEADERS_FINGERPRINT = False
+# The roles are indexed in memory. Interval (seconds) at which each worker checks if
+# another one modified the roles
+GEORCHESTRA_ROLE_CATALOG_CHECK_INTERVAL = 30
+# Stateless mode: the user is built from the sec-* headers on every request (with a
+# per-worker cache keyed by a fingerprint of the headers), and nothing gets stored in the
+# session: no session cookie, no sticky sessions needed, no login/logout when the user
+# changes. Cache entries expire after GEORCHESTRA_ROLES_CHECK_FREQUENCY minutes
+GEORCHESTRA_STATELESS_AUTH = False
+# GEORCHESTRA_STATELESS_CACHE_SIZE = 10000  # users cached per worker
+# Push-based invalidation: events like {"users": ["username"], "roles": true} published
+# on this Redis channel (GEORCHESTRA_REDIS_URL), or POSTed to the invalidation endpoint,
+# make the listed users get their profile checked on their next request, and the role
+# catalog reloaded, in all workers. GEORCHESTRA_ROLES_CHECK_FREQUENCY can then be raised
+# to hours
+# GEORCHESTRA_INVALIDATION_CHANNEL = "georchestra_invalidation"
+# The endpoint is only enabled if a token is set. Expected as "Authorization: Bearer <token>"
+# Internal use only: don't expose it through the gateway
+# GEORCHESTRA_INVALIDATION_TOKEN = "change-me"
+# GEORCHESTRA_INVALIDATION_PATH = "/georchestra/invalidate"
+# Write-behind mode: when the sec-* headers show a profile change (roles, email), the
+# user is updated right away for the current request, but the DB record is updated by a
+# background thread (coalesced per user, batched), instead of blocking the request
+GEORCHESTRA_PROFILE_WRITE_BEHIND = False
+# GEORCHESTRA_PROFILE_WRITE_BEHIND_INTERVAL = 1  # seconds between two flushes
+# GEORCHESTRA_PROFILE_WRITE_BEHIND_BATCH_SIZE = 100  # users per transaction
+# GEORCHESTRA_PROFILE_WRITE_BEHIND_MAX_RETRIES = 3
+# Requests to those paths and endpoints skip the login logic (no user profile lookup).
+# Paths ending with a / are prefixes, the others must match exactly. Default values are:
+# GEORCHESTRA_LOGIN_BYPASS_PATHS = ["/static/", "/health", "/ping", "/favicon.ico", "/robots.txt"]
+# GEORCHESTRA_LOGIN_BYPASS_ENDPOINTS = ["static", "appbuilder.static", "health", "georchestra_metrics", "georchestra_invalidate"]
+# Anonymous requests (no sec-username header) without a logged-in session don't touch
+# the session at all, and get no Set-Cookie header
+GEORCHESTRA_ANONYMOUS_FAST_PATH = True
+# Prometheus metrics for the geOrchestra customizations and the caches, served on
+# /metrics (requires the prometheus_client package). Set the PROMETHEUS_MULTIPROC_DIR
+# env var to aggregate the metrics from all gunicorn workers.
+GEORCHESTRA_METRICS_ENABLED = True
+# Required (the endpoint is disabled without it), in an "Authorization: Bearer <token>"
+# header, to access the metrics
+GEORCHESTRA_METRICS_TOKEN = environ.get('GEORCHESTRA_METRICS_TOKEN')
+# Minimum interval (seconds) between two computations of the caches memory usage
+# (SCAN of all the cache keys)
+# GEORCHESTRA_METRICS_CACHE_SIZE_INTERVAL = 300
+# Requests profiler: records a cProfile profile of the requests carrying the
+# "X-Georchestra-Profile: <token>" header, and/or of a random fraction of the requests.
+# Disabled if none of the token and the sampling rate are set. Admins list and
+# download the profiles on GEORCHESTRA_PROFILER_PATH (/georchestra/profiles)
+# GEORCHESTRA_PROFILER_TOKEN = "change-me"
+# GEORCHESTRA_PROFILER_SAMPLING_RATE = 0.001
+# GEORCHESTRA_PROFILER_MIN_DURATION = 1  # seconds. Faster sampled requests are not kept
+# GEORCHESTRA_PROFILER_DIR = "/tmp/georchestra_profiles"
+# GEORCHESTRA_PROFILER_MAX_FILES = 100  # the oldest profiles are deleted
+# Redis DB used by the geOrchestra customizations (not by the caches)
+GEORCHESTRA_REDIS_URL = f"{REDIS_BASE_URL}/5"
 # Can configure the header from the georchestra default.properties file
 # GEORCHESTRA_PROPERTIES_FILE_PATH = "/etc/georchestra/default.properties"
+# The properties file is cached, and parsed again only when it changes. Minimum interval
+# (seconds) between two checks of its modification time
+# GEORCHESTRA_PROPERTIES_CHECK_INTERVAL = 30
 # GEORCHESTRA_NOHEADER = False
 # Can also configure the header directly here with the following params
 # GEORCHESTRA_HEADER_SCRIPT = "https://cdn.jsdelivr.net/gh/georchestra/header@dist/header.js"
@@ -80,13 +177,72 @@ LOGIN_REDIRECT_URL = "?login"
 # Disable default event logging (stored in DB by default, which can bloat the DB,
 # cf https://github.com/apache/superset/discussions/23110).
 # Alternatives are StdOutEventLogger or DBEventLogger (default).
+# AsyncEventLogger doesn't block the requests: events are queued in memory and written
+# in batches by a background thread, to a JSON lines file, a DB table or an HTTP endpoint
+# RollupEventLogger only writes aggregated rows (counts and durations histograms per
+# time bucket and dimensions), which keeps the volume low.
 if environ.get('LOG_EVENTS_STDOUT', 'false') in ['true', 'yes']:
     logger.debug("EVENT_LOGGER = StdOutEventLogger()")
     EVENT_LOGGER = StdOutEventLogger()
+elif environ.get('LOG_EVENTS_FILE'):
+    from GeorchestraEventLoggers import (
+        AsyncEventLogger,
+        HttpPostSink,
+        JsonLinesSink,
+        PostgresSink,
+        RollupEventLogger,
+    )
+    # Other sinks:
+    # PostgresSink(SQLALCHEMY_DATABASE_URI, "georchestra_events")
+    # HttpPostSink("https://my-analytics/events", headers={"Authorization": "Bearer ..."})
+    event_sink = JsonLinesSink(environ.get('LOG_EVENTS_FILE'))
+    if environ.get('LOG_EVENTS_ROLLUP', 'false') in ['true', 'yes']:
+        logger.debug("EVENT_LOGGER = RollupEventLogger(JsonLinesSink())")
+        EVENT_LOGGER = RollupEventLogger(
+            event_sink,
+            # Among action, event_name, dashboard_id, slice_id, role
+            dimensions=("action", "event_name", "dashboard_id", "slice_id", "role"),
+            bucket_seconds=300,
+            flush_interval=60,  # seconds
+        )
+    else:
+        logger.debug("EVENT_LOGGER = AsyncEventLogger(JsonLinesSink())")
+        EVENT_LOGGER = AsyncEventLogger(
+            event_sink,
+            batch_size=500,
+            flush_interval=10,  # seconds
+            max_queue_size=10000,
+            overflow_policy="drop",  # or "block"
+        )
 else:
     logger.debug("EVENT_LOGGER = NullEventLogger()")
     EVENT_LOGGER = NullEventLogger()
 
+# Queries instrumentation: times the queries run on the analytics databases (charts,
+# SQL Lab), exposed as metrics (georchestra_query_seconds and georchestra_query_rows).
+# Queries slower than slow_query_threshold seconds also go to a slow query log, written
+# asynchronously like the events (any sink: JsonLinesSink, PostgresSink...).
+# It wraps the cursors of the analytics databases connections: disabled by default
+# GEORCHESTRA_QUERY_METRICS = True
+if globals().get('GEORCHESTRA_QUERY_METRICS', False):
+    from GeorchestraEventLoggers import JsonLinesSink
+    from GeorchestraMonitoring import QueryInstrumentation
+    query_instrumentation = QueryInstrumentation(
+        # Among database, dataset, role and source. dataset reads the body of the chart
+        # data requests, role (the users' roles) can make a lot of time series
+        labels=("database", "source"),
+        slow_query_threshold=5,  # seconds
+        slow_query_sink=(
+            JsonLinesSink(environ.get('LOG_SLOW_QUERIES_FILE'))
+            if environ.get('LOG_SLOW_QUERIES_FILE')
+            else None
+        ),
+        log_sql=False,  # only write the hash of the SQL
+    )
+    # Both are needed
+    QUERY_LOGGER = query_instrumentation.log_query
+    DB_CONNECTION_MUTATOR = query_instrumentation.mutate_connection
+
 from LocalizationFr import *
 
 # Redefine home page (Superset default is /superset/welcome)
@@ -221,38 +377,145 @@ TALISMAN_CONFIG = {
 ################################
 # Use redis for caching and rate limit
 ################################
+# GeorchestraRedisCache is the flask-caching Redis backend, instrumented to provide
+# hits/misses and memory usage metrics.
+# It can also keep a small in-process LRU in front of Redis (per cache, opt-in). Meant
+# for the small metadata entries, not for the chart data:
+# - CACHE_LOCAL_ENABLED: enable the local tier
+# - CACHE_LOCAL_MAX_ITEMS: max number of entries kept by each worker (default 1000)
+# - CACHE_LOCAL_MAX_SIZE: max total size of the entries kept by each worker, in bytes
+#   (default 16MB)
+# - CACHE_LOCAL_TIMEOUT: how long an entry is kept locally, in seconds (default 10). Never
+#   longer than it has left to live in Redis
+# - CACHE_LOCAL_MAX_ITEM_SIZE: bigger entries are not kept locally (default 64KB)
+# - CACHE_LOCAL_WRITE_THROUGH: writes also update the local tier (by default, they just
+#   drop the entry from it)
+# Writes are propagated to the other workers through a Redis pub/sub channel
+# (CACHE_LOCAL_INVALIDATION_CHANNEL, defaults to georchestra_cache_invalidation_<prefix>)
+# Entries can be compressed (per cache), which matters for the chart data, e.g. with
+# large geometry columns:
+# - CACHE_COMPRESSION_THRESHOLD: compress the entries of at least this size, in bytes
+#   (default: no compression)
+# - CACHE_COMPRESSION_CODEC: zstd (requires the zstandard package) or zlib. Defaults
+#   to zstd if available
+# - CACHE_COMPRESSION_LEVEL: defaults to the codec's default
+# - CACHE_MAX_VALUE_SIZE: entries bigger than this, in bytes once compressed, are not
+#   cached (default: no limit)
+# Entries written before compression was enabled are still read.
 
 CACHE_CONFIG = {
-    'CACHE_TYPE': 'redis',
+    'CACHE_TYPE': 'GeorchestraCaches.GeorchestraRedisCache',
     'CACHE_REDIS_URL': f"{REDIS_BASE_URL}/3",
     'CACHE_DEFAULT_TIMEOUT': 86400,
-    'CACHE_KEY_PREFIX': 'SUPERSET_VIEW'
+    'CACHE_KEY_PREFIX': 'SUPERSET_VIEW',
+    'CACHE_LOCAL_ENABLED': True,
+    'CACHE_LOCAL_MAX_ITEMS': 1000,
+    'CACHE_LOCAL_MAX_SIZE': 8 * 1024 * 1024,
+    'CACHE_LOCAL_TIMEOUT': 10,
 }
 
 DATA_CACHE_CONFIG = {
-    'CACHE_TYPE': 'redis',
+    'CACHE_TYPE': 'GeorchestraCaches.GeorchestraRedisCache',
     'CACHE_REDIS_URL': f"{REDIS_BASE_URL}/3",
     'CACHE_DEFAULT_TIMEOUT': 86400,
-    'CACHE_KEY_PREFIX': 'SUPERSET_DATA'
+    'CACHE_KEY_PREFIX': 'SUPERSET_DATA',
+    'CACHE_COMPRESSION_THRESHOLD': 16384,
+    'CACHE_MAX_VALUE_SIZE': 64 * 1024 * 1024,
 }
 
 EXPLORE_FORM_DATA_CACHE_CONFIG = {
-    'CACHE_TYPE': 'redis',
+    'CACHE_TYPE': 'GeorchestraCaches.GeorchestraRedisCache',
     'CACHE_REDIS_URL': f"{REDIS_BASE_URL}/3",
     'CACHE_DEFAULT_TIMEOUT': 86400,
-    'CACHE_KEY_PREFIX': 'SUPERSET_E'
+    'CACHE_KEY_PREFIX': 'SUPERSET_E',
+    'CACHE_LOCAL_ENABLED': True,
+    'CACHE_LOCAL_MAX_ITEMS': 1000,
+    'CACHE_LOCAL_MAX_SIZE': 8 * 1024 * 1024,
+    'CACHE_LOCAL_TIMEOUT': 10,
+    'CACHE_LOCAL_WRITE_THROUGH': True,
 }
 
 FILTER_STATE_CACHE_CONFIG = {
-    'CACHE_TYPE': 'redis',
+    'CACHE_TYPE': 'GeorchestraCaches.GeorchestraRedisCache',
     'CACHE_REDIS_URL': f"{REDIS_BASE_URL}/3",
     'CACHE_DEFAULT_TIMEOUT': 86400,
-    'CACHE_KEY_PREFIX': 'SUPERSET_F'
+    'CACHE_KEY_PREFIX': 'SUPERSET_F',
+    'CACHE_LOCAL_ENABLED': True,
+    'CACHE_LOCAL_MAX_ITEMS': 1000,
+    'CACHE_LOCAL_MAX_SIZE': 8 * 1024 * 1024,
+    'CACHE_LOCAL_TIMEOUT': 10,
+    'CACHE_LOCAL_WRITE_THROUGH': True,
 }
 
 RATELIMIT_STORAGE_URI = f"{REDIS_BASE_URL}/4"
 RATELIMIT_STORAGE_OPTIONS = {"socket_connect_timeout": 30}
 
+################################
+# Cache warm-up
+################################
+# The charts of the dashboards visible to the Public role, and of the most viewed
+# dashboards (according to the EVENT_LOGGER records), can be computed in advance to
+# fill DATA_CACHE_CONFIG, e.g. after a Redis flush or a deployment.
+# Either run `superset georchestra warm-up-caches --loop`, or schedule the
+# georchestra.cache_warmup Celery task with celery beat, e.g.:
+# from celery.schedules import crontab
+# class CeleryConfig:
+#     broker_url = f"{REDIS_BASE_URL}/0"
+#     result_backend = f"{REDIS_BASE_URL}/0"
+#     imports = ("superset.sql_lab", "superset.tasks.scheduler", "GeorchestraWarmup")
+#     beat_schedule = {
+#         "georchestra-cache-warmup": {
+#             "task": "georchestra.cache_warmup",
+#             "schedule": crontab(minute=0),
+#         },
+#     }
+# CELERY_CONFIG = CeleryConfig
+GEORCHESTRA_WARMUP_PUBLIC_DASHBOARDS = True
+# Number of most viewed dashboards to warm up, on top of the public ones. 0 to disable
+GEORCHESTRA_WARMUP_TOP_N = 10
+# GEORCHESTRA_WARMUP_TOP_N_DAYS = 7  # views are counted over the last N days
+# User the most viewed dashboards are computed as, e.g. a service account having the
+# roles of most viewers. Default: anonymous (Public role)
+# GEORCHESTRA_WARMUP_USERNAME = "superset_warmup"
+# GEORCHESTRA_WARMUP_CONCURRENCY = 4  # charts computed in parallel
+# GEORCHESTRA_WARMUP_DATABASE_RATE = 1  # max queries started per second on a database
+# GEORCHESTRA_WARMUP_INTERVAL = 3600  # seconds between two runs of the --loop command
+
+################################
+# GeoJSON export
+################################
+# Streaming GeoJSON / newline-delimited GeoJSON export of the datasets and charts, e.g.
+# for QGIS or mviewer, on GEORCHESTRA_GEO_EXPORT_PATH/dataset/<id>.geojson and
+# GEORCHESTRA_GEO_EXPORT_PATH/chart/<id>.ndjson. Not limited by ROW_LIMIT. None to disable
+GEORCHESTRA_GEO_EXPORT_PATH = "/georchestra/export"
+# GEORCHESTRA_GEO_EXPORT_CHUNK_SIZE = 1000  # rows read from the database at a time
+# GEORCHESTRA_GEO_EXPORT_ROW_LIMIT = 1000000  # max features per export. Default: none
+
+################################
+# Vector tiles
+################################
+# Mapbox Vector Tiles of the geometries of the datasets, for map clients, on
+# GEORCHESTRA_TILES_PATH/dataset/<id>/<z>/<x>/<y>.mvt?geometry=<column>. Made by PostGIS
+# (3.0 or later), or from SpatiaLite (requires the mapbox-vector-tile and shapely
+# packages). None to disable
+GEORCHESTRA_TILES_PATH = "/georchestra/tiles"
+# GEORCHESTRA_TILES_MAX_ZOOM = 22
+# GEORCHESTRA_TILES_MAX_FEATURES = 50000  # per tile
+# GEORCHESTRA_TILES_SIMPLIFY = 1  # simplification tolerance, in 1/4096 of tile
+# GEORCHESTRA_TILES_MAX_AGE = 3600  # browser cache, in seconds
+# GEORCHESTRA_TILES_SPATIALITE_EXTENSION = "mod_spatialite"
+# Tiles cache, next to the other caches. Keys depend on the dataset's last change
+# (changed_on) and on the row level security filters of the user
+GEORCHESTRA_TILES_CACHE_CONFIG = {
+    'CACHE_TYPE': 'GeorchestraCaches.GeorchestraRedisCache',
+    'CACHE_REDIS_URL': f"{REDIS_BASE_URL}/3",
+    'CACHE_DEFAULT_TIMEOUT': 86400,
+    'CACHE_KEY_PREFIX': 'GEORCHESTRA_TILES',
+    'CACHE_COMPRESSION_THRESHOLD': 16384,
+    'CACHE_MAX_VALUE_SIZE': 16 * 1024 * 1024,
+}
+# GEORCHESTRA_TILES_CACHE_TIMEOUT = 86400  # Default: CACHE_DEFAULT_TIMEOUT
+
 
 # Optionally import Overrides.py (which will have been included on
 # the PYTHONPATH) in order to allow some final, custom overrides
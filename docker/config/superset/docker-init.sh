@@ -40,6 +40,8 @@ ADMIN_PASSWORD="${ADMIN_PASSWORD:-admin}"
 # Initialize the database
 echo_step "1" "Starting" "Applying DB migrations"
 superset db upgrade
+# Indexes used by the geOrchestra login logic
+superset georchestra ensure-indexes
 echo_step "1" "Complete" "Applying DB migrations"
 
 # Create an admin user
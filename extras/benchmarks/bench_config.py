@@ -0,0 +1,35 @@
+# Superset config used by the microbenchmarks (bench_customizations.py): offline,
+# in-memory SQLite metadata DB, no Redis
+
+from flask_appbuilder.const import AUTH_REMOTE_USER
+from sqlalchemy.pool import StaticPool
+
+from GeorchestraCustomizations import GeorchestraSecurityManager, NullEventLogger
+
+SECRET_KEY = "microbenchmarks-only"
+# A single connection, shared by all sessions, or each one would get its own empty DB
+SQLALCHEMY_DATABASE_URI = "sqlite://"
+SQLALCHEMY_ENGINE_OPTIONS = {
+    "poolclass": StaticPool,
+    "connect_args": {"check_same_thread": False},
+}
+SQLALCHEMY_EXAMPLES_URI = "sqlite://"
+
+AUTH_TYPE = AUTH_REMOTE_USER
+CUSTOM_SECURITY_MANAGER = GeorchestraSecurityManager
+AUTH_USER_REGISTRATION_ROLE = "Public"
+FAB_UPDATE_PERMS = False
+WTF_CSRF_ENABLED = False
+TALISMAN_ENABLED = False
+EVENT_LOGGER = NullEventLogger()
+
+CACHE_CONFIG = {"CACHE_TYPE": "NullCache"}
+DATA_CACHE_CONFIG = {"CACHE_TYPE": "NullCache"}
+EXPLORE_FORM_DATA_CACHE_CONFIG = {"CACHE_TYPE": "NullCache"}
+FILTER_STATE_CACHE_CONFIG = {"CACHE_TYPE": "NullCache"}
+
+GEORCHESTRA_ROLES_PREFIX = "ROLE_SUPERSET_"
+GEORCHESTRA_ROLES_CHECK_FREQUENCY = 5
+GEORCHESTRA_ROLES_CHECK_STORE = "memory"
+GEORCHESTRA_REDIS_URL = None
+GEORCHESTRA_METRICS_ENABLED = False
@@ -0,0 +1,274 @@
+"""
+Microbenchmarks for the per-request cost of the geOrchestra customizations
+(config/superset/GeorchestraCustomizations.py).
+
+Runs offline, against a Superset app using an in-memory SQLite metadata DB (see
+bench_config.py). Requires a python environment where Superset is installed (see the
+development setup documentation).
+
+Usage:
+    python extras/benchmarks/bench_customizations.py --output results.json
+    python extras/benchmarks/bench_customizations.py --compare results.json --threshold 0.2
+
+With --compare, the exit code is 1 if the median time of any benchmark increased by
+more than the threshold (0.2 = +20%) compared to the baseline results file.
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CONFIG_DIR = os.path.join(HERE, "..", "..", "config", "superset")
+
+# Must be set before superset gets imported
+sys.path[:0] = [os.path.abspath(CONFIG_DIR), HERE]
+os.environ["SUPERSET_CONFIG_PATH"] = os.path.join(HERE, "bench_config.py")
+
+ROLE_SIZES = (10, 100, 1000)
+ROLE_NAME = "Bench_role_{}"
+USERNAME = "bench_user"
+OTHER_USERNAME = "bench_other_user"
+
+
+def user_headers(username: str, roles: str = "ROLE_USER") -> dict:
+    return {
+        "HTTP_SEC_USERNAME": username,
+        "HTTP_SEC_ROLES": roles,
+        "HTTP_SEC_EMAIL": f"{username}@example.org",
+        "HTTP_SEC_FIRSTNAME": "Bench",
+        "HTTP_SEC_LASTNAME": username,
+    }
+
+
+def roles_header(size: int) -> str:
+    # Half of them are not Superset roles, like in a real geOrchestra header
+    superset_roles = [f"ROLE_SUPERSET_{ROLE_NAME.format(i).upper()}" for i in range(size)]
+    other_roles = [f"ROLE_OTHER_{i}" for i in range(size)]
+    return ";".join(superset_roles + other_roles)
+
+
+class Bench(object):
+    def __init__(self, iterations: int, warmup: int):
+        self.iterations = iterations
+        self.warmup = warmup
+        self.results = {}
+
+        from superset.app import create_app
+
+        self.app = create_app()
+        with self.app.app_context():
+            self._populate_db()
+
+    def _populate_db(self) -> None:
+        from superset import db, security_manager as sm
+
+        db.create_all()
+        sm.add_role("Public")
+        for i in range(max(ROLE_SIZES)):
+            sm.add_role(ROLE_NAME.format(i))
+        for username in (USERNAME, OTHER_USERNAME):
+            sm.add_user(
+                username=username,
+                first_name="Bench",
+                last_name=username,
+                email=f"{username}@example.org",
+                role=[sm.find_role("Public")],
+            )
+
+    def measure(self, name: str, function, setup=None, environ: dict = None) -> None:
+        """
+        Run `function` in a fresh request context, `warmup` + `iterations` times.
+        Only the call to `function` is timed, not `setup` (called in the same request
+        context, just before)
+        """
+        timings = []
+        for i in range(self.warmup + self.iterations):
+            with self.app.test_request_context(environ_base=environ or {}):
+                context = setup() if setup else None
+                start = time.perf_counter_ns()
+                function(context)
+                elapsed = time.perf_counter_ns() - start
+            if i >= self.warmup:
+                timings.append(elapsed / 1000)
+        timings.sort()
+        self.results[name] = {
+            "iterations": len(timings),
+            "min_us": timings[0],
+            "median_us": statistics.median(timings),
+            "mean_us": statistics.fmean(timings),
+            "p95_us": timings[int(len(timings) * 0.95) - 1],
+        }
+        print(
+            f"{name:45s} median {self.results[name]['median_us']:10.1f} µs"
+            f"   p95 {self.results[name]['p95_us']:10.1f} µs"
+        )
+
+    def run(self) -> dict:
+        from flask_login import login_user
+        from GeorchestraCustomizations import (
+            GeorchestraContextProcessor,
+            MemoryRolesCheckStore,
+            RemoteUserLogin,
+        )
+        from superset import security_manager as sm
+
+        login = RemoteUserLogin(self.app)
+        # A roles check on every call
+        recheck_login = RemoteUserLogin(self.app)
+        recheck_login.roles_checks = MemoryRolesCheckStore(timedelta(0))
+
+        def log_in(username):
+            def setup():
+                login_user(sm.find_user(username=username))
+
+            return setup
+
+        self.measure(
+            "log_user.already_logged_in",
+            lambda _: login.log_user(),
+            setup=log_in(USERNAME),
+            environ=user_headers(USERNAME),
+        )
+        self.measure(
+            "log_user.roles_recheck",
+            lambda _: recheck_login.log_user(),
+            setup=log_in(USERNAME),
+            environ=user_headers(USERNAME),
+        )
+        self.measure(
+            "log_user.user_switch",
+            lambda _: login.log_user(),
+            setup=log_in(OTHER_USERNAME),
+            environ=user_headers(USERNAME),
+        )
+        self.measure("log_user.anonymous", lambda _: login.log_user())
+        self.measure(
+            "log_user.anonymous_logout",
+            lambda _: login.log_user(),
+            setup=log_in(USERNAME),
+        )
+
+        counter = iter(range(sys.maxsize))
+
+        def new_user():
+            from flask import request
+
+            username = f"bench_new_user_{next(counter)}"
+            request.environ.update(user_headers(username))
+
+        self.measure(
+            "log_user.first_time_creation", lambda _: login.log_user(), setup=new_user
+        )
+
+        self.measure(
+            "log_user_stateless.cached",
+            lambda _: login.log_user_stateless(),
+            environ=user_headers(USERNAME),
+        )
+        self.measure(
+            "log_user_stateless.sync",
+            lambda _: login.log_user_stateless(),
+            setup=lambda: login.stateless_users._users.clear(),
+            environ=user_headers(USERNAME),
+        )
+
+        for size in ROLE_SIZES:
+            header = roles_header(size)
+            self.measure(
+                f"get_valid_roles_from_header.{size}_roles",
+                lambda _: login._get_valid_roles_from_header(header),
+            )
+            self.measure(
+                f"get_valid_roles_from_header.{size}_roles_cold",
+                lambda _: login._get_valid_roles_from_header(header),
+                setup=login.role_catalog.invalidate,
+            )
+
+        processor = GeorchestraContextProcessor(self.app)
+        processor.properties_file_path = ""
+        self.measure(
+            "get_georchestra_properties.no_file",
+            lambda _: processor.get_georchestra_properties(),
+        )
+        with tempfile.NamedTemporaryFile("w", suffix=".properties") as properties:
+            properties.write(
+                "headerScript=https://cdn.jsdelivr.net/gh/georchestra/header@dist/header.js\n"
+                "headerHeight=90\n"
+                "headerUrl=/header/\n"
+                "logoUrl=https://www.georchestra.org/public/georchestra-logo.svg\n"
+            )
+            properties.flush()
+            processor = GeorchestraContextProcessor(self.app)
+            processor.properties_file_path = properties.name
+            self.measure(
+                "get_georchestra_properties.with_file",
+                lambda _: processor.get_georchestra_properties(),
+            )
+        return self.results
+
+
+def compare(results: dict, baseline_path: str, threshold: float) -> bool:
+    """
+    :return: True if no benchmark regressed beyond the threshold
+    """
+    with open(baseline_path) as f:
+        baseline = json.load(f)["results"]
+    success = True
+    print(f"\n{'benchmark':45s} {'baseline':>12s} {'current':>12s} {'change':>8s}")
+    for name, result in results.items():
+        if name not in baseline:
+            print(f"{name:45s} {'-':>12s} {result['median_us']:12.1f} {'new':>8s}")
+            continue
+        before = baseline[name]["median_us"]
+        change = result["median_us"] / before - 1 if before else 0
+        regressed = change > threshold
+        success = success and not regressed
+        print(
+            f"{name:45s} {before:12.1f} {result['median_us']:12.1f} {change:+8.1%}"
+            + ("  REGRESSION" if regressed else "")
+        )
+    return success
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="baseline results JSON file")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="max allowed increase of the median time, relative (0.2 = +20%%)",
+    )
+    args = parser.parse_args()
+
+    results = Bench(args.iterations, args.warmup).run()
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "date": datetime.now(timezone.utc).isoformat(),
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "iterations": args.iterations,
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+    if args.compare and not compare(results, args.compare, args.threshold):
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
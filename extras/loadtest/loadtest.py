@@ -0,0 +1,426 @@
+"""
+Load generator for a Superset instance, impersonating the geOrchestra gateway: requests
+carry the sec-username, sec-roles, sec-email, ... headers the gateway adds for logged-in
+users.
+
+Scenarios:
+- anonymous: anonymous viewers of the public dashboards
+- viewer: logged-in users browsing the dashboards and charts
+- role_change: logged-in users whose roles change between two requests
+
+Each scenario is run alone for --duration seconds, then all of them together
+(scenario "mixed", weighted by --mix). For each one, the throughput, p50/p95/p99 latency
+and number of queries run on the Superset metadata DB are reported. The latter needs the
+pg_stat_statements extension (see docker-compose.loadtest.yml) and psycopg2.
+
+Only uses the python standard library, psycopg2 aside. See
+docs/technical_guides/contribute/loadtest.md
+"""
+
+import argparse
+import http.client
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+import urllib.parse
+from collections import defaultdict
+from typing import Optional
+
+logger = logging.getLogger("loadtest")
+
+SCENARIOS = ("anonymous", "viewer", "role_change")
+
+
+def default_db_uri() -> str:
+    return (
+        f"postgresql://{os.environ.get('DATABASE_USER', 'superset')}"
+        f":{os.environ.get('DATABASE_PASSWORD', 'superset')}"
+        f"@{os.environ.get('DATABASE_HOST', 'localhost')}"
+        f":{os.environ.get('DATABASE_PORT', '5432')}"
+        f"/{os.environ.get('DATABASE_DB', 'superset')}"
+    )
+
+
+class Population(object):
+    """
+    The simulated geOrchestra users, and the headers the gateway would send for them
+    """
+
+    def __init__(self, users: int, roles: list[str], max_roles: int, seed: int):
+        self.random = random.Random(seed)
+        self.roles = roles
+        self.max_roles = max_roles
+        self.users = [
+            {
+                "username": f"loadtest_user_{i}",
+                "roles": self.pick_roles(),
+            }
+            for i in range(users)
+        ]
+        self._lock = threading.Lock()
+
+    def pick_roles(self) -> list[str]:
+        # Always ROLE_USER, plus some Superset roles, like a real geOrchestra account
+        count = self.random.randint(1, min(self.max_roles, len(self.roles)))
+        return ["ROLE_USER"] + sorted(self.random.sample(self.roles, count))
+
+    def pick_user(self) -> dict:
+        with self._lock:
+            return self.random.choice(self.users)
+
+    def change_roles(self, user: dict) -> None:
+        with self._lock:
+            user["roles"] = self.pick_roles()
+
+    @staticmethod
+    def headers(user: dict) -> dict:
+        return {
+            "sec-username": user["username"],
+            "sec-roles": ";".join(user["roles"]),
+            "sec-email": f"{user['username']}@example.org",
+            "sec-firstname": "Load",
+            "sec-lastname": user["username"],
+            "sec-org": "LOADTEST",
+        }
+
+
+class Client(object):
+    """
+    An HTTP client, keeping its connection and cookies (i.e. the Superset session), like
+    a browser
+    """
+
+    def __init__(self, base_url: str, timeout: float):
+        url = urllib.parse.urlsplit(base_url)
+        self.prefix = url.path.rstrip("/")
+        connection_class = (
+            http.client.HTTPSConnection
+            if url.scheme == "https"
+            else http.client.HTTPConnection
+        )
+        self.connection = connection_class(url.netloc, timeout=timeout)
+        self.cookies = {}
+        # The simulated user, for the logged-in scenarios
+        self.user = None
+
+    def get(self, path: str, headers: Optional[dict] = None) -> tuple[int, bytes]:
+        headers = dict(headers or {})
+        if self.cookies:
+            headers["Cookie"] = "; ".join(f"{k}={v}" for k, v in self.cookies.items())
+        try:
+            self.connection.request("GET", self.prefix + path, headers=headers)
+            response = self.connection.getresponse()
+            body = response.read()
+        except (OSError, http.client.HTTPException):
+            self.connection.close()
+            raise
+        for cookie in response.headers.get_all("Set-Cookie") or []:
+            name, _, value = cookie.split(";", 1)[0].partition("=")
+            self.cookies[name.strip()] = value.strip()
+        return response.status, body
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+class Recorder(object):
+    """
+    Collects the latency of the requests, for a phase of the test
+    """
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def record(self, scenario: str, latency: float, ok: bool) -> None:
+        with self._lock:
+            self.latencies[scenario].append(latency)
+            if not ok:
+                self.errors[scenario] += 1
+
+    def summary(self, duration: float) -> dict:
+        latencies = [value for values in self.latencies.values() for value in values]
+        result = {"total": self._summarize(latencies, self.errors_count(), duration)}
+        for scenario, values in self.latencies.items():
+            result[scenario] = self._summarize(
+                values, self.errors[scenario], duration
+            )
+        return result
+
+    def errors_count(self) -> int:
+        return sum(self.errors.values())
+
+    @staticmethod
+    def _summarize(latencies: list[float], errors: int, duration: float) -> dict:
+        if not latencies:
+            return {"requests": 0, "errors": errors}
+        quantiles = statistics.quantiles(latencies, n=100, method="inclusive")
+        return {
+            "requests": len(latencies),
+            "errors": errors,
+            "throughput_rps": len(latencies) / duration,
+            "p50_ms": quantiles[49] * 1000,
+            "p95_ms": quantiles[94] * 1000,
+            "p99_ms": quantiles[98] * 1000,
+            "max_ms": max(latencies) * 1000,
+        }
+
+
+class QueryCounter(object):
+    """
+    Counts the queries run on the Superset metadata DB, using pg_stat_statements
+    """
+
+    def __init__(self, db_uri: str):
+        self.connection = None
+        try:
+            import psycopg2
+        except ImportError:
+            logger.warning("psycopg2 not found: the DB queries won't be counted")
+            return
+        try:
+            self.connection = psycopg2.connect(db_uri)
+            self.connection.autocommit = True
+            with self.connection.cursor() as cursor:
+                cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_stat_statements")
+                cursor.execute("SELECT 1 FROM pg_stat_statements LIMIT 1")
+        except psycopg2.Error as e:
+            logger.warning(
+                f"pg_stat_statements not available, the DB queries won't be counted: {e}"
+            )
+            self.connection = None
+
+    def reset(self) -> None:
+        if self.connection:
+            with self.connection.cursor() as cursor:
+                cursor.execute("SELECT pg_stat_statements_reset()")
+
+    def count(self) -> Optional[int]:
+        """
+        :return: number of queries run on the current DB since the last reset, not
+        counting ours
+        """
+        if not self.connection:
+            return None
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT coalesce(sum(calls), 0) FROM pg_stat_statements "
+                "JOIN pg_database ON pg_database.oid = dbid "
+                "WHERE datname = current_database() "
+                "AND query NOT LIKE '%pg_stat_statements%'"
+            )
+            return int(cursor.fetchone()[0])
+
+
+class LoadTest(object):
+    def __init__(self, args):
+        self.args = args
+        self.population = Population(
+            args.users, args.roles.split(","), args.max_roles_per_user, args.seed
+        )
+        self.public_dashboards = []
+        self.query_counter = QueryCounter(args.db_uri)
+
+    def discover_public_dashboards(self) -> None:
+        if self.args.public_dashboards:
+            self.public_dashboards = self.args.public_dashboards.split(",")
+            return
+        client = Client(self.args.url, self.args.timeout)
+        status, body = client.get("/api/v1/dashboard/?q=(page_size:100)")
+        client.close()
+        if status == 200:
+            self.public_dashboards = [
+                str(dashboard["id"]) for dashboard in json.loads(body)["result"]
+            ]
+        if not self.public_dashboards:
+            logger.warning(
+                "No dashboard visible to anonymous users (Public role). "
+                "The anonymous scenario will only load the welcome page"
+            )
+
+    # Scenarios. Each call is one "page view"
+
+    def anonymous(self, client: Client) -> bool:
+        if not self.public_dashboards:
+            return self._get(client, "/superset/welcome/", {})
+        dashboard = random.choice(self.public_dashboards)
+        return self._get(
+            client, f"/superset/dashboard/{dashboard}/", {}
+        ) and self._get(client, f"/api/v1/dashboard/{dashboard}/charts", {})
+
+    def viewer(self, client: Client) -> bool:
+        headers = self.population.headers(client.user)
+        path = random.choice(
+            (
+                "/superset/welcome/",
+                "/api/v1/dashboard/?q=(page_size:25)",
+                "/api/v1/chart/?q=(page_size:25)",
+                "/api/v1/me/roles/",
+            )
+        )
+        return self._get(client, path, headers)
+
+    def role_change(self, client: Client) -> bool:
+        self.population.change_roles(client.user)
+        return self._get(
+            client, "/api/v1/me/roles/", self.population.headers(client.user)
+        )
+
+    def _get(self, client: Client, path: str, headers: dict) -> bool:
+        status, _ = client.get(path, headers)
+        return status < 400
+
+    def worker(self, scenarios: list[str], weights: list[float], stop: float, recorder):
+        clients = {}
+        while time.monotonic() < stop:
+            scenario = random.choices(scenarios, weights)[0]
+            client = clients.get(scenario)
+            # Viewers come and go: new browser session from time to time
+            if client is None or random.random() < self.args.new_session_rate:
+                if client:
+                    client.close()
+                client = clients[scenario] = Client(self.args.url, self.args.timeout)
+                client.user = self.population.pick_user()
+            start = time.perf_counter()
+            try:
+                ok = getattr(self, scenario)(client)
+            except (OSError, http.client.HTTPException) as e:
+                logger.debug(f"{scenario}: {e}")
+                ok = False
+            recorder.record(scenario, time.perf_counter() - start, ok)
+            if self.args.think_time:
+                time.sleep(random.expovariate(1 / self.args.think_time))
+        for client in clients.values():
+            client.close()
+
+    def run_phase(self, name: str, scenarios: list[str], weights: list[float]) -> dict:
+        logger.info(
+            f"Running {name} for {self.args.duration}s, {self.args.concurrency} clients"
+        )
+        recorder = Recorder()
+        self.query_counter.reset()
+        start = time.monotonic()
+        stop = start + self.args.duration
+        threads = [
+            threading.Thread(
+                target=self.worker, args=(scenarios, weights, stop, recorder), daemon=True
+            )
+            for _ in range(self.args.concurrency)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        duration = time.monotonic() - start
+        result = recorder.summary(duration)
+        queries = self.query_counter.count()
+        if queries is not None:
+            result["total"]["db_queries"] = queries
+            requests = result["total"]["requests"]
+            result["total"]["db_queries_per_request"] = (
+                queries / requests if requests else None
+            )
+        return result
+
+    def run(self) -> dict:
+        self.discover_public_dashboards()
+        mix = dict(zip(SCENARIOS, (float(w) for w in self.args.mix.split(","))))
+        enabled = [scenario for scenario in SCENARIOS if mix.get(scenario)]
+        results = {}
+        if not self.args.mixed_only:
+            for scenario in enabled:
+                results[scenario] = self.run_phase(scenario, [scenario], [1])
+        results["mixed"] = self.run_phase(
+            "mixed", enabled, [mix[scenario] for scenario in enabled]
+        )
+        return results
+
+
+def print_results(results: dict) -> None:
+    print(
+        f"\n{'phase':12s} {'scenario':12s} {'requests':>9s} {'errors':>7s} {'req/s':>8s}"
+        f" {'p50 ms':>8s} {'p95 ms':>8s} {'p99 ms':>8s} {'DB queries/req':>15s}"
+    )
+    for phase, result in results.items():
+        for scenario, values in result.items():
+            if not values.get("requests"):
+                continue
+            queries = values.get("db_queries_per_request")
+            print(
+                f"{phase:12s} {scenario:12s} {values['requests']:9d} {values['errors']:7d}"
+                f" {values['throughput_rps']:8.1f} {values['p50_ms']:8.1f}"
+                f" {values['p95_ms']:8.1f} {values['p99_ms']:8.1f}"
+                f" {'' if queries is None else f'{queries:.2f}':>15s}"
+            )
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description=__doc__.split("\n\n")[0],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("--url", default="http://localhost:8088")
+    parser.add_argument("--duration", type=float, default=60, help="seconds per phase")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--users", type=int, default=500, help="number of users")
+    parser.add_argument(
+        "--roles",
+        default="ROLE_SUPERSET_GAMMA,ROLE_SUPERSET_ALPHA,ROLE_SUPERSET_SQL_LAB",
+        help="comma-separated geOrchestra roles the users get a random subset of",
+    )
+    parser.add_argument("--max-roles-per-user", type=int, default=2)
+    parser.add_argument(
+        "--mix",
+        default="5,4,1",
+        help="weights of the anonymous, viewer and role_change scenarios. "
+        "0 disables a scenario",
+    )
+    parser.add_argument(
+        "--mixed-only", action="store_true", help="only run the mixed phase"
+    )
+    parser.add_argument(
+        "--public-dashboards",
+        help="comma-separated ids of the dashboards for the anonymous viewers. "
+        "Default: those the Public role can see",
+    )
+    parser.add_argument(
+        "--new-session-rate",
+        type=float,
+        default=0.05,
+        help="probability, for each request, that the client starts a new session",
+    )
+    parser.add_argument(
+        "--think-time", type=float, default=0, help="mean pause between requests (s)"
+    )
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument(
+        "--db-uri",
+        default=default_db_uri(),
+        help="Superset metadata DB, to count the queries (pg_stat_statements)",
+    )
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.INFO,
+        format="%(asctime)s %(levelname)s %(message)s",
+    )
+    results = LoadTest(args).run()
+    print_results(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            parameters = {k: v for k, v in vars(args).items() if k != "db_uri"}
+            json.dump({"parameters": parameters, "results": results}, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())